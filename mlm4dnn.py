@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import shlex
 import argparse
 import subprocess
 import scripts._rs_utils as pgrsu
@@ -92,6 +93,7 @@ python scripts/model_repair.py \
     --repo2model-path {repo2model_file} \
     --model-train-env-name {train_env_name} \
     --out-dir {output_dir} \
+    --filter-num-workers 0 \
     --ops {ops}"""
 
     system(
@@ -175,6 +177,18 @@ IM4DNN_REMOVE_ROOT=1 bash scripts/finetune_unixcoder.sh \
     system(launch_cmd.format_map(finetune_config))
 
 
+def build_dataset():
+    # All args are of scripts/build_mlm_dataset.py, e.g. --input_dir --output_dir
+    launch_cmd = "python -u scripts/build_mlm_dataset.py " + shlex.join(sys.argv[1:])
+    exit(system(launch_cmd))
+
+
+def aggregate():
+    # All args are of scripts/aggregate_results.py, e.g. --repair_result_dirs --output_dir
+    launch_cmd = "python -u scripts/aggregate_results.py " + shlex.join(sys.argv[1:])
+    exit(system(launch_cmd))
+
+
 def repro():
     parser = argparse.ArgumentParser()
     parser.add_argument("--infill-api-config-file", type=str, default=None)
@@ -211,7 +225,7 @@ if __name__ == "__main__":
         print("Usage: python mlm4dnn.py <subcmd> ...")
         exit(-1)
 
-    available_subcmds = ["train", "repro"]
+    available_subcmds = ["train", "repro", "build_dataset", "aggregate"]
     subcmd = sys.argv.pop(1)
     if subcmd not in available_subcmds:
         print(f"Available subcmds: {available_subcmds}")
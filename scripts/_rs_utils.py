@@ -618,6 +618,11 @@ class TimeCounter:
             cls.__result_stack[-1][tag] = 0
         cls.__result_stack[-1][tag] += duration
 
+    @classmethod
+    def add_result(cls, duration, *args, sep=':'):
+        """Add a duration (nano) measured elsewhere, e.g. in a worker process"""
+        cls.__add_result(sep.join(args), duration)
+
     @classmethod
     def push_result(cls, result=None):
         result = result or {}
@@ -0,0 +1,175 @@
+import os
+import glob
+import sqlite3
+import argparse
+import multiprocessing
+import _rs_utils as pgrsu
+
+from collect_result import collect
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+_STAGES = ("1", "2", "3")  # 1: Gen DNNm; 2: Infill DNNm; 3: Filter Patch
+_MODEL_COLUMNS = ["run", "model", "rank_W", "rank_S", "rank_EM"] + [f"time_{s}" for s in _STAGES]
+_SUMMARY_COLUMNS = [
+    "run", "models", "WRC", "SRC", "SMC", "mean_rank_W", "mean_rank_S", "mean_rank_EM",
+] + [f"{k}_time_{s}" for s in _STAGES for k in ("total", "mean")]
+
+
+def _find_runs(patterns: list[str]) -> list[str]:
+    """Repair result dirs (i.e. dirs having validate_results/) matched by the patterns"""
+    runs = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.isdir(os.path.join(path, "validate_results")):
+                runs.add(os.path.abspath(path))
+    return sorted(runs)
+
+
+def _load_time_cost(model_result_dir: str, stage: str) -> float | None:
+    time_cost_jf = os.path.join(model_result_dir, f"_{stage}_time_cost.json")
+    if not os.path.isfile(time_cost_jf):
+        return None
+    return pgrsu._load_json(time_cost_jf)["time_cost"]
+
+
+def _correct_models_dir(run_dir: str, default: str | None) -> str | None:
+    """The fmt_fixed_files of the run (i.e. its `repro` output dir), default if not found"""
+    fmt_fixed_files_dir = os.path.join(run_dir, "fmt_fixed_files")
+    return fmt_fixed_files_dir if os.path.isdir(fmt_fixed_files_dir) else default
+
+
+def _aggregate_run(task):
+    """
+    Collect one repair result dir (in a worker), None if it is not complete
+
+    NOTE: The canonical forms memoized by collect_result are shared by the runs of a
+    worker, most correct models (and many patches) are the same across runs
+    """
+    run_dir, name, correct_models_dir, patch_source_jfilename = task
+    if (correct_models_dir := _correct_models_dir(run_dir, correct_models_dir)) is None:
+        pgrsu._wlog(f"Failed to collect {run_dir}: no fmt_fixed_files and no --correct_models_dir")
+        return None
+    try:
+        result = collect(run_dir, correct_models_dir, patch_source_jfilename)
+    except Exception as e:
+        pgrsu._wlog(f"Failed to collect {run_dir}: {type(e).__name__}: {e}")
+        return None
+
+    rows = []
+    for model_row in result["models"]:
+        row = {"run": name, **model_row}
+        for s in _STAGES:
+            row[f"time_{s}"] = _load_time_cost(os.path.join(run_dir, row["model"]), s)
+        rows.append(row)
+
+    summary = {"run": name}
+    for k in _SUMMARY_COLUMNS[1:8]:
+        v = result["summary"][k]
+        summary[k] = None if v == "-" else v  # A column of numbers
+    for s in _STAGES:
+        times = [r[f"time_{s}"] for r in rows if r[f"time_{s}"] is not None]
+        summary[f"total_time_{s}"] = sum(times) if times else None
+        summary[f"mean_time_{s}"] = sum(times) / len(times) if times else None
+    return summary, rows
+
+
+def _save_as_sqlite(tables: dict, filename: str):
+    tmp_filename = f"{filename}.tmp"
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    db = sqlite3.connect(tmp_filename)
+    for table, (columns, rows) in tables.items():
+        db.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+        db.executemany(
+            f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})",
+            [[r[c] for c in columns] for r in rows],
+        )
+    db.commit()
+    db.close()
+    os.replace(tmp_filename, filename)  # Never leave a partial table
+
+
+def _save_as_parquet(tables: dict, output_dir: str):
+    for table, (columns, rows) in tables.items():
+        pyarrow.parquet.write_table(
+            pyarrow.table({c: [r[c] for r in rows] for c in columns}),
+            os.path.join(output_dir, f"{table}.parquet"),
+        )
+
+
+def _fmt(v, digits=2):
+    if v is None:
+        return "-"
+    return f"{v:.{digits}f}" if isinstance(v, float) else str(v)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Aggregate the results of many repair result dirs (e.g. repro runs) into one table"
+    )
+    parser.add_argument("--repair_result_dirs", type=str, nargs="+", required=True,
+                        help="Dirs or glob patterns (`**` is supported), dirs without validate_results/ are ignored")
+    parser.add_argument("--correct_models_dir", type=str, default=None,
+                        help="Used by the runs without <run>/fmt_fixed_files (made by `repro`)")
+    parser.add_argument("--patch_source_filename", type=str, default="filtered_possible_repaired_models.json")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="The tables `summary` and `models` are saved to results.sqlite or *.parquet")
+    parser.add_argument("--format", type=str, choices=["sqlite", "parquet"], default="sqlite")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    if args.format == "parquet" and pyarrow is None:
+        parser.error("pyarrow is required by --format parquet, install it or use --format sqlite")
+    return args
+
+
+def main(args):
+    runs = _find_runs(args.repair_result_dirs)
+    if not runs:
+        pgrsu._flog(f"Not found any repair result dir in {args.repair_result_dirs}")
+    pgrsu._ilog(f"Found {len(runs)} repair result dirs")
+
+    # Runs are named by their paths relative to the common root of all runs
+    root = os.path.dirname(runs[0]) if len(runs) == 1 else os.path.commonpath(runs)
+    tasks = [
+        (r, os.path.relpath(r, root), args.correct_models_dir, args.patch_source_filename)
+        for r in runs
+    ]
+    summaries, rows = [], []
+    with multiprocessing.Pool(max(1, min(args.num_workers, len(tasks)))) as pool:
+        for result in pgrsu._tqdm(
+            pool.imap(_aggregate_run, tasks), title="Aggregate runs", len=len(tasks)
+        ):
+            if result is not None:
+                summaries.append(result[0])
+                rows.extend(result[1])
+
+    tables = {
+        "summary": (_SUMMARY_COLUMNS, summaries),
+        "models": (_MODEL_COLUMNS, rows),
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.format == "sqlite":
+        _save_as_sqlite(tables, os.path.join(args.output_dir, "results.sqlite"))
+    else:
+        _save_as_parquet(tables, args.output_dir)
+    pgrsu._ilog(f"Aggregated {len(summaries)}/{len(runs)} runs ({len(rows)} models) to {args.output_dir}")
+
+    pgrsu._ilog("Run\tWRC\tSRC\tSMC\tRank")
+    for s in summaries:
+        rank = "/".join(_fmt(s[k]) for k in ("mean_rank_W", "mean_rank_S", "mean_rank_EM"))
+        pgrsu._ilog(f"{s['run']}\t{s['WRC']}\t{s['SRC']}\t{s['SMC']}\t{rank}")
+
+    pgrsu._ilog("Run\t" + "\t".join(f"T{s} (Total/Mean)" for s in _STAGES))
+    for s in summaries:
+        times = [f"{_fmt(s[f'total_time_{t}'])}/{_fmt(s[f'mean_time_{t}'])}" for t in _STAGES]
+        pgrsu._ilog(f"{s['run']}\t" + "\t".join(times))
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,222 @@
+import io
+import os
+import ast
+import glob
+import json
+import random
+import hashlib
+import sqlite3
+import argparse
+import multiprocessing
+import _rs_utils as pgrsu
+import data_utils as du
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+_DEFAULT_TEMPLATES = [
+    t.name
+    for t in (
+        du._MT_mask_keras_metric_arg,
+        du._MT_mask_keras_learning_rate_arg,
+        du._MT_mask_keras_optimizer_arg,
+        du._MT_mask_keras_loss_arg,
+        du._MT_mask_keras_epochs_arg,
+        du._MT_mask_keras_batch_size_arg,
+        du._MT_mask_keras_Layer,
+        du._MT_mask_keras_activation_arg,
+        du._MT_mask_keras_initializer_arg,
+    )
+]
+_SPLITS = ("train", "valid", "test")
+
+
+def _digest(string: str) -> bytes:
+    # hash(MaskedPython) is hash(string), but str hashes are salted per process
+    return hashlib.blake2b(string.encode("utf-8"), digest_size=16).digest()
+
+
+def _assign_split(relpath: str, ratios: list[float]) -> str:
+    """Split by program (not by masked sample), stable for a given relpath"""
+    h = int.from_bytes(_digest(relpath)[:8], "big") / 2**64
+    for split, ratio in zip(_SPLITS, ratios):
+        if h < ratio:
+            return split
+        h -= ratio
+    return _SPLITS[-1]
+
+
+def _normalize(code: str, std_keras_usage: bool) -> str:
+    codeast = ast.parse(code)
+    if std_keras_usage:
+        from repo2model_s import _std_keras_usage_style
+
+        codeast = ast.fix_missing_locations(_std_keras_usage_style(codeast))
+    return ast.unparse(codeast)
+
+
+def _masked_python_to_record(mp: du.MaskedPython, templ: str, relpath: str, mask_hint: bool):
+    if len(mp.masked_cfs_ast) != 1:
+        return None
+    record = mp.to_istr_ostr()  # The same formatting as the original dataset
+    if mask_hint:
+        hint = du._make_mask_hint_token(du._get_possible_ast_hint(mp.masked_cfs_ast[0]))
+        marker = du._make_mask_marker(0)
+        record["python_wmt_string"] = record["python_wmt_string"].replace(marker, f"{marker} {hint}")
+    return {**record, "template": templ, "program": relpath}
+
+
+def _build_shard(task):
+    """
+    Normalize and template the programs of one shard (in a worker), seeded by the
+    shard so that a rebuild with the same arguments gives the same samples
+    """
+    split, shard_id, relpaths, args = task
+    random.seed(f"{args.seed}:{split}:{shard_id}")
+    templates = [du._mask_t(name) for name in args.templates]
+    records, stats = [], {"programs": 0, "failed_programs": 0, "samples": 0}
+    for relpath in relpaths:
+        stats["programs"] += 1
+        try:
+            with open(os.path.join(args.input_dir, relpath), "r", encoding="UTF-8") as fp:
+                code = _normalize(fp.read(), args.std_keras_usage)
+            site_index = du.MaskSiteIndex(code)  # Shared by all templates and tries
+            result = du._generate_masked_python(
+                codeast=site_index.codeast,
+                templates=templates,
+                expected_number_of_data_generated_by_templ=[args.expected_number] * len(templates),
+                max_tries_per_templ=args.max_tries_per_templ,
+                **{f"{t.name}_site_index": site_index for t in templates if t.name.startswith("T_mask_keras_")},
+            )
+        except Exception as e:
+            stats["failed_programs"] += 1
+            pgrsu._wlog(f"Failed to template {relpath}: {type(e).__name__}: {e}")
+            continue
+        for templ in args.templates:  # Sorted, a set has no stable order across processes
+            for mp in sorted(result[templ], key=lambda x: x.string):
+                if record := _masked_python_to_record(mp, templ, relpath, args.mask_hint):
+                    records.append((_digest(mp.string), record))
+    stats["samples"] = len(records)
+    return split, shard_id, records, stats
+
+
+class _DiskBackedSet:
+    """A set of digests in sqlite, for deduping more samples than fit in memory"""
+
+    def __init__(self, filename: str):
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE seen (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+
+    def add(self, digest: bytes) -> bool:
+        """Add digest, False if it was already in the set"""
+        return self.db.execute("INSERT OR IGNORE INTO seen VALUES (?)", (digest,)).rowcount == 1
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        os.remove(self.filename)
+
+
+def _open_shard_writer(filename: str, compression: str):
+    if compression == "none":
+        return open(filename, "w", encoding="UTF-8")
+    fp = zstandard.ZstdCompressor(level=3).stream_writer(open(filename, "wb"))
+    return io.TextIOWrapper(fp, encoding="UTF-8")
+
+
+def _write_shard(filename: str, records: list[dict], compression: str):
+    tmp_filename = f"{filename}.tmp"
+    with _open_shard_writer(tmp_filename, compression) as fp:
+        for record in records:
+            fp.write(json.dumps(record) + "\n")
+    os.replace(tmp_filename, filename)  # Never leave a partial shard
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Build the (sharded) MLM dataset from a corpus of keras programs"
+    )
+    parser.add_argument("--input_dir", type=str, required=True,
+                        help="The corpus, all *.py (recursively) are used")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="Shards are written to <output_dir>/{train,valid,test}/")
+    parser.add_argument("--templates", type=str, nargs="+", default=_DEFAULT_TEMPLATES)
+    parser.add_argument("--expected_number", type=int, default=1,
+                        help="Expected number of samples generated by a template per program")
+    parser.add_argument("--max_tries_per_templ", type=int, default=1)
+    parser.add_argument("--split_ratios", type=float, nargs=3, default=[0.8, 0.1, 0.1])
+    parser.add_argument("--std_keras_usage", action="store_true", default=False,
+                        help="Normalize the programs by _std_keras_usage_style of repo2model_s")
+    parser.add_argument("--mask_hint", action="store_true", default=False,
+                        help="Append the mask hint to the mask, e.g. `__mask_0__ __mhint_K_loss__`")
+    parser.add_argument("--programs_per_shard", type=int, default=512)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--compression", type=str, choices=["zst", "none"], default="zst")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    for name in args.templates:
+        if name not in du._glb_mask_templates:
+            parser.error(f"Unknown template {name}, available: {sorted(du._glb_mask_templates)}")
+    if args.compression == "zst" and zstandard is None:
+        parser.error("zstandard is required by --compression zst, install it or use --compression none")
+    return args
+
+
+def main(args):
+    args.input_dir = os.path.abspath(args.input_dir)
+    args.output_dir = os.path.abspath(args.output_dir)
+    ext = ".jsonl.zst" if args.compression == "zst" else ".jsonl"
+
+    relpaths = sorted(
+        os.path.relpath(f, args.input_dir)
+        for f in glob.glob(f"{args.input_dir}/**/*.py", recursive=True)
+    )
+    pgrsu._ilog(f"Found {len(relpaths)} programs in {args.input_dir}")
+
+    tasks = []
+    for split in _SPLITS:
+        split_relpaths = [p for p in relpaths if _assign_split(p, args.split_ratios) == split]
+        split_dir = os.path.join(args.output_dir, split)
+        os.makedirs(split_dir, exist_ok=True)
+        for stale in glob.glob(f"{split_dir}/*.jsonl*"):  # Of the last build
+            os.remove(stale)
+        for i in range(0, len(split_relpaths), args.programs_per_shard):
+            shard_id = i // args.programs_per_shard
+            tasks.append((split, shard_id, split_relpaths[i : i + args.programs_per_shard], args))
+
+    # Shards are deduped (and written) in task order, so the first of the duplicates
+    # (e.g. the one in train) is kept whatever the number of workers
+    seen = _DiskBackedSet(os.path.join(args.output_dir, ".dedupe.sqlite"))
+    totals = {s: {"programs": 0, "failed_programs": 0, "samples": 0, "written": 0} for s in _SPLITS}
+    with multiprocessing.Pool(args.num_workers) as pool:
+        for split, shard_id, records, stats in pgrsu._tqdm(
+            pool.imap(_build_shard, tasks), title="Build shards", len=len(tasks)
+        ):
+            kept = [record for digest, record in records if seen.add(digest)]
+            _write_shard(os.path.join(args.output_dir, split, f"{shard_id:05d}{ext}"), kept, args.compression)
+            for k, v in stats.items():
+                totals[split][k] += v
+            totals[split]["written"] += len(kept)
+    seen.close()
+
+    pgrsu._save_as_json(
+        {"args": vars(args), "totals": totals},
+        os.path.join(args.output_dir, "meta.json"),
+    )
+    for split, t in totals.items():
+        pgrsu._ilog(
+            f"{split}: {t['programs']} programs ({t['failed_programs']} failed), "
+            f"{t['samples']} samples, {t['written']} written after dedupe"
+        )
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -1,47 +1,111 @@
 import os
 import ast
+import csv
 import glob
+import hashlib
 import argparse
+import multiprocessing
 import _rs_utils as pgrsu
 
 from repo2model_s import _std_keras_usage_style
 
 
-def _semantic_equivalent(a: str, b: str) -> bool:
+def _canonical_form(source: str) -> str | None:
     """
-    _std_keras_usage_style(ast.parse(a)) == _std_keras_usage_style(ast.parse(b))
+    ast.unparse(_std_keras_usage_style(ast.parse(source))), without `__root__.` and
+    the imports, None if source is not parsable
     """
-
-    a = a.replace("__root__.", "")
-    b = b.replace("__root__.", "")
-
-    if a.strip() == b.strip():
-        return True
-
+    source = source.replace("__root__.", "")
     try:
-        a_ast = ast.parse(a)
-        b_ast = ast.parse(b)
+        codeast = ast.parse(source)
     except SyntaxError:
-        return False
-
-    a_ast.body = [
+        return None
+    codeast.body = [
         stmt
-        for stmt in a_ast.body
-        if not isinstance(stmt, (ast.Import, ast.ImportFrom))
-    ]
-    b_ast.body = [
-        stmt
-        for stmt in b_ast.body
+        for stmt in codeast.body
         if not isinstance(stmt, (ast.Import, ast.ImportFrom))
     ]
+    return ast.unparse(_std_keras_usage_style(codeast))
+
+
+def _digest(source: str) -> str:
+    return hashlib.blake2b(source.encode("utf-8"), digest_size=16).hexdigest()
+
 
-    std_a_ast = _std_keras_usage_style(a_ast)
-    std_b_ast = _std_keras_usage_style(b_ast)
-    if ast.unparse(std_a_ast) == ast.unparse(std_b_ast):
+_canonical_digests = {}  # digest of source => digest of its canonical form (or None), per process
+
+
+def _canonical_digest(source: str) -> str | None:
+    """
+    Memoized digest of _canonical_form(source), patches (and correct models) are
+    often the same source, e.g. at many ranks or in many runs
+    """
+    key = _digest(source)
+    if key not in _canonical_digests:
+        canonical = _canonical_form(source)
+        _canonical_digests[key] = _digest(canonical) if canonical is not None else None
+    return _canonical_digests[key]
+
+
+def _semantic_equivalent(a: str, b: str) -> bool:
+    """
+    _std_keras_usage_style(ast.parse(a)) == _std_keras_usage_style(ast.parse(b))
+    """
+    if a.replace("__root__.", "").strip() == b.replace("__root__.", "").strip():
         return True
+    a_canonical = _canonical_digest(a)
+    return a_canonical is not None and a_canonical == _canonical_digest(b)
 
-    # ...
-    return False
+
+def _load_dup_ranks(model_result_dir: str, patch_source_jfilename: str):
+    """
+    Load the dup ranks recorded by the dedup filter of `model_repair.py`, None
+    if not deduped. dup_ranks[j] are the 0-based ranks of patch j before dedup.
+    """
+    dup_ranks_jf = (
+        f"{model_result_dir}/{patch_source_jfilename[:-len('.json')]}-dup_ranks.json"
+    )
+    if not os.path.isfile(dup_ranks_jf):
+        return None
+    return pgrsu._load_json(dup_ranks_jf)
+
+
+def _fan_out_ranks(dup_ranks, rank: int) -> list[int]:
+    """
+    Map a 1-based rank of the deduped patches to all its 1-based ranks before dedup
+    """
+    if rank == -1:
+        return []
+    if dup_ranks is None:
+        return [rank]
+    return [r + 1 for r in dup_ranks[rank - 1]]
+
+
+def _exact_match_rank(task) -> int:
+    """
+    The 1-based rank (before dedup) of the first patch semantically equivalent to
+    the correct model, -1 if none; the correct model is canonicalized once, and a
+    patch only if its text does not match
+    """
+    patch_jf, correct_filename, dup_ranks = task
+    patch_sources = pgrsu._load_json(patch_jf)
+    correct_source = pgrsu._load_txt(correct_filename)
+    correct_text = correct_source.replace("__root__.", "").strip()
+    correct_canonical = _canonical_digest(correct_source)
+    for i, patch_source in enumerate(patch_sources, start=1):
+        if isinstance(patch_source, list):
+            assert len(patch_source) == 2
+            patch_source = patch_source[0].replace("__mask_0__", patch_source[1])
+        if patch_source.replace("__root__.", "").strip() == correct_text or (
+            correct_canonical is not None
+            and _canonical_digest(patch_source) == correct_canonical
+        ):
+            return _fan_out_ranks(dup_ranks, i)[0]
+    return -1
+
+
+def _mean(ranks: list[int]):
+    return sum(ranks) / len(ranks) if len(ranks) > 0 else "-"
 
 
 def get_args():
@@ -50,14 +114,28 @@ def get_args():
     parser.add_argument("--correct_models_dir", type=str, required=True)
     parser.add_argument("--patch_source_filename", type=str, required=True)
     parser.add_argument("--verbose", action="store_true", default=False)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(),
+                        help="Models are compared with their correct models in parallel")
+    parser.add_argument("--output_json", type=str, default=None,
+                        help="Also save the summary and the ranks of each model as json")
+    parser.add_argument("--output_csv", type=str, default=None,
+                        help="Also save the ranks of each model as csv")
     return parser.parse_args()
 
 
-def main(args):
-    repair_result_dir = os.path.abspath(args.repair_result_dir)
-    correct_models_dir = os.path.abspath(args.correct_models_dir)
-    patch_source_jfilename = args.patch_source_filename
-    verbose = args.verbose
+def collect(
+    repair_result_dir: str,
+    correct_models_dir: str,
+    patch_source_jfilename: str,
+    num_workers: int = 1,
+    verbose: bool = False,
+) -> dict:
+    """
+    Collect WRC/SRC/SMC and the ranks of a repair result dir, as
+    {"summary": {...}, "models": [{"model", "rank_W", "rank_S", "rank_EM"}, ...]}
+    """
+    repair_result_dir = os.path.abspath(repair_result_dir)
+    correct_models_dir = os.path.abspath(correct_models_dir)
     assert os.path.isdir(repair_result_dir)
     assert os.path.isdir(correct_models_dir)
     assert patch_source_jfilename.endswith(".json")
@@ -71,11 +149,8 @@ def main(args):
 
     if len(models) > len(v_models):
         pgrsu._wlog(f"Found {len(models)} but {len(v_models)} validated, ignoring some")
-        models = [
-            m
-            for m in models
-            if any(os.path.basename(m) == os.path.basename(v) for v in v_models)
-        ]
+        v_names = set(os.path.basename(v) for v in v_models)
+        models = [m for m in models if os.path.basename(m) in v_names]
     assert len(models) == len(v_models)
 
     pgrsu._ilog(f"Found {len(models)} models")
@@ -95,37 +170,31 @@ def main(args):
     res_WRC = sum(1 if j is not None else 0 for j in weak1st_patch_jsons)
     res_SRC = sum(1 if j is not None else 0 for j in strong2_patch_jsons)
 
-    ranks_WRC = [
-        int(j["patch_name"].split(".")[-1]) + 1 if j else -1
-        for j in weak1st_patch_jsons
+    # Fan the ranks of deduped patches back out, the highest rank is reported
+    models_dup_ranks = [_load_dup_ranks(m, patch_source_jfilename) for m in models]
+    all_ranks_WRC = [
+        _fan_out_ranks(d, int(j["patch_name"].split(".")[-1]) + 1 if j else -1)
+        for j, d in zip(weak1st_patch_jsons, models_dup_ranks)
     ]
-    ranks_SRC = [
-        int(j["patch_name"].split(".")[-1]) + 1 if j else -1
-        for j in strong2_patch_jsons
+    all_ranks_SRC = [
+        _fan_out_ranks(d, int(j["patch_name"].split(".")[-1]) + 1 if j else -1)
+        for j, d in zip(strong2_patch_jsons, models_dup_ranks)
     ]
+    ranks_WRC = [r[0] if r else -1 for r in all_ranks_WRC]
+    ranks_SRC = [r[0] if r else -1 for r in all_ranks_SRC]
 
-    res_SMC = 0
-    ranks_SMC = []
-    emr_models = []
-    for m in models:
+    tasks = []
+    for m, dup_ranks in zip(models, models_dup_ranks):
         patch_jf = f"{m}/{patch_source_jfilename}"
         assert os.path.isfile(patch_jf)
-
-        patch_sources = pgrsu._load_json(patch_jf)
-        correct_source = pgrsu._load_txt(f"{correct_models_dir}/{os.path.basename(m)}")
-
-        this_rank = -1
-        for i, patch_source in enumerate(patch_sources, start=1):
-            if isinstance(patch_source, list):
-                assert len(patch_source) == 2
-                patch_source = patch_source[0].replace("__mask_0__", patch_source[1])
-            if _semantic_equivalent(patch_source, correct_source):
-                this_rank = i
-                res_SMC += 1
-                break
-        ranks_SMC.append(this_rank)
-        if this_rank != -1:
-            emr_models.append(os.path.basename(m))
+        tasks.append((patch_jf, f"{correct_models_dir}/{os.path.basename(m)}", dup_ranks))
+    if num_workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(num_workers, len(tasks))) as pool:
+            ranks_SMC = pool.map(_exact_match_rank, tasks, chunksize=1)
+    else:
+        ranks_SMC = [_exact_match_rank(t) for t in tasks]
+    res_SMC = sum(1 for r in ranks_SMC if r != -1)
+    emr_models = [os.path.basename(m) for m, r in zip(models, ranks_SMC) if r != -1]
     assert len(ranks_WRC) == len(ranks_SRC) == len(ranks_SMC) == len(models)
 
     if verbose:
@@ -143,6 +212,15 @@ def main(args):
 
         pgrsu._ilog(f"Exact Match Repaired: {emr_models}")
 
+        if any(d is not None for d in models_dup_ranks):
+            pgrsu._ilog(f"All Ranks (Dup) of W : {[r for r in all_ranks_WRC if r]}")
+            pgrsu._ilog(f"All Ranks (Dup) of S : {[r for r in all_ranks_SRC if r]}")
+
+    rows = [
+        {"model": os.path.basename(m), "rank_W": w, "rank_S": s, "rank_EM": e}
+        for m, w, s, e in zip(models, ranks_WRC, ranks_SRC, ranks_SMC)
+    ]
+
     ranks_WRC = [r for r in ranks_WRC if r != -1]
     ranks_SRC = [r for r in ranks_SRC if r != -1]
     ranks_SMC = [r for r in ranks_SMC if r != -1]
@@ -153,14 +231,47 @@ def main(args):
     assert len(ranks_SRC) == res_SRC
     assert len(ranks_SMC) == res_SMC
 
-    mean_rank_WRC = sum(ranks_WRC) / len(ranks_WRC) if len(ranks_WRC) > 0 else "-"
-    mean_rank_SRC = sum(ranks_SRC) / len(ranks_SRC) if len(ranks_SRC) > 0 else "-"
-    mean_rank_SMC = sum(ranks_SMC) / len(ranks_SMC) if len(ranks_SMC) > 0 else "-"
+    mean_rank_WRC = _mean(ranks_WRC)
+    mean_rank_SRC = _mean(ranks_SRC)
+    mean_rank_SMC = _mean(ranks_SMC)
     res_Rank = f"{mean_rank_WRC}/{mean_rank_SRC}/{mean_rank_SMC}"
 
     pgrsu._ilog(f"WRC\tSRC\tSMC\tRank")
     pgrsu._ilog(f"{res_WRC}\t{res_SRC}\t{res_SMC}\t{res_Rank}")
 
+    summary = {
+        "models": len(models),
+        "WRC": res_WRC,
+        "SRC": res_SRC,
+        "SMC": res_SMC,
+        "mean_rank_W": mean_rank_WRC,
+        "mean_rank_S": mean_rank_SRC,
+        "mean_rank_EM": mean_rank_SMC,
+        "Rank": res_Rank,
+    }
+    return {"summary": summary, "models": rows}
+
+
+def _save_as_csv(rows: list[dict], filename: str):
+    with open(filename, "w", encoding="UTF-8", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=["model", "rank_W", "rank_S", "rank_EM"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(args):
+    result = collect(
+        args.repair_result_dir,
+        args.correct_models_dir,
+        args.patch_source_filename,
+        num_workers=args.num_workers,
+        verbose=args.verbose,
+    )
+    if args.output_json:
+        pgrsu._save_as_json({"args": vars(args), **result}, args.output_json)
+    if args.output_csv:
+        _save_as_csv(result["models"], args.output_csv)
+
 
 if __name__ == "__main__":
     main(get_args())
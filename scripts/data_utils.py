@@ -4,6 +4,7 @@ import ast
 import tokenize
 import random
 import functools
+import numpy as np
 import _rs_utils as pgrsu
 from dataclasses import dataclass
 from typing import Callable, Tuple, List, Set, Dict, Union, TextIO, Any
@@ -57,11 +58,8 @@ def _clone_ast(root):
 
 
 def _set_height(root: ast.AST) -> ast.AST:
-    subtree_max_height = 0
-    for child in ast.iter_child_nodes(root):
-        subtree_max_height = max(subtree_max_height,
-                                 _set_height(child)._pg_height)
-    root._pg_height = subtree_max_height + 1
+    for node, height in zip(*NodeTable(root).columns('height')):
+        node._pg_height = height
     return root
 
 
@@ -74,9 +72,9 @@ def _set_node_id(root, init_id=0):
 def _set_parent(root):
     if not hasattr(root, 'parent'):
         root.parent = None
-    for child in ast.iter_child_nodes(root):
-        child.parent = root
-        _set_parent(child)
+    for node in ast.walk(root):
+        for child in ast.iter_child_nodes(node):
+            child.parent = node
     return root
 
 
@@ -91,9 +89,8 @@ def _iter_parent_chain(node, with_self = True):
 def _check_parent_chain(node, checker, mode='any', with_self=False):
     assert callable(checker)
     assert mode in ('any', 'all')
-    pchain = list(_iter_parent_chain(node, with_self=with_self))
-    pchain = [checker(p) for p in pchain]
-    return bool(eval(f'{mode}(pchain)'))
+    pchain = map(checker, _iter_parent_chain(node, with_self=with_self))
+    return any(pchain) if mode == 'any' else all(pchain)
 
 
 def _check_call_member_fn(fn_name: str, node: ast.Call, nargs: int = None, kwargkeys: set = None):
@@ -104,33 +101,119 @@ def _check_call_member_fn(fn_name: str, node: ast.Call, nargs: int = None, kwarg
             (kwargkeys is None or set(kwargkeys) == {e.arg for e in node.keywords})
 
 
-def _find_x(node, is_x, ignore_sub_scope=False) -> list:
-    assert callable(is_x)
-    ck = lambda n: not _check_parent_chain(n,
-                                           checker=lambda p: p != node and isinstance(p, (ast.FunctionDef, ast.ClassDef)),
-                                           mode='any',
-                                           with_self=False) \
-         if ignore_sub_scope else lambda n: True
-    return [n for n in ast.walk(node) if is_x(n) if ck(n)]
+class NodeTable:
+    '''
+    A flat table of the nodes of a tree, row i is the i-th node of ast.walk(root)
+    (so the root is row 0, and rows are sorted by depth), built by one iterative
+    traversal. The columns are NumPy arrays: parent (row, -1 for the root), depth,
+    height (1 for leaves), size (of the subtree), pre (DFS pre-order, the subtree of
+    row i is pre[i] <= pre < pre[i] + size[i]), type_code (see type_mask) and scope
+    (row of the nearest ancestor opening a scope, the root counts as one).
+    Queries over all the nodes (e.g. inside a JoinedStr) are then a few vectorized
+    passes per depth level instead of a parent chain walk per node.
+    '''
+    _type_codes: Dict[type, int] = {}  # Shared by all tables
+    _SCOPE_TYPES = (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)
+
+    def __init__(self, root: ast.AST):
+        self.nodes: List[ast.AST] = [root]
+        parent, depth = [-1], [0]
+        i = 0
+        while i < len(self.nodes):  # Same order as ast.walk
+            for child in ast.iter_child_nodes(self.nodes[i]):
+                self.nodes.append(child)
+                parent.append(i)
+                depth.append(depth[i] + 1)
+            i += 1
+        self.index = {id(n): i for i, n in enumerate(self.nodes)}
+        self.parent = np.array(parent, dtype=np.int32)
+        self.depth = np.array(depth, dtype=np.int32)
+        self.type_code = np.array([self._type_code(type(n)) for n in self.nodes], dtype=np.int16)
+        # Rows of depth d are levels[d]:levels[d + 1]
+        self._levels = np.searchsorted(self.depth, np.arange(self.depth[-1] + 2))
+
+        self.height = np.ones(len(self.nodes), dtype=np.int32)
+        self.size = np.ones(len(self.nodes), dtype=np.int32)
+        for d in range(self.depth[-1], 0, -1):  # Bottom-up
+            rows = slice(self._levels[d], self._levels[d + 1])
+            np.maximum.at(self.height, self.parent[rows], self.height[rows] + 1)
+            np.add.at(self.size, self.parent[rows], self.size[rows])
+
+        self.pre = np.zeros(len(self.nodes), dtype=np.int32)
+        for d in range(1, self.depth[-1] + 1):  # Top-down, siblings are adjacent rows
+            begin, end = self._levels[d], self._levels[d + 1]
+            parent, size = self.parent[begin:end], self.size[begin:end]
+            before = np.cumsum(size) - size  # Sizes of the previous rows of the level
+            first = np.flatnonzero(np.r_[True, parent[1:] != parent[:-1]])  # First child
+            first = np.repeat(first, np.diff(np.r_[first, len(parent)]))
+            self.pre[begin:end] = self.pre[parent] + 1 + before - before[first]
+
+        self.scope = self._propagate(self.type_mask(self._SCOPE_TYPES), rows=True)
+
+    @classmethod
+    def _type_code(cls, t: type) -> int:
+        return cls._type_codes.setdefault(t, len(cls._type_codes))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def columns(self, *names: str):
+        '''(nodes, column, ...) with the columns as lists, e.g. to set attributes'''
+        return (self.nodes, *(getattr(self, n).tolist() for n in names))
+
+    def type_mask(self, classes) -> np.ndarray:
+        '''isinstance(node, classes) of all the nodes'''
+        codes = [c for t, c in self._type_codes.items() if issubclass(t, classes)]
+        return np.isin(self.type_code, codes)
+
+    def _propagate(self, mask: np.ndarray, rows=False) -> np.ndarray:
+        # Top-down: whether (rows=False) / the nearest (rows=True) strict ancestor in mask
+        out = np.full(len(self.nodes), -1 if rows else False, dtype=np.int32 if rows else bool)
+        for d in range(1, self.depth[-1] + 1):
+            begin, end = self._levels[d], self._levels[d + 1]
+            parent = self.parent[begin:end]
+            if rows:
+                out[begin:end] = np.where(mask[parent], parent, out[parent])
+            else:
+                out[begin:end] = mask[parent] | out[parent]
+        return out
+
+    def inside(self, classes) -> np.ndarray:
+        '''Whether a strict ancestor (under the root, the root included) of each node is of classes'''
+        return self._propagate(self.type_mask(classes))
 
+    def rows_of(self, nodes: List[ast.AST]) -> np.ndarray:
+        return np.fromiter((self.index[id(n)] for n in nodes), dtype=np.int64, count=len(nodes))
 
-def _random_sample_n_subtrees(nodes: List[ast.AST], k: int) -> Set[ast.AST]:
-    nodes = nodes.copy()
+    def related(self, row: int, rows: np.ndarray) -> np.ndarray:
+        '''Whether each of rows is row, an ancestor or a descendant of row'''
+        pre, size = self.pre[rows], self.size[rows]
+        return ((self.pre[row] <= pre) & (pre < self.pre[row] + self.size[row])) | \
+               ((pre <= self.pre[row]) & (self.pre[row] < pre + size))
+
+
+def _find_x(node, is_x, ignore_sub_scope=False) -> list:
+    assert callable(is_x)
+    if not ignore_sub_scope:
+        return [n for n in ast.walk(node) if is_x(n)]
+    table = NodeTable(node)
+    opens_sub_scope = table.type_mask((ast.FunctionDef, ast.ClassDef))
+    opens_sub_scope[0] = False  # The scope of node itself
+    in_sub_scope = table._propagate(opens_sub_scope)
+    return [n for n, sub in zip(table.nodes, in_sub_scope.tolist()) if is_x(n) if not sub]
+
+
+def _random_sample_n_subtrees(nodes: List[ast.AST], k: int, table: NodeTable = None) -> Set[ast.AST]:
+    if not nodes:
+        return set()
+    if table is None:
+        table = NodeTable(list(_iter_parent_chain(nodes[0]))[-1])  # Of the whole tree
+    rows = table.rows_of(nodes)
     result = set()
-    while nodes and len(result) < k:
-        n = random.choice(nodes)
-        result.add(n)
-        nodes.remove(n)
-        for parent in _iter_parent_chain(n, with_self=False):
-            try:
-                nodes.remove(parent)
-            except:
-                pass
-        for child in ast.walk(n):
-            try:
-                nodes.remove(child)
-            except:
-                pass
+    while len(rows) and len(result) < k:
+        row = random.choice(rows)  # The same draw as random.choice(nodes)
+        result.add(table.nodes[row])
+        rows = rows[~table.related(row, rows)]  # Not overlapped with the sampled
     return result
 
 
@@ -515,6 +598,36 @@ _keras_possible_layers_api_root = ['__root__.bert4keras.backend.keras.layers',
 #                                          *_keras_possible_layers_api_root] if root.split('.')[-2] == 'keras'}
 _keras_model_compile_infix = '.compile('  #FIXME: More strict checking if needed
 _keras_model_fit_infix = '.fit('  #FIXME: More strict checking if needed
+# hint -> (names of the str constants, api roots of the names/calls), see _get_possible_ast_hint
+_mhint_keras_component_vocab = {
+    _MHINT_K_PADDING: (_keras_padding_names, []),
+    _MHINT_K_INITIALIZER: (_keras_initializer_names, _keras_possible_inits_api_root),
+    _MHINT_K_CONSTRAINT: (_keras_constraint_names, _keras_possible_constraints_api_root),
+    _MHINT_K_ACTIVATION: (_keras_activation_names, _keras_possible_activations_api_root),
+    _MHINT_K_DATAFORMAT: (_keras_dataformat_names, []),
+    _MHINT_K_LOSS: (_keras_loss_names, _keras_possible_losses_api_root),
+    _MHINT_K_OPTIMIZER: (_keras_optimizer_names, _keras_possible_optimizers_api_root),
+    _MHINT_K_METRIC: (_keras_metric_names, _keras_possible_metrics_api_root),
+    _MHINT_K_REGULARIZER: (_keras_regularizer_names, _keras_possible_regularizers_api_root),
+}
+
+
+def _get_mhint_keras_component_vocab(hint: str, remove_root=False) -> Union[Tuple[List[str], List[str]], None]:
+    '''
+    (elements, prefixes): what a mask with the keras component hint can be restored to,
+    an element (e.g. 'relu') or anything starting with a prefix (e.g. keras.activations.).
+    None if the hint has no closed vocabulary (e.g. K_layer).
+    '''
+    if hint not in _mhint_keras_component_vocab:
+        return None
+    names, roots = _mhint_keras_component_vocab[hint]
+    elements = [repr(n) for n in dict.fromkeys(names)]  # ast_unparse(Constant)
+    prefixes = [f'{r}.' for r in roots]
+    if remove_root:  # See IM4DNN_REMOVE_ROOT
+        prefixes = [p.replace('__root__.', '') for p in prefixes]
+    return elements, list(dict.fromkeys(prefixes))
+
+
 def _get_possible_ast_hint(node: ast.AST) -> str:
     # DNN component releated
     if isinstance(node, ast.Constant) and isinstance((val := node.value), str):
@@ -721,6 +834,18 @@ class MaskedPython:
         }
 
 
+class _SplicedMaskedPython(MaskedPython):
+    # Emitted by splicing the mask into the source (see MaskSiteIndex.splice),
+    # the python_wmt_ast is parsed from the string only if someone asks for it
+    def __init__(self, string: str, masked_cfs_ast: List[ast.AST]):
+        self.string = string
+        self.masked_cfs_ast = masked_cfs_ast
+
+    @functools.cached_property
+    def python_wmt_ast(self) -> ast.AST:
+        return _fix_single_ins(ast.parse(self.string))
+
+
 @dataclass
 class MaskTemplate:
     name: str
@@ -865,27 +990,22 @@ def _random_mask_subtree(codeast: ast.AST,
                           ast.stmt,
                           ast.withitem)
 
-    def _is_cannotbe_replaced_ast(node):
-        return _check_parent_chain(node,
-                                   checker=lambda p: isinstance(p, ast.JoinedStr),
-                                   mode='any',
-                                   with_self=False) or \
-              (isinstance(node, ast.Name) and _is_mask_marker(node.id))
-
     if clone_codeast:
         codeast = _set_parent(_set_height(_fix_single_ins(_clone_ast(codeast))))
 
-    max_h = int(max_height_factor * codeast._pg_height)
-    possible_nodes = [node for node in ast.walk(codeast)
-                        if isinstance(node, CANBE_REPLACED_AST) and \
-                            not _is_cannotbe_replaced_ast(node) and \
-                            node._pg_height <= max_h]
+    table = NodeTable(codeast)
+    max_h = int(max_height_factor * table.height[0])
+    canbe_replaced = table.type_mask(CANBE_REPLACED_AST) & \
+                        ~table.inside(ast.JoinedStr) & \
+                        (table.height <= max_h)
+    possible_nodes = [node for node, ok in zip(table.nodes, canbe_replaced.tolist())
+                        if ok and not (isinstance(node, ast.Name) and _is_mask_marker(node.id))]
 
     masked_cfs = None
     if possible_nodes:
         max_s_num = min(int(len(possible_nodes) * max_selected_num_factor), max_selected_num)
         s_num = random.randint(0, max_s_num)
-        nodes = list(_random_sample_n_subtrees(possible_nodes, k=s_num))
+        nodes = list(_random_sample_n_subtrees(possible_nodes, k=s_num, table=table))
         replace_node_map = {}
         masked_cfs = [None] * len(nodes)
         for i, n in enumerate(nodes):
@@ -924,18 +1044,13 @@ def _random_mask_nil(codeast: ast.AST,
             L.insert(i, mk_val())
         return I
 
-    def _is_cannotbe_inserted_ast(node):
-        return _check_parent_chain(node,
-                                   checker=lambda p: isinstance(p, ast.JoinedStr),
-                                   mode='any',
-                                   with_self=False) or \
-              (isinstance(node, ast.Name) and _is_mask_marker(node.id))
-
     possible_inserters = []
-    possible_containers = [node for node in ast.walk(codeast)
+    table = NodeTable(codeast)
+    not_in_joinedstr = (~table.inside(ast.JoinedStr)).tolist()
+    possible_containers = [node for node, ok in zip(table.nodes, not_in_joinedstr)
                                 if _is_block_stmt(node) or isinstance(node, (ast.Call, ast.Tuple, ast.List, ast.Set))
-                                if not _is_cannotbe_inserted_ast(node)]
-    possible_containers = list(_random_sample_n_subtrees(possible_containers, k=len(possible_containers)))
+                                if ok]  # Block stmts, Calls, ... are never mask markers
+    possible_containers = list(_random_sample_n_subtrees(possible_containers, k=len(possible_containers), table=table))
     total_insert_points = 0
     make_mask_stmt = lambda: ast.Expr(ast.Name(id=_make_mask_marker(make_mask_id() + mask_id_start), ctx=ast.Load()))
     make_mask_expr = lambda: ast.Name(id=_make_mask_marker(make_mask_id() + mask_id_start), ctx=ast.Load())
@@ -1002,6 +1117,8 @@ def _reg_mask_template(name: str):
                     clone_codeast: bool = True,
                     **kwargs):
             mask_maker = MaskMaker(mask_id_start)
+            if kwargs.get('site_index') is not None:  # The sites are nodes of its codeast
+                codeast, clone_codeast = kwargs['site_index'].codeast, False
             if clone_codeast:
                 codeast = _fix_single_ins(_clone_ast(codeast))
             return fn(codeast,
@@ -1081,9 +1198,11 @@ def _replace_arg_with_mask(codeast: ast.AST,
                            mask_maker: MaskMaker,
                            is_call: Callable[[ast.Call], bool],
                            cared_arg_indexes: List[int],
-                           cared_arg_keys: List[str]) -> list[MaskedPython]:
-    calls: list[ast.Call] = _find_x(codeast, is_x=is_call)
-    setreset_fns = []
+                           cared_arg_keys: List[str],
+                           sites: List[ast.Call] = None,
+                           splice: Callable[[ast.AST, str], str] = None) -> list[MaskedPython]:
+    calls: list[ast.Call] = _find_x(codeast, is_x=is_call) if sites is None else sites
+    setreset_fns, slot_nodes = [], []
     for c in calls:
         for i, a in enumerate(c.args):
             if i in cared_arg_indexes:
@@ -1093,6 +1212,7 @@ def _replace_arg_with_mask(codeast: ast.AST,
                         return old_val
                     return fn
                 setreset_fns.append(make_fn(c.args, i))
+                slot_nodes.append(a)
         for k in c.keywords:
             if k.arg in cared_arg_keys:
                 def make_fn(keywords, k):
@@ -1101,10 +1221,16 @@ def _replace_arg_with_mask(codeast: ast.AST,
                         return old_val
                     return fn
                 setreset_fns.append(make_fn(c.keywords, k))
+                slot_nodes.append(k.value)
     masked_data: List[MaskedPython] = []
     for slot in range(len(setreset_fns)):
         with mask_maker as mm:
-            with SetResetHelper(setreset_fns, [mm.make_mask_node() if i == slot else None \
+            mask_node = mm.make_mask_node()
+            if splice and (string := splice(slot_nodes[slot], ast_unparse(mask_node))) is not None:
+                masked_data.append(_SplicedMaskedPython(string=string,
+                                                        masked_cfs_ast=[_clone_ast(slot_nodes[slot])]))
+                continue
+            with SetResetHelper(setreset_fns, [mask_node if i == slot else None \
                                                     for i in range(len(setreset_fns))]) as h:
                     masked_data.append(MaskedPython(string=ast_unparse(codeast),
                                                     python_wmt_ast=_clone_ast(codeast),
@@ -1117,9 +1243,11 @@ def _replace_node_with_mask(codeast: ast.AST,
                             mask_maker: MaskMaker,
                             is_node: Callable[[ast.AST], bool],
                             max_generate_num: int = None,
+                            sites: List[ast.AST] = None,
+                            splice: Callable[[ast.AST, str], str] = None,
                             **kwargs) -> list[MaskedPython]:
     codeast = _set_node_id(_set_parent(codeast))
-    nodes: list[ast.AST] = _find_x(codeast, is_x=is_node)
+    nodes: list[ast.AST] = _find_x(codeast, is_x=is_node) if sites is None else sites
     if max_generate_num is not None:
         nodes = random.sample(nodes, min(max_generate_num, len(nodes)))
     masked_data: List[MaskedPython] = []
@@ -1129,6 +1257,10 @@ def _replace_node_with_mask(codeast: ast.AST,
                 mask_node = _make_mask_node(n)(mm.make_mask_node())
             except (NotImplementedError, ValueError):
                 continue # Skip this node
+            if splice and (string := splice(n, ast_unparse(mask_node))) is not None:
+                masked_data.append(_SplicedMaskedPython(string=string,
+                                                        masked_cfs_ast=[_clone_ast(n)]))
+                continue
             mcodeast = ReplaceXWithY(x_cls_names=[n.__class__.__name__],
                                      is_x=lambda x: x._pg_node_id == n._pg_node_id,
                                      make_y=lambda x: mask_node).visit(_set_node_id(_clone_ast(codeast)))
@@ -1169,29 +1301,79 @@ def _replace_keras_component_with_mask(codeast: ast.AST, mask_maker: MaskMaker,
     return masked_data
 
 
+class MaskSiteIndex:
+    '''
+    The sites (candidate nodes) of the T_mask_keras_* templates of a program, found by
+    one parse and one walk instead of a parse (and a clone) and a walk per template.
+    Pass it to the generators as `site_index`, they then work on its codeast.
+    The codeast is parsed from the unparsed program (string), so the spans of its nodes
+    locate them in string, and a masked program is emitted by splicing the mask into
+    string instead of cloning and unparsing the whole tree (see splice).
+    '''
+    _member_fns = ('compile', 'fit', 'Activation')  # See _check_call_member_fn
+    _hints = (_MHINT_K_LAYER, _MHINT_K_OPTIMIZER)  # See _get_possible_ast_hint
+
+    def __init__(self, code: str):
+        self.string = ast_unparse(ast.parse(code))
+        self.codeast = _fix_single_ins(ast.parse(self.string))
+        self._lines = self.string.split('\n')
+        self._line_starts = [0]
+        for line in self._lines:
+            self._line_starts.append(self._line_starts[-1] + len(line) + 1)
+        self.sites: Dict[str, List[ast.Call]] = {k: [] for k in self._member_fns + self._hints}
+        for node in ast.walk(self.codeast):  # Same order as _find_x
+            if not isinstance(node, ast.Call):
+                continue
+            if isinstance(node.func, ast.Attribute) and node.func.attr in self._member_fns:
+                self.sites[node.func.attr].append(node)
+            if (hint := _get_possible_ast_hint(node)) in self._hints:
+                self.sites[hint].append(node)
+
+    def _offset(self, lineno: int, col_offset: int) -> int:
+        line = self._lines[lineno - 1]
+        if not line.isascii():  # col_offset is in utf-8 bytes
+            col_offset = len(line.encode('utf-8')[:col_offset].decode('utf-8'))
+        return self._line_starts[lineno - 1] + col_offset
+
+    def splice(self, node: ast.AST, text: str) -> str:
+        # string with node replaced by text, None if the span of node does not hold
+        # exactly its unparsed source (e.g. the parentheses of a walrus argument)
+        if getattr(node, 'end_lineno', None) is None:
+            return None
+        start = self._offset(node.lineno, node.col_offset)
+        end = self._offset(node.end_lineno, node.end_col_offset)
+        if self.string[start:end] != ast_unparse(node):
+            return None
+        return self.string[:start] + text + self.string[end:]
+
+
 @_reg_mask_template("T_mask_keras_metric_arg")
-def _replace_keras_metric_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, **kwargs) -> list[MaskedPython]:
+def _replace_keras_metric_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, site_index: MaskSiteIndex = None, **kwargs) -> list[MaskedPython]:
     #1. ...compile(...metrics=xxx...), keys=['metrics']
     return _replace_arg_with_mask(codeast,
                                   mask_maker,
                                   is_call=lambda n: _check_call_member_fn('compile', n),
                                   cared_arg_indexes=[],
-                                  cared_arg_keys=['metrics'])
+                                  cared_arg_keys=['metrics'],
+                                  sites=site_index and site_index.sites['compile'],
+                                  splice=site_index and site_index.splice)
 
 
 @_reg_mask_template("T_mask_keras_optimizer_arg")
-def _replace_keras_optimizer_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, **kwargs) -> list[MaskedPython]:
+def _replace_keras_optimizer_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, site_index: MaskSiteIndex = None, **kwargs) -> list[MaskedPython]:
     #1. ...compile(...optimizer=<opt>...), keys=['optimizer']
     #2. ...compile(<opt>, ...), indexes=[0]
     return _replace_arg_with_mask(codeast,
                                   mask_maker,
                                   is_call=lambda n: _check_call_member_fn('compile', n),
                                   cared_arg_indexes=[0],
-                                  cared_arg_keys=['optimizer'])
+                                  cared_arg_keys=['optimizer'],
+                                  sites=site_index and site_index.sites['compile'],
+                                  splice=site_index and site_index.splice)
 
 
 @_reg_mask_template("T_mask_keras_epochs_arg")
-def _replace_keras_epochs_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, **kwargs) -> list[MaskedPython]:
+def _replace_keras_epochs_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, site_index: MaskSiteIndex = None, **kwargs) -> list[MaskedPython]:
     #1. ...fit(...epochs=<epochs>...), keys=['epochs']
     #2. ...fit(...nb_epoch=<epochs>...), keys=['nb_epoch']
     #3. ...fit(<0>, <1>, <2>, <epochs>, ...), indexes=[3]
@@ -1199,39 +1381,47 @@ def _replace_keras_epochs_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker,
                                   mask_maker,
                                   is_call=lambda n: _check_call_member_fn('fit', n),
                                   cared_arg_indexes=[3],
-                                  cared_arg_keys=['epochs', 'nb_epoch'])
+                                  cared_arg_keys=['epochs', 'nb_epoch'],
+                                  sites=site_index and site_index.sites['fit'],
+                                  splice=site_index and site_index.splice)
 
 
 @_reg_mask_template("T_mask_keras_loss_arg")
-def _replace_keras_loss_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, **kwargs) -> list[MaskedPython]:
+def _replace_keras_loss_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, site_index: MaskSiteIndex = None, **kwargs) -> list[MaskedPython]:
     #1. ...compile(...loss=<loss>...), keys=['loss']
     #2. ...compile(<0>, <loss>, ...), indexes=[1]
     return _replace_arg_with_mask(codeast,
                                   mask_maker,
                                   is_call=lambda n: _check_call_member_fn('compile', n),
                                   cared_arg_indexes=[1],
-                                  cared_arg_keys=['loss'])
+                                  cared_arg_keys=['loss'],
+                                  sites=site_index and site_index.sites['compile'],
+                                  splice=site_index and site_index.splice)
 
 
 @_reg_mask_template("T_mask_keras_activation_arg")
-def _replace_keras_activation_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, **kwargs) -> list[MaskedPython]:
+def _replace_keras_activation_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, site_index: MaskSiteIndex = None, **kwargs) -> list[MaskedPython]:
     #1. ...<Layer>(...activation=<activation>...), keys=['activation']
     #2. ...Activation(<activation>), keys=['activation'], indexes=[0]
     in_Layer = _replace_arg_with_mask(codeast,
                                       mask_maker,
                                       is_call=lambda n: isinstance(n, ast.Call) and _get_possible_ast_hint(n) == _MHINT_K_LAYER,
                                       cared_arg_indexes=[],
-                                      cared_arg_keys=['activation'])
+                                      cared_arg_keys=['activation'],
+                                      sites=site_index and site_index.sites[_MHINT_K_LAYER],
+                                      splice=site_index and site_index.splice)
     in_Activation = _replace_arg_with_mask(codeast,
                                            mask_maker,
                                            is_call=lambda n: _check_call_member_fn('Activation', n),
                                            cared_arg_indexes=[0],
-                                           cared_arg_keys=['activation'])
+                                           cared_arg_keys=['activation'],
+                                           sites=site_index and site_index.sites['Activation'],
+                                           splice=site_index and site_index.splice)
     return in_Layer + in_Activation
 
 
 @_reg_mask_template("T_mask_keras_initializer_arg")
-def _replace_keras_initializer_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, **kwargs) -> list[MaskedPython]:
+def _replace_keras_initializer_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, site_index: MaskSiteIndex = None, **kwargs) -> list[MaskedPython]:
     #1. ...<Layer>(...kernel_initializer=<initializer>...), keys=['kernel_initializer']
     #2. ...<Layer>(...bias_initializer=<initializer>...), keys=['bias_initializer']
     #3. ...<Layer>(...init=<initializer>...), keys=['init']
@@ -1239,20 +1429,24 @@ def _replace_keras_initializer_arg_with_mask(codeast: ast.AST, mask_maker: MaskM
                                   mask_maker,
                                   is_call=lambda n: isinstance(n, ast.Call) and _get_possible_ast_hint(n) == _MHINT_K_LAYER,
                                   cared_arg_indexes=[],
-                                  cared_arg_keys=['kernel_initializer', 'bias_initializer', 'init'])
+                                  cared_arg_keys=['kernel_initializer', 'bias_initializer', 'init'],
+                                  sites=site_index and site_index.sites[_MHINT_K_LAYER],
+                                  splice=site_index and site_index.splice)
 
 
 @_reg_mask_template("T_mask_keras_Layer")
-def _replace_keras_layer_with_mask(codeast: ast.AST, mask_maker: MaskMaker, **kwargs) -> list[MaskedPython]:
+def _replace_keras_layer_with_mask(codeast: ast.AST, mask_maker: MaskMaker, site_index: MaskSiteIndex = None, **kwargs) -> list[MaskedPython]:
     #1. ...<Layer>(...)
     return _replace_node_with_mask(codeast,
                                    mask_maker,
                                    is_node=lambda n: isinstance(n, ast.Call) and _get_possible_ast_hint(n) == _MHINT_K_LAYER,
+                                   sites=site_index and site_index.sites[_MHINT_K_LAYER],
+                                   splice=site_index and site_index.splice,
                                    **kwargs)
 
 
 @_reg_mask_template("T_mask_keras_learning_rate_arg")
-def _replace_learning_rate_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, **kwargs) -> list[MaskedPython]:
+def _replace_learning_rate_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, site_index: MaskSiteIndex = None, **kwargs) -> list[MaskedPython]:
     #1. ...<Optimizer>(...learning_rate=<lr>...), keys=['learning_rate']
     #2. ...<Optimizer>(...lr=<lr>...), keys=['lr']
     #3. ...<Optimizer>(<lr>), indexes=[0]
@@ -1260,18 +1454,22 @@ def _replace_learning_rate_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker
                                   mask_maker,
                                   is_call=lambda n: isinstance(n, ast.Call) and _get_possible_ast_hint(n) == _MHINT_K_OPTIMIZER,
                                   cared_arg_indexes=[0],
-                                  cared_arg_keys=['learning_rate', 'lr'])
+                                  cared_arg_keys=['learning_rate', 'lr'],
+                                  sites=site_index and site_index.sites[_MHINT_K_OPTIMIZER],
+                                  splice=site_index and site_index.splice)
 
 
 @_reg_mask_template("T_mask_keras_batch_size_arg")
-def _replace_batch_size_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, **kwargs) -> list[MaskedPython]:
+def _replace_batch_size_arg_with_mask(codeast: ast.AST, mask_maker: MaskMaker, site_index: MaskSiteIndex = None, **kwargs) -> list[MaskedPython]:
     #1. ...fit(...batch_size=<batch_size>...), keys=['batch_size']
     #3. ...fit(<0>, <1>, <batch_size>, ...), indexes=[2]
     return _replace_arg_with_mask(codeast,
                                   mask_maker,
                                   is_call=lambda n: _check_call_member_fn('fit', n),
                                   cared_arg_indexes=[2],
-                                  cared_arg_keys=['batch_size'])
+                                  cared_arg_keys=['batch_size'],
+                                  sites=site_index and site_index.sites['fit'],
+                                  splice=site_index and site_index.splice)
 
 
 ## args of keras.Model.compile
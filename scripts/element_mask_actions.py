@@ -6,8 +6,9 @@ from abc import abstractmethod
 class MaskAction:
     @abstractmethod
     def generate_masked_models(
-        self, code: str
+        self, code: str, site_index: du.MaskSiteIndex = None
     ) -> list[str, str]:  # (code with mask, mask ori)
+        # site_index: du.MaskSiteIndex(code), to share one parse and walk by all actions
         raise NotImplementedError("To be implemented")
 
 
@@ -16,16 +17,18 @@ class MaskAction:
 
 # _MT_mask_keras_metric_arg = _mask_t('T_mask_keras_metric_arg')
 class MetricMaskAction(MaskAction):
-    def generate_masked_models(self, code: str) -> list[str, str]:
+    def generate_masked_models(
+        self, code: str, site_index: du.MaskSiteIndex = None
+    ) -> list[str, str]:
         result = []
-        codeast = ast.parse(code)
+        site_index = site_index or du.MaskSiteIndex(code)
         # L1 Template
-        result.extend(du._MT_mask_keras_metric_arg.generator(codeast))
+        result.extend(du._MT_mask_keras_metric_arg.generator(site_index.codeast, site_index=site_index))
         # L... Ablation[2]
         return list(
             map(
                 lambda x: (
-                    ast.unparse(x.python_wmt_ast),
+                    x.string,
                     ast.unparse(x.masked_cfs_ast[0]),
                 ),
                 result,
@@ -35,16 +38,18 @@ class MetricMaskAction(MaskAction):
 
 # _MT_mask_keras_learning_rate_arg = _mask_t('T_mask_keras_learning_rate_arg')
 class LearningRateMaskAction(MaskAction):
-    def generate_masked_models(self, code: str) -> list[str, str]:
+    def generate_masked_models(
+        self, code: str, site_index: du.MaskSiteIndex = None
+    ) -> list[str, str]:
         result = []
-        codeast = ast.parse(code)
+        site_index = site_index or du.MaskSiteIndex(code)
         # L1 Template
-        result.extend(du._MT_mask_keras_learning_rate_arg.generator(codeast))
+        result.extend(du._MT_mask_keras_learning_rate_arg.generator(site_index.codeast, site_index=site_index))
         # L... ('adam' -> __root__.keras.optimizers.Adam(<mask>)) Ablation[2]
         return list(
             map(
                 lambda x: (
-                    ast.unparse(x.python_wmt_ast),
+                    x.string,
                     ast.unparse(x.masked_cfs_ast[0]),
                 ),
                 result,
@@ -54,16 +59,18 @@ class LearningRateMaskAction(MaskAction):
 
 # _MT_mask_keras_optimizer_arg = _mask_t('T_mask_keras_optimizer_arg')
 class OptimizerMaskAction(MaskAction):
-    def generate_masked_models(self, code: str) -> list[str, str]:
+    def generate_masked_models(
+        self, code: str, site_index: du.MaskSiteIndex = None
+    ) -> list[str, str]:
         result = []
-        codeast = ast.parse(code)
+        site_index = site_index or du.MaskSiteIndex(code)
         # L1 Template
-        result.extend(du._MT_mask_keras_optimizer_arg.generator(codeast))
+        result.extend(du._MT_mask_keras_optimizer_arg.generator(site_index.codeast, site_index=site_index))
         # L... ('<mask>', __root__.keras.<mask>) Ablation[2]
         return list(
             map(
                 lambda x: (
-                    ast.unparse(x.python_wmt_ast),
+                    x.string,
                     ast.unparse(x.masked_cfs_ast[0]),
                 ),
                 result,
@@ -73,16 +80,18 @@ class OptimizerMaskAction(MaskAction):
 
 # _MT_mask_keras_loss_arg = _mask_t('T_mask_keras_loss_arg')
 class LossMaskAction(MaskAction):
-    def generate_masked_models(self, code: str) -> list[str, str]:
+    def generate_masked_models(
+        self, code: str, site_index: du.MaskSiteIndex = None
+    ) -> list[str, str]:
         result = []
-        codeast = ast.parse(code)
+        site_index = site_index or du.MaskSiteIndex(code)
         # L1 Template
-        result.extend(du._MT_mask_keras_loss_arg.generator(codeast))
+        result.extend(du._MT_mask_keras_loss_arg.generator(site_index.codeast, site_index=site_index))
         # L... ('<mask>', __root__.keras.<mask>) Ablation[2]
         return list(
             map(
                 lambda x: (
-                    ast.unparse(x.python_wmt_ast),
+                    x.string,
                     ast.unparse(x.masked_cfs_ast[0]),
                 ),
                 result,
@@ -95,16 +104,18 @@ class LossMaskAction(MaskAction):
 
 # _MT_mask_keras_epochs_arg = _mask_t('T_mask_keras_epochs_arg')
 class EpochsMaskAction(MaskAction):
-    def generate_masked_models(self, code: str) -> list[str, str]:
+    def generate_masked_models(
+        self, code: str, site_index: du.MaskSiteIndex = None
+    ) -> list[str, str]:
         result = []
-        codeast = ast.parse(code)
+        site_index = site_index or du.MaskSiteIndex(code)
         # L1 Template
-        result.extend(du._MT_mask_keras_epochs_arg.generator(codeast))
+        result.extend(du._MT_mask_keras_epochs_arg.generator(site_index.codeast, site_index=site_index))
         # L...
         return list(
             map(
                 lambda x: (
-                    ast.unparse(x.python_wmt_ast),
+                    x.string,
                     ast.unparse(x.masked_cfs_ast[0]),
                 ),
                 result,
@@ -114,16 +125,18 @@ class EpochsMaskAction(MaskAction):
 
 # _MT_mask_keras_batch_size_arg = _mask_t('T_mask_keras_batch_size_arg')
 class BatchSizeMaskAction(MaskAction):
-    def generate_masked_models(self, code: str) -> list[str, str]:
+    def generate_masked_models(
+        self, code: str, site_index: du.MaskSiteIndex = None
+    ) -> list[str, str]:
         result = []
-        codeast = ast.parse(code)
+        site_index = site_index or du.MaskSiteIndex(code)
         # L1 Template
-        result.extend(du._MT_mask_keras_batch_size_arg.generator(codeast))
+        result.extend(du._MT_mask_keras_batch_size_arg.generator(site_index.codeast, site_index=site_index))
         # L...
         return list(
             map(
                 lambda x: (
-                    ast.unparse(x.python_wmt_ast),
+                    x.string,
                     ast.unparse(x.masked_cfs_ast[0]),
                 ),
                 result,
@@ -134,16 +147,18 @@ class BatchSizeMaskAction(MaskAction):
 ##################### keras.layers.Layer / args of keras.layers.Layer #####################
 # _MT_mask_keras_Layer = _mask_t('T_mask_keras_Layer')
 class LayerMaskAction(MaskAction):
-    def generate_masked_models(self, code: str) -> list[str, str]:
+    def generate_masked_models(
+        self, code: str, site_index: du.MaskSiteIndex = None
+    ) -> list[str, str]:
         result = []
-        codeast = ast.parse(code)
+        site_index = site_index or du.MaskSiteIndex(code)
         # L1 Template
-        result.extend(du._MT_mask_keras_Layer.generator(codeast))
+        result.extend(du._MT_mask_keras_Layer.generator(site_index.codeast, site_index=site_index))
         # L... (...Layer(xxx,yyy) -> ...Layer(<mask0>)) Ablation[2]
         return list(
             map(
                 lambda x: (
-                    ast.unparse(x.python_wmt_ast),
+                    x.string,
                     ast.unparse(x.masked_cfs_ast[0]),
                 ),
                 result,
@@ -153,16 +168,18 @@ class LayerMaskAction(MaskAction):
 
 # _MT_mask_keras_activation_arg = _mask_t('T_mask_keras_activation_arg')
 class ActivationMaskAction(MaskAction):
-    def generate_masked_models(self, code: str) -> list[str, str]:
+    def generate_masked_models(
+        self, code: str, site_index: du.MaskSiteIndex = None
+    ) -> list[str, str]:
         result = []
-        codeast = ast.parse(code)
+        site_index = site_index or du.MaskSiteIndex(code)
         # L1 Template
-        result.extend(du._MT_mask_keras_activation_arg.generator(codeast))
+        result.extend(du._MT_mask_keras_activation_arg.generator(site_index.codeast, site_index=site_index))
         # L... ('<mask>', __root__.keras.activations.<mask>) Ablation[2]
         return list(
             map(
                 lambda x: (
-                    ast.unparse(x.python_wmt_ast),
+                    x.string,
                     ast.unparse(x.masked_cfs_ast[0]),
                 ),
                 result,
@@ -172,16 +189,18 @@ class ActivationMaskAction(MaskAction):
 
 # _MT_mask_keras_initializer_arg = _mask_t('T_mask_keras_initializer_arg')
 class InitializerMaskAction(MaskAction):
-    def generate_masked_models(self, code: str) -> list[str, str]:
+    def generate_masked_models(
+        self, code: str, site_index: du.MaskSiteIndex = None
+    ) -> list[str, str]:
         result = []
-        codeast = ast.parse(code)
+        site_index = site_index or du.MaskSiteIndex(code)
         # L1 Template
-        result.extend(du._MT_mask_keras_initializer_arg.generator(codeast))
+        result.extend(du._MT_mask_keras_initializer_arg.generator(site_index.codeast, site_index=site_index))
         # L... ('<mask>', __root__.keras.initializers.<mask>) Ablation[2]
         return list(
             map(
                 lambda x: (
-                    ast.unparse(x.python_wmt_ast),
+                    x.string,
                     ast.unparse(x.masked_cfs_ast[0]),
                 ),
                 result,
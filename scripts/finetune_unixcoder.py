@@ -21,23 +21,35 @@ using a masked language modeling (MLM) loss.
 
 from __future__ import absolute_import
 
+import io
 import os
+import re
+import glob
 import time
 import torch
+import datetime
+import functools
+import contextlib
+import fileinput
 import json
+import hashlib
 import random
 import argparse
 import numpy as np
 import finetune_unixcoder.bleu as bleu
 import _rs_utils as pgrsu
+import data_utils as du
 
 from io import open
-from finetune_unixcoder.model import Seq2Seq
+from finetune_unixcoder.model import NgramDrafter, Seq2Seq, TokenTrie
 from torch.utils.data import (
     DataLoader,
+    Dataset,
+    DistributedSampler,
+    IterableDataset,
+    Sampler,
     SequentialSampler,
     RandomSampler,
-    TensorDataset,
 )
 from torch.optim import AdamW
 from transformers import (
@@ -45,13 +57,21 @@ from transformers import (
     RobertaConfig,
     RobertaModel,
     RobertaTokenizer,
+    RobertaTokenizerFast,
     AutoModel,
 )
 
+try:
+    import zstandard  # Only for the *.zst datasets
+except ImportError:
+    zstandard = None
+
 
 class Example(object):
     """A single training/test example."""
 
+    __slots__ = ("idx", "source", "target")
+
     def __init__(
         self,
         idx,
@@ -63,6 +83,61 @@ class Example(object):
         self.target = target
 
 
+def _list_shards(filename):
+    """The shards (*.jsonl, *.jsonl.zst) of a dataset directory, or [filename]"""
+    if not os.path.isdir(filename):
+        return [filename]
+    shards = sorted(
+        glob.glob(os.path.join(filename, "*.jsonl"))
+        + glob.glob(os.path.join(filename, "*.jsonl.zst"))
+    )
+    if not shards:
+        raise FileNotFoundError(f"No *.jsonl or *.jsonl.zst shards in {filename}")
+    return shards
+
+
+def _open_text(filename):
+    """
+    Open a (optionally zstd-compressed, *.zst) text file for streaming reads, a
+    directory (e.g. made by build_mlm_dataset.py) is read as its shards in order
+    """
+    if os.path.isdir(filename):
+        return fileinput.FileInput(  # Not fileinput.input, which is global
+            _list_shards(filename), openhook=lambda f, mode: _open_text(f)
+        )
+    if not filename.endswith(".zst"):
+        return open(filename, encoding="utf-8")
+    if zstandard is None:
+        raise ImportError(f"zstandard is required to read {filename}")
+    fp = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"))
+    return io.TextIOWrapper(fp, encoding="utf-8")
+
+
+def _parse_example(idx, line, rm_fn_head=False):
+    js = json.loads(line.strip())
+    src = js[
+        "python_wmt_string"
+    ]  # don't " ".join(js["python_wmt_string"].split()): python code has spaces
+    tgt = js[
+        "masked_cfs_string"
+    ]  # don't " ".join(js["masked_cfs_string"].split()): python code has spaces
+
+    if rm_fn_head:
+        import ast
+
+        srcast: ast.Module = ast.parse(src)
+        assert len(srcast.body) == 1 and isinstance(srcast.body[0], ast.FunctionDef)
+        assert isinstance(srcast.body[0].body[-1], ast.Return)
+        srcast.body = srcast.body[0].body[:-1]  # remove return
+        src = ast.unparse(ast.fix_missing_locations(srcast))
+
+    return Example(
+        idx=idx,
+        source=src,
+        target=tgt,
+    )
+
+
 @pgrsu._log_fn_call(ret=False)
 def read_examples(filename):
     """Read examples from filename."""
@@ -71,39 +146,19 @@ def read_examples(filename):
         pgrsu._ilog("!!!!!RM_FN_HEAD is enabled!!!!!")
 
     examples = []
-    with open(filename, encoding="utf-8") as f:
+    with _open_text(filename) as f:
         for idx, line in enumerate(pgrsu._tqdm(f)):
-            js = json.loads(line.strip())
-            src = js[
-                "python_wmt_string"
-            ]  # don't " ".join(js["python_wmt_string"].split()): python code has spaces
-            tgt = js[
-                "masked_cfs_string"
-            ]  # don't " ".join(js["masked_cfs_string"].split()): python code has spaces
-
-            if RM_FN_HEAD:
-                import ast
-
-                srcast: ast.Module = ast.parse(src)
-                assert len(srcast.body) == 1 and isinstance(
-                    srcast.body[0], ast.FunctionDef
-                )
-                assert isinstance(srcast.body[0].body[-1], ast.Return)
-                srcast.body = srcast.body[0].body[:-1]  # remove return
-                src = ast.unparse(ast.fix_missing_locations(srcast))
-
-            examples.append(
-                Example(
-                    idx=idx,
-                    source=src,
-                    target=tgt,
-                )
-            )
+            examples.append(_parse_example(idx, line, RM_FN_HEAD))
     return examples
 
 
 class InputFeatures(object):
-    """A single training/test features for a example."""
+    """
+    A single training/test features for a example, the ids are (read-only) row
+    views of the arrays made by convert_examples_to_arrays.
+    """
+
+    __slots__ = ("example_id", "source_ids", "target_ids")
 
     def __init__(
         self,
@@ -116,94 +171,604 @@ class InputFeatures(object):
         self.target_ids = target_ids
 
 
+def _remove_root(example):
+    example.source = example.source.replace("__root__.", "")
+    example.target = example.target.replace("__root__.", "")
+
+
+def _tokenize_to_ids(tokenizer, texts):
+    """Token ids of each text, without special tokens"""
+    if getattr(tokenizer, "is_fast", False):  # Batched in Rust
+        return tokenizer(texts, add_special_tokens=False)["input_ids"]
+    return [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(t)) for t in texts]
+
+
+_worker_tokenizer = None  # Set by _init_tokenize_worker in the worker processes
+
+
+def _tokenize_shard_to_ids(shard):
+    return _tokenize_to_ids(_worker_tokenizer, shard)
+
+
+def _init_tokenize_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+_checked_fast_tokenizers = {}  # id(fast tokenizer) => same ids as the slow one
+
+
+def _get_fast_tokenizer(tokenizer, args, texts):
+    """
+    The fast tokenizer (args.fast_tokenizer) if it makes the same ids as the slow
+    one on a sample of texts, None otherwise
+    """
+    fast_tokenizer = getattr(args, "fast_tokenizer", None)
+    if fast_tokenizer is None or tokenizer is fast_tokenizer:
+        return fast_tokenizer
+    if id(fast_tokenizer) not in _checked_fast_tokenizers:
+        sample = [t for t in texts[:64] if t] + ["None", ""]
+        same_ids = _tokenize_to_ids(tokenizer, sample) == _tokenize_to_ids(
+            fast_tokenizer, sample
+        )
+        if not same_ids:
+            pgrsu._wlog("Fast tokenizer makes different ids, use the slow one")
+        _checked_fast_tokenizers[id(fast_tokenizer)] = same_ids
+    return fast_tokenizer if _checked_fast_tokenizers[id(fast_tokenizer)] else None
+
+
+def _batch_tokenize_to_ids(tokenizer, args, texts, shard_size=4096, logging=True):
+    """
+    Token ids of each text, in shards by the fast tokenizer (if it makes the same
+    ids) or by processes (args.tokenize_num_workers) with the slow tokenizer
+    """
+    fast_tokenizer = _get_fast_tokenizer(tokenizer, args, texts)
+    shards = [texts[i : i + shard_size] for i in range(0, len(texts), shard_size)]
+    num_workers = getattr(args, "tokenize_num_workers", 1)
+    ids = []
+    if fast_tokenizer is None and num_workers > 1 and len(shards) > 1:
+        import multiprocessing
+
+        with multiprocessing.Pool(
+            num_workers, initializer=_init_tokenize_worker, initargs=(tokenizer,)
+        ) as pool:
+            for shard_ids in pool.imap(_tokenize_shard_to_ids, shards):
+                ids.extend(shard_ids)
+                pgrsu._schedule_touch_gpu(10 * 60)  # 10 minutes
+        return ids
+    for shard in pgrsu._tqdm(shards) if logging else shards:
+        ids.extend(_tokenize_to_ids(fast_tokenizer or tokenizer, shard))
+        pgrsu._schedule_touch_gpu(10 * 60)  # 10 minutes
+    return ids
+
+
+def _get_ids_dtype(tokenizer):
+    """The smallest dtype (torch.from_numpy-able) holding all token ids"""
+    return np.int16 if len(tokenizer) <= np.iinfo(np.int16).max + 1 else np.int32
+
+
 @pgrsu._log_fn_call(ret=False)
-def convert_examples_to_features(examples, tokenizer, args, stage=None):
-    """convert examples to token ids"""
+def convert_examples_to_arrays(examples, tokenizer, args, stage=None):
+    """convert examples to token ids: (source_ids, target_ids) padded int arrays"""
+    return _convert_examples_to_arrays(examples, tokenizer, args, stage)
+
+
+def _convert_examples_to_arrays(examples, tokenizer, args, stage=None, logging=True):
     REMOVE_ROOT = bool(eval(os.getenv("IM4DNN_REMOVE_ROOT", "0")))
-    if REMOVE_ROOT:
+    if REMOVE_ROOT and logging:
         pgrsu._ilog("!!!!!REMOVE_ROOT is enabled!!!!!")
-    features = []
-    for example_index, example in enumerate(pgrsu._tqdm(examples)):
-        # source
-        ## toknize && get the context (args.max_source_length - 4 tokens) around the mask
-        assert args.max_source_length >= 4, "max_source_length must be larger than 4"
-        ### Split source by __mask_0__ -> Tokenize one by one -> Join with <mask0>
+    # source
+    ## toknize && get the context (args.max_source_length - 4 tokens) around the mask
+    assert args.max_source_length >= 4, "max_source_length must be larger than 4"
+    ### Split source by __mask_0__ -> Tokenize one by one -> Join with <mask0>
+    source_s_0, source_s_1 = [], []
+    for example in examples:
         if REMOVE_ROOT:
-            example.source = example.source.replace("__root__.", "")
-            example.target = example.target.replace("__root__.", "")
+            _remove_root(example)
         source_s = example.source.split("__mask_0__")
         if len(source_s) == 1:
             source_s.append("")
         assert len(source_s) == 2
-        source_tokens_0 = tokenizer.tokenize(source_s[0])
-        source_tokens_1 = tokenizer.tokenize(source_s[1])
-        ### truncate (left_context, right_context) around the mask
-        left_context, right_context = 0.5, 0.5
-        max_source_length = (
-            args.max_source_length - 5  # -5: cls, ec-dc, sep, sep, <mask0>
-        )
-        left_length = int(left_context * max_source_length)
-        right_length = int(right_context * max_source_length)
-        source_tokens = (
-            source_tokens_0[-left_length:]
-            + ["<mask0>"]
-            + source_tokens_1[:right_length]
+        source_s_0.append(source_s[0])
+        source_s_1.append(source_s[1])
+    source_ids_0 = _batch_tokenize_to_ids(
+        tokenizer, args, source_s_0, logging=logging
+    )
+    source_ids_1 = _batch_tokenize_to_ids(
+        tokenizer, args, source_s_1, logging=logging
+    )
+    del source_s_0, source_s_1
+    ### truncate (left_context, right_context) around the mask
+    left_context, right_context = 0.5, 0.5
+    max_source_length = args.max_source_length - 5  # -5: cls, ec-dc, sep, sep, <mask0>
+    left_length = int(left_context * max_source_length)
+    right_length = int(right_context * max_source_length)
+    mask0_id, ec_dc_id = tokenizer.convert_tokens_to_ids(["<mask0>", "<encoder-decoder>"])
+    cls_id, sep_id = tokenizer.cls_token_id, tokenizer.sep_token_id
+    ## add special tokens && padding
+    ids_dtype = _get_ids_dtype(tokenizer)
+    source_ids = np.full(
+        (len(examples), args.max_source_length), tokenizer.pad_token_id, dtype=ids_dtype
+    )
+    for i, (ids_0, ids_1) in enumerate(zip(source_ids_0, source_ids_1)):
+        ids_0, ids_1 = ids_0[-left_length:], ids_1[:right_length]
+        assert len(ids_0) + 1 + len(ids_1) <= max_source_length
+        n_0, n_1 = 3 + len(ids_0), 4 + len(ids_0) + len(ids_1)
+        source_ids[i, :3] = (cls_id, ec_dc_id, sep_id)
+        source_ids[i, 3:n_0] = ids_0
+        source_ids[i, n_0] = mask0_id
+        source_ids[i, n_0 + 1 : n_1] = ids_1
+        source_ids[i, n_1] = sep_id
+
+    # target
+    if stage == "test":
+        target_ids_s = _tokenize_to_ids(tokenizer, ["None"]) * len(examples)
+    else:
+        target_ids_s = _batch_tokenize_to_ids(
+            tokenizer, args, [example.target for example in examples], logging=logging
         )
-        assert len(source_tokens) <= max_source_length
-        ## check if <mask0> in source_tokens
-        assert "<mask0>" in source_tokens
-        ## add special tokens
-        source_tokens = (
-            [tokenizer.cls_token, "<encoder-decoder>", tokenizer.sep_token]
-            + source_tokens
-            + [tokenizer.sep_token]
+    target_ids = np.full(
+        (len(examples), args.max_target_length), tokenizer.pad_token_id, dtype=ids_dtype
+    )
+    for i, ids in enumerate(target_ids_s):
+        ids = ids[: args.max_target_length - 2]  # -2: cls, sep
+        target_ids[i, 0] = mask0_id
+        target_ids[i, 1 : 1 + len(ids)] = ids
+        target_ids[i, 1 + len(ids)] = sep_id
+
+    return source_ids, target_ids
+
+
+@pgrsu._log_fn_call(ret=False)
+def convert_examples_to_features(examples, tokenizer, args, stage=None):
+    """convert examples to token ids"""
+    source_ids, target_ids = convert_examples_to_arrays(
+        examples, tokenizer, args, stage=stage
+    )
+    source_ids.flags.writeable = target_ids.flags.writeable = False
+    return [
+        InputFeatures(i, source_ids[i], target_ids[i]) for i in range(len(examples))
+    ]
+
+
+_FEATURES_CACHE_VERSION = 2  # 2: int16 ids for small vocabularies
+
+
+def _get_features_cache_prefix(filename, tokenizer, args, stage=None):
+    """
+    Prefix of the cache files of the features of filename, None if disabled.
+    The key covers the file, the tokenizer and every option changing the ids.
+    """
+    if args.disable_features_cache:
+        return None
+    cache_dir = args.features_cache_dir or os.path.join(
+        args.output_dir, "features_cache"
+    )
+    file_stats = [os.stat(f) for f in _list_shards(filename)]
+    key = json.dumps(
+        {
+            "version": _FEATURES_CACHE_VERSION,
+            "filename": os.path.abspath(filename),
+            "file_size": sum(st.st_size for st in file_stats),
+            "file_mtime": max(st.st_mtime_ns for st in file_stats),
+            "tokenizer": [
+                type(tokenizer).__name__,
+                tokenizer.name_or_path,
+                len(tokenizer),
+            ],
+            "max_source_length": args.max_source_length,
+            "max_target_length": args.max_target_length,
+            "stage": "test" if stage == "test" else "train",  # Only test differs
+            "IM4DNN_REMOVE_ROOT": bool(eval(os.getenv("IM4DNN_REMOVE_ROOT", "0"))),
+            "IM4DNN_RM_FN_HEAD": bool(eval(os.getenv("IM4DNN_RM_FN_HEAD", "0"))),
+        },
+        sort_keys=True,
+    )
+    key = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(os.path.normpath(filename)))[0]
+    return os.path.join(cache_dir, f"{name}-{key}")
+
+
+@pgrsu._log_fn_call(ret=False)
+def load_features(filename, tokenizer, args, stage=None, examples=None):
+    """
+    Load (source_ids, target_ids) of the examples in filename, memory-mapped from
+    the .npy cache built by the first call. The given examples (read from filename)
+    are modified in place as convert_examples_to_features does.
+    """
+    cache_prefix = _get_features_cache_prefix(filename, tokenizer, args, stage)
+    if cache_prefix is not None:
+        source_ids_npy = f"{cache_prefix}.source_ids.npy"
+        target_ids_npy = f"{cache_prefix}.target_ids.npy"
+        if os.path.isfile(source_ids_npy) and os.path.isfile(target_ids_npy):
+            pgrsu._ilog(f"Load cached features: {cache_prefix}")
+            if examples is not None and bool(eval(os.getenv("IM4DNN_REMOVE_ROOT", "0"))):
+                for example in examples:
+                    _remove_root(example)
+            return (
+                np.load(source_ids_npy, mmap_mode="r"),
+                np.load(target_ids_npy, mmap_mode="r"),
+            )
+
+    if examples is None:
+        examples = read_examples(filename)
+    source_ids, target_ids = convert_examples_to_arrays(
+        examples, tokenizer, args, stage=stage
+    )
+    if cache_prefix is None:
+        return source_ids, target_ids
+
+    os.makedirs(os.path.dirname(cache_prefix), exist_ok=True)
+    for npy, ids in ((source_ids_npy, source_ids), (target_ids_npy, target_ids)):
+        tmp_npy = f"{npy}.{os.getpid()}.tmp.npy"
+        np.save(tmp_npy, ids)
+        os.replace(tmp_npy, npy)  # Atomic, other jobs never see a partial file
+    pgrsu._ilog(f"Saved cached features: {cache_prefix}")
+    return (
+        np.load(source_ids_npy, mmap_mode="r"),
+        np.load(target_ids_npy, mmap_mode="r"),
+    )
+
+
+class NpyFeaturesDataset(Dataset):
+    """Dataset over (memory-mapped) token id arrays, rows are read on demand"""
+
+    def __init__(self, *arrays):
+        assert arrays and all(len(a) == len(arrays[0]) for a in arrays)
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays[0])
+
+    def __getitem__(self, index):
+        return tuple(torch.from_numpy(a[index].astype(np.int64)) for a in self.arrays)
+
+    def __getitems__(self, indexes):
+        """
+        A whole batch by one gather per array (instead of a copy per row), the
+        tensors share the memory of the gathered arrays
+        """
+        indexes = np.asarray(indexes)
+        return tuple(torch.from_numpy(a[indexes].astype(np.int64)) for a in self.arrays)
+
+
+class StreamingFeaturesDataset(IterableDataset):
+    """
+    Stream examples from a (optionally zstd-compressed) jsonl file and convert them
+    to token ids on the fly (in DataLoader workers), memory stays flat regardless of
+    the file size:
+      * Sharded by line: rank (num_replicas) first, then DataLoader worker
+      * Shuffled within a buffer of `shuffle_buffer_size` lines (0 to disable)
+      * Each rank yields the same number (`len(self)`) of examples for DDP
+    """
+
+    def __init__(
+        self,
+        filename,
+        tokenizer,
+        args,
+        stage=None,
+        shuffle_buffer_size=10000,
+        chunk_size=256,
+        num_replicas=1,
+        rank=0,
+        seed=0,
+    ):
+        self.filename = filename
+        self.tokenizer = tokenizer
+        self.args = args
+        self.stage = stage
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.chunk_size = chunk_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self._num_lines = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self._num_lines is None:  # One streaming pass, then cached
+            with _open_text(self.filename) as f:
+                self._num_lines = sum(1 for _ in f)
+        return self._num_lines // self.num_replicas
+
+    def _iter_shard_lines(self, worker_id, num_workers):
+        num_examples = len(self)  # Drop the tail so that all ranks are equal
+        with _open_text(self.filename) as f:
+            for idx, line in enumerate(f):
+                local_idx, rank = divmod(idx, self.num_replicas)
+                if local_idx >= num_examples:
+                    break
+                if rank == self.rank and local_idx % num_workers == worker_id:
+                    yield idx, line
+
+    def _shuffle(self, items, rng):
+        if self.shuffle_buffer_size <= 0:
+            yield from items
+            return
+        buffer = []
+        for item in items:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(item)
+                continue
+            i = rng.randint(len(buffer))
+            yield buffer[i]
+            buffer[i] = item
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _to_features(self, lines):
+        rm_fn_head = bool(eval(os.getenv("IM4DNN_RM_FN_HEAD", "0")))
+        examples = [_parse_example(idx, line, rm_fn_head) for idx, line in lines]
+        arrays = _convert_examples_to_arrays(
+            examples, self.tokenizer, self.args, self.stage, logging=False
         )
-        ## convert tokens to ids
-        source_ids = tokenizer.convert_tokens_to_ids(source_tokens)
-        ## padding
-        padding_length = args.max_source_length - len(source_ids)
-        source_ids += [tokenizer.pad_token_id] * padding_length
-
-        # target
-        if stage == "test":
-            target_tokens = tokenizer.tokenize("None")
-        else:
-            target_tokens = tokenizer.tokenize(example.target)[
-                : args.max_target_length - 2  # -2: cls, sep
-            ]
-        target_tokens = ["<mask0>"] + target_tokens + [tokenizer.sep_token]
-        target_ids = tokenizer.convert_tokens_to_ids(target_tokens)
-        padding_length = args.max_target_length - len(target_ids)
-        target_ids += [tokenizer.pad_token_id] * padding_length
-
-        # if example_index < 5:
-        #     if stage == "train":
-        #         pgrsu._ilog("*** Example ***")
-        #         pgrsu._ilog("idx: {}".format(example.idx))
-        #         pgrsu._ilog(
-        #             "source_tokens: {}".format(
-        #                 [x.replace("\u0120", "_") for x in source_tokens]
-        #             )
-        #         )
-        #         pgrsu._ilog("source_ids: {}".format(" ".join(map(str, source_ids))))
-        #         pgrsu._ilog(
-        #             "target_tokens: {}".format(
-        #                 [x.replace("\u0120", "_") for x in target_tokens]
-        #             )
-        #         )
-        #         pgrsu._ilog("target_ids: {}".format(" ".join(map(str, target_ids))))
-
-        features.append(
-            InputFeatures(
-                example_index,
-                source_ids,
-                target_ids,
+        for row in zip(*arrays):
+            yield tuple(torch.from_numpy(a.astype(np.int64)) for a in row)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        shard_id = self.rank * num_workers + worker_id
+        rng = np.random.RandomState((self.seed, self.epoch, shard_id))
+        lines = self._shuffle(self._iter_shard_lines(worker_id, num_workers), rng)
+        chunk = []
+        for item in lines:
+            chunk.append(item)
+            if len(chunk) == self.chunk_size:
+                yield from self._to_features(chunk)
+                chunk = []
+        if chunk:
+            yield from self._to_features(chunk)
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Random batches of examples with similar lengths: shuffle, sort the lengths
+    in chunks of `bucket_size` batches, then shuffle the batches
+    """
+
+    def __init__(
+        self, lengths, batch_size, bucket_size=100, num_replicas=1, rank=0, seed=0
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch  # Same batches for all replicas of an epoch
+
+    def __len__(self):
+        n_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        return (n_batches + self.num_replicas - 1) // self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        indexes = rng.permutation(len(self.lengths))
+        chunk_size = self.batch_size * self.bucket_size
+        batches = []
+        for i in range(0, len(indexes), chunk_size):
+            chunk = indexes[i : i + chunk_size]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind="stable")]
+            batches.extend(
+                chunk[j : j + self.batch_size].tolist()
+                for j in range(0, len(chunk), self.batch_size)
+            )
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+        # Each replica takes every num_replicas-th batch, padded to the same number
+        batches += batches[: len(self) * self.num_replicas - len(batches)]
+        yield from batches[self.rank :: self.num_replicas]
+
+
+def _get_lengths(ids, pad_token_id, chunk_size=65536):
+    """Number of tokens (not padding) of each row of ids"""
+    return np.concatenate(
+        [
+            (ids[i : i + chunk_size] != pad_token_id).sum(-1)
+            for i in range(0, len(ids), chunk_size)
+        ]
+        or [np.zeros(0, dtype=np.int64)]
+    )
+
+
+def _trim_padding(ids, pad_token_id):
+    """Drop the trailing columns that are padding in all rows"""
+    not_pad = ids.ne(pad_token_id).any(0).nonzero()
+    length = int(not_pad[-1]) + 1 if len(not_pad) else 1
+    return ids[:, :length]
+
+
+def make_collate_fn(pad_token_id=None):
+    """
+    Collate fn of the batches gathered by NpyFeaturesDataset.__getitems__ (or of
+    lists of rows), padding each batch to its longest member (instead of max length)
+    if pad_token_id is given
+    """
+
+    def collate_fn(batch):
+        if isinstance(batch, list):  # Rows
+            batch = tuple(torch.stack(ids) for ids in zip(*batch))
+        if pad_token_id is None:
+            return batch
+        return tuple(_trim_padding(ids, pad_token_id) for ids in batch)
+
+    return collate_fn
+
+
+_MASK_HINT_RE = re.compile(r"__mask_0__\s*__mhint_(\w+?)__")
+_mask_hint_tries = {}  # (id(tokenizer), hint) => TokenTrie or None
+
+
+def _get_mask_hint_trie(tokenizer, hint):
+    """TokenTrie of the closed vocabulary of the keras component hint, or None"""
+    key = (id(tokenizer), hint)
+    if key not in _mask_hint_tries:
+        remove_root = bool(eval(os.getenv("IM4DNN_REMOVE_ROOT", "0")))
+        vocab = du._get_mhint_keras_component_vocab(hint, remove_root=remove_root)
+        trie = None
+        if vocab is not None:
+            elements, prefixes = vocab
+            eos_id = tokenizer.sep_token_id
+            trie = TokenTrie(
+                [ids + [eos_id] for ids in _tokenize_to_ids(tokenizer, elements)],
+                _tokenize_to_ids(tokenizer, prefixes),
             )
+        _mask_hint_tries[key] = trie
+    return _mask_hint_tries[key]
+
+
+def get_constrained_decoding_tries(examples, tokenizer):
+    """
+    TokenTrie of each example selected by its mask hint (__mhint_K_loss__, ...),
+    None for the examples without a closed vocabulary hint
+    """
+    tries = []
+    for example in examples:
+        hint = _get_mask_hint(example)
+        tries.append(hint and _get_mask_hint_trie(tokenizer, hint))
+    return tries
+
+
+def _get_mask_hint(example):
+    match = _MASK_HINT_RE.search(example.source)
+    return match and match.group(1)
+
+
+@pgrsu._log_fn_call(ret=False)
+def build_ngram_drafter(filename, tokenizer, args, chunk_size=4096):
+    """NgramDrafter of the target ids of the examples in filename (streamed)"""
+    rm_fn_head = bool(eval(os.getenv("IM4DNN_RM_FN_HEAD", "0")))
+    remove_root = bool(eval(os.getenv("IM4DNN_REMOVE_ROOT", "0")))
+    mask0_id = tokenizer.convert_tokens_to_ids(["<mask0>"])[0]
+    drafter = NgramDrafter(
+        tokenizer.sep_token_id, n=args.draft_ngram, max_draft_len=args.max_draft_len
+    )
+
+    def add(examples):
+        targets = [example.target for example in examples]
+        all_ids = _batch_tokenize_to_ids(tokenizer, args, targets, logging=False)
+        for example, ids in zip(examples, all_ids):
+            ids = ids[: args.max_target_length - 2]  # Same as the target ids
+            drafter.add(_get_mask_hint(example), [mask0_id, *ids, drafter.eos_id])
+
+    examples = []
+    with _open_text(filename) as f:
+        for idx, line in enumerate(pgrsu._tqdm(f)):
+            examples.append(_parse_example(idx, line, rm_fn_head))
+            if remove_root:
+                _remove_root(examples[-1])
+            if len(examples) == chunk_size:
+                add(examples)
+                examples = []
+    add(examples)
+    return drafter.build()
+
+
+def _decode(model, dataloader, tokenizer, beam_size):
+    """Decode the top-1 prediction text of each example in dataloader"""
+    device = next(model.parameters()).device
+    p = []
+    for batch in dataloader:
+        source_ids = batch[0].to(device)
+        with torch.no_grad():
+            preds = model(source_ids, beam_size=beam_size)
+            # convert ids to text
+            for pred in preds:
+                t = pred[0].cpu().numpy()
+                t = list(t)
+                if 0 in t:
+                    t = t[: t.index(0)]
+                text = tokenizer.decode(t, clean_up_tokenization_spaces=False)
+                p.append(text)
+    return p
+
+
+def _dev_bleu(p, eval_examples):
+    """BLEU-4 of the predictions, in memory instead of by dev.output/dev.gold"""
+    predictions, golds = [], []
+    for ref, gold in zip(p, eval_examples):
+        predictions.append(str(gold.idx) + "\t" + ref)
+        # Split as the rows of dev.gold would be read back
+        golds.extend((str(gold.idx) + "\t" + gold.target).split("\n"))
+    (goldMap, predictionMap) = bleu.computeMapsFromRows(predictions, golds)
+    return round(bleu.bleuFromMaps(goldMap, predictionMap)[0], 2)
+
+
+def _init_distributed(args):
+    """
+    Set args.device/rank/world_size, init the process group if launched by torchrun,
+    e.g. `torchrun --nproc_per_node 4 finetune_unixcoder.py --no_cuda ...` (gloo)
+    """
+    use_cuda = torch.cuda.is_available() and not args.no_cuda
+    args.world_size = int(os.getenv("WORLD_SIZE", "1"))
+    args.rank = int(os.getenv("RANK", "0"))
+    args.local_rank = int(os.getenv("LOCAL_RANK", "0"))
+    if use_cuda:
+        torch.cuda.set_device(args.local_rank)
+        args.device = torch.device("cuda", args.local_rank)
+    else:
+        args.device = torch.device("cpu")
+    if args.world_size > 1:
+        torch.distributed.init_process_group(
+            backend=args.ddp_backend or ("nccl" if use_cuda else "gloo"),
+            timeout=datetime.timedelta(hours=5),  # Rank 0 evaluates alone
         )
+    return args.device
+
+
+def _barrier(args):
+    if args.world_size > 1:
+        torch.distributed.barrier()
 
-        pgrsu._schedule_touch_gpu(10 * 60)  # 10 minutes
 
-    return features
+def _check_distributed(args):
+    """
+    Check the process group (e.g. gloo on CPU): all ranks see all the batches of
+    LengthBucketBatchSampler once (modulo padding), and DDP keeps the same weights
+    """
+    world_size = args.world_size
+
+    def all_gather(obj):
+        if world_size == 1:
+            return [obj]
+        objs = [None] * world_size
+        torch.distributed.all_gather_object(objs, obj)
+        return objs
+
+    lengths = np.random.RandomState(0).randint(1, 100, size=103)
+    sampler = LengthBucketBatchSampler(
+        lengths, batch_size=4, bucket_size=3, num_replicas=world_size, rank=args.rank
+    )
+    batches = all_gather(list(sampler))
+    assert len(set(map(len, batches))) == 1, "Replicas have different numbers of batches"
+    seen = sorted({i for rank_batches in batches for b in rank_batches for i in b})
+    assert seen == list(range(len(lengths))), "Some examples are never sampled"
+
+    torch.manual_seed(args.seed)  # The same initial weights on all ranks
+    model = torch.nn.Linear(4, 2).to(args.device)
+    if world_size > 1:
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[args.local_rank] if args.device.type == "cuda" else None
+        )
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    x = torch.full((3, 4), float(args.rank + 1), device=args.device)  # Different data
+    model(x).sum().backward()
+    optimizer.step()
+    weights = all_gather([p.detach().cpu() for p in model.parameters()])
+    for rank_weights in weights[1:]:
+        assert all(torch.equal(a, b) for a, b in zip(weights[0], rank_weights)), (
+            "Gradients are not synchronized"
+        )
+    pgrsu._ilog(f"Distributed check passed (rank {args.rank}/{world_size}, {args.device})")
 
 
 @pgrsu._log_fn_call(ret=False)
@@ -240,19 +805,22 @@ def get_args():
         "--train_filename",
         default=None,
         type=str,
-        help="The train filename. Should contain the .jsonl files for this task.",
+        help="The train filename. Should contain the .jsonl files for this task "
+        "(or a directory of .jsonl/.jsonl.zst shards, e.g. by build_mlm_dataset.py).",
     )
     parser.add_argument(
         "--dev_filename",
         default=None,
         type=str,
-        help="The dev filename. Should contain the .jsonl files for this task.",
+        help="The dev filename. Should contain the .jsonl files for this task "
+        "(or a directory of .jsonl/.jsonl.zst shards, e.g. by build_mlm_dataset.py).",
     )
     parser.add_argument(
         "--test_filename",
         default=None,
         type=str,
-        help="The test filename. Should contain the .jsonl files for this task.",
+        help="The test filename. Should contain the .jsonl files for this task "
+        "(or a directory of .jsonl/.jsonl.zst shards, e.g. by build_mlm_dataset.py).",
     )
     parser.add_argument(
         "--max_source_length",
@@ -293,7 +861,8 @@ def get_args():
         "--train_batch_size",
         default=8,
         type=int,
-        help="Batch size per GPU/CPU for training.",
+        help="Batch size for training, split across the processes launched by torchrun "
+        "(as DataParallel split it across the GPUs).",
     )
     parser.add_argument(
         "--eval_batch_size",
@@ -316,6 +885,13 @@ def get_args():
     parser.add_argument(
         "--beam_size", default=10, type=int, help="beam size for beam search"
     )
+    parser.add_argument(
+        "--eval_beam_size",
+        default=1,
+        type=int,
+        help="beam size for the dev bleu during training (1 is greedy), the full "
+        "--beam_size is only used to confirm a new best checkpoint",
+    )
     parser.add_argument(
         "--weight_decay", default=0.0, type=float, help="Weight deay if we apply some."
     )
@@ -334,6 +910,107 @@ def get_args():
     parser.add_argument(
         "--seed", type=int, default=1234, help="random seed for initialization"
     )
+    parser.add_argument(
+        "--do_preprocess",
+        action="store_true",
+        help="Whether to only build the features cache of the train/dev/test files.",
+    )
+    parser.add_argument(
+        "--features_cache_dir",
+        default=None,
+        type=str,
+        help="The directory of the features cache, default to {output_dir}/features_cache.",
+    )
+    parser.add_argument(
+        "--constrained_decoding",
+        action="store_true",
+        help="Whether to restrict the beam search (test/inference) to the keras "
+        "vocabulary selected by the mask hint, e.g. __mhint_K_activation__.",
+    )
+    parser.add_argument(
+        "--draft_filename",
+        default=None,
+        type=str,
+        help="The jsonl file (e.g. train.jsonl) whose targets build the n-gram "
+        "drafter of the inference service, no draft decoding if not given.",
+    )
+    parser.add_argument(
+        "--draft_ngram", default=3, type=int, help="n of the n-gram drafter."
+    )
+    parser.add_argument(
+        "--max_draft_len",
+        default=8,
+        type=int,
+        help="Max number of tokens drafted for a hypothesis per decoder pass.",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Whether to stream the training data from the (optionally *.zst) jsonl "
+        "file and tokenize on the fly, instead of loading it all into memory.",
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        default=10000,
+        type=int,
+        help="Number of examples to shuffle within (--streaming only).",
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        default=0,
+        type=int,
+        help="Number of DataLoader worker processes (--streaming only).",
+    )
+    parser.add_argument(
+        "--fp16",
+        action="store_true",
+        help="Whether to train with fp16 autocast and loss scaling (CUDA only).",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Whether to train with bf16 autocast (CUDA or CPU).",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="Whether to recompute the activations of the encoder layers in backward.",
+    )
+    parser.add_argument(
+        "--ddp_backend",
+        default=None,
+        type=str,
+        help="Backend of DistributedDataParallel (launched by torchrun), default to "
+        "nccl on CUDA and gloo on CPU.",
+    )
+    parser.add_argument(
+        "--check_distributed",
+        action="store_true",
+        help="Only check the process group, the sharding of the batches and the gradient "
+        "sync, e.g. `torchrun --nproc_per_node 2 finetune_unixcoder.py --no_cuda "
+        "--check_distributed --model_name_or_path - --output_dir /tmp/ddp_check` (gloo, no GPU needed).",
+    )
+    parser.add_argument(
+        "--disable_dynamic_padding",
+        action="store_true",
+        help="Pad every batch to max_source_length/max_target_length.",
+    )
+    parser.add_argument(
+        "--disable_fast_tokenizer",
+        action="store_true",
+        help="Avoid tokenizing with the fast (Rust) tokenizer.",
+    )
+    parser.add_argument(
+        "--tokenize_num_workers",
+        default=1,
+        type=int,
+        help="Number of processes to tokenize with the slow tokenizer.",
+    )
+    parser.add_argument(
+        "--disable_features_cache",
+        action="store_true",
+        help="Avoid caching the features of the train/dev/test files.",
+    )
 
     return parser.parse_args()
 
@@ -341,10 +1018,29 @@ def get_args():
 @pgrsu._log_fn_call(ret=False)
 def main(args):
     # set device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = _init_distributed(args)
     args.n_gpu = torch.cuda.device_count()
-    args.device = device
     pgrsu._ilog(f"Device: {device}, n_gpu: {args.n_gpu}")
+    pgrsu._ilog(f"Rank: {args.rank}, world_size: {args.world_size}")
+    if args.n_gpu > 1 and args.world_size == 1 and device.type == "cuda":
+        pgrsu._wlog(
+            f"{args.n_gpu} GPUs but only {device} is used, launch with "
+            f"`torchrun --nproc_per_node {args.n_gpu}` (see finetune_unixcoder.sh)"
+        )
+    args.per_process_train_batch_size = (
+        args.train_batch_size // args.gradient_accumulation_steps // args.world_size
+    )
+    if args.do_train and args.per_process_train_batch_size == 0:
+        raise ValueError(
+            "--train_batch_size must be >= gradient_accumulation_steps * world_size"
+        )
+    if args.check_distributed:
+        _check_distributed(args)
+        return
+    if args.fp16 and device.type != "cuda":
+        raise ValueError("--fp16 requires CUDA, use --bf16 instead")
+    if args.fp16 and args.bf16:
+        raise ValueError("--fp16 and --bf16 are exclusive")
 
     # Set seed
     set_seed(args.seed)
@@ -354,6 +1050,14 @@ def main(args):
 
     # build model
     tokenizer = RobertaTokenizer.from_pretrained(args.model_name_or_path)
+    args.fast_tokenizer = None
+    if not args.disable_fast_tokenizer:
+        try:
+            args.fast_tokenizer = RobertaTokenizerFast.from_pretrained(
+                args.model_name_or_path
+            )
+        except Exception as e:
+            pgrsu._wlog(f"Load fast tokenizer failed, use the slow one: {e}")
     config = RobertaConfig.from_pretrained(args.model_name_or_path)
     # import！！！you must set is_decoder as True for generation
     config.is_decoder = True
@@ -380,32 +1084,88 @@ def main(args):
 
     pgrsu._ilog(f"The model has {count_parameters(model):,} trainable parameters")
 
+    if args.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+
     pgrsu._ilog(f"Training/evaluation parameters {args}")
     model.to(args.device)
 
-    if args.n_gpu > 1:
-        # multi-gpu training
-        model = torch.nn.DataParallel(model)
+    if args.world_size > 1:
+        # multi-process (multi-gpu or cpu) training
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[args.local_rank] if device.type == "cuda" else None
+        )
+    raw_model = model.module if hasattr(model, "module") else model
+
+    if args.do_preprocess:
+        for filename, stages in (
+            (args.train_filename, ["train"]),
+            (args.dev_filename, ["dev", "test"]),  # dev loss, dev bleu
+            (args.test_filename, ["test"]),
+        ):
+            for stage in stages if filename else []:
+                load_features(filename, tokenizer, args, stage=stage)
+        return
+
+    # Pad each batch to its longest member
+    collate_fn = make_collate_fn(
+        None if args.disable_dynamic_padding else tokenizer.pad_token_id
+    )
 
     if args.do_train:
-        # Prepare training data loader
-        train_examples = read_examples(args.train_filename)
-        train_features = convert_examples_to_features(
-            train_examples, tokenizer, args, stage="train"
-        )
-        all_source_ids = torch.tensor(
-            [f.source_ids for f in train_features], dtype=torch.long
-        )
-        all_target_ids = torch.tensor(
-            [f.target_ids for f in train_features], dtype=torch.long
-        )
-        train_data = TensorDataset(all_source_ids, all_target_ids)
-        train_sampler = RandomSampler(train_data)
-        train_dataloader = DataLoader(
-            train_data,
-            sampler=train_sampler,
-            batch_size=args.train_batch_size // args.gradient_accumulation_steps,
-        )
+        if args.streaming:
+            # Prepare training data loader (streamed from the jsonl file)
+            train_data = StreamingFeaturesDataset(
+                args.train_filename,
+                tokenizer,
+                args,
+                stage="train",
+                shuffle_buffer_size=args.shuffle_buffer_size,
+                num_replicas=args.world_size,
+                rank=args.rank,
+                seed=args.seed,
+            )
+            train_sampler = train_data  # For set_epoch
+            train_dataloader = DataLoader(
+                train_data,
+                batch_size=args.per_process_train_batch_size,
+                num_workers=args.dataloader_num_workers,
+                collate_fn=collate_fn,
+            )
+        else:
+            # Prepare training data loader
+            if args.rank != 0:
+                _barrier(args)  # Wait for rank 0 to build the features cache
+            all_source_ids, all_target_ids = load_features(
+                args.train_filename, tokenizer, args, stage="train"
+            )
+            if args.rank == 0:
+                _barrier(args)
+            train_data = NpyFeaturesDataset(all_source_ids, all_target_ids)
+            if args.disable_dynamic_padding:
+                if args.world_size > 1:
+                    train_sampler = DistributedSampler(train_data, seed=args.seed)
+                else:
+                    train_sampler = RandomSampler(train_data)
+                train_dataloader = DataLoader(
+                    train_data,
+                    sampler=train_sampler,
+                    batch_size=args.per_process_train_batch_size,
+                    collate_fn=collate_fn,
+                )
+            else:
+                train_sampler = LengthBucketBatchSampler(
+                    _get_lengths(all_source_ids, tokenizer.pad_token_id),
+                    batch_size=args.per_process_train_batch_size,
+                    num_replicas=args.world_size,
+                    rank=args.rank,
+                    seed=args.seed,
+                )
+                train_dataloader = DataLoader(
+                    train_data,
+                    batch_sampler=train_sampler,
+                    collate_fn=collate_fn,
+                )
 
         # Prepare optimizer and schedule (linear warmup and decay)
         no_decay = ["bias", "LayerNorm.weight"]
@@ -438,32 +1198,52 @@ def main(args):
 
         # Start training
         pgrsu._ilog("***** Running training *****")
-        pgrsu._ilog(f"  Num examples = {len(train_examples)}")
+        pgrsu._ilog(f"  Num examples = {len(train_data)}")
         pgrsu._ilog(
             f"  Batch size = {args.train_batch_size * args.gradient_accumulation_steps}"
         )
         pgrsu._ilog(f"  Num epoch = {args.num_train_epochs}")
 
+        # Mixed precision: autocast (bf16/fp16) and loss scaling (fp16 only)
+        amp_dtype = torch.bfloat16 if args.bf16 else torch.float16 if args.fp16 else None
+        scaler = torch.cuda.amp.GradScaler(enabled=args.fp16)
+
         model.train()
         patience, best_bleu, losses, dev_dataset = 0, 0, [], {}
+        best_fast_bleu = 0
         for epoch in range(args.num_train_epochs):
+            if hasattr(train_sampler, "set_epoch"):
+                train_sampler.set_epoch(epoch)
             for idx, batch in enumerate(train_dataloader):
                 batch = tuple(t.to(device) for t in batch)
                 source_ids, target_ids = batch
-                loss, _, _ = model(source_ids=source_ids, target_ids=target_ids)
-
-                if args.n_gpu > 1:
-                    loss = loss.mean()  # mean() to average on multi-gpu.
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
-
-                losses.append(loss.item())
-                loss.backward()
+                # Sync gradients (DDP) only in the last accumulation step
+                sync_grads = (len(losses) + 1) % args.gradient_accumulation_steps == 0
+                with (
+                    model.no_sync()
+                    if args.world_size > 1 and not sync_grads
+                    else contextlib.nullcontext()
+                ):
+                    with torch.autocast(
+                        device_type=device.type,
+                        dtype=amp_dtype,
+                        enabled=amp_dtype is not None,
+                    ):
+                        loss, _, _ = model(source_ids=source_ids, target_ids=target_ids)
+
+                    if args.gradient_accumulation_steps > 1:
+                        loss = loss / args.gradient_accumulation_steps
+
+                    losses.append(loss.item())
+                    scaler.scale(loss).backward()
                 if len(losses) % args.gradient_accumulation_steps == 0:
                     # Update parameters
-                    optimizer.step()
+                    scaler.step(optimizer)
+                    scaler.update()
                     optimizer.zero_grad()
                     scheduler.step()
+                    if args.rank != 0:
+                        continue
                     if len(losses) // args.gradient_accumulation_steps % 100 == 0:
                         pgrsu._ilog(
                             "Epoch {} Step {} loss {}".format(
@@ -479,26 +1259,23 @@ def main(args):
                                 ),
                             )
                         )
-            if args.do_eval:
-                # Eval model with dev dataset
+            if args.do_eval and args.rank == 0:
+                # Eval model with dev dataset (rank 0 only, by the raw model)
                 if "dev_loss" in dev_dataset:
                     eval_examples, eval_data = dev_dataset["dev_loss"]
                 else:
-                    eval_examples = read_examples(args.dev_filename)
-                    eval_features = convert_examples_to_features(
-                        eval_examples, tokenizer, args, stage="dev"
-                    )
-                    all_source_ids = torch.tensor(
-                        [f.source_ids for f in eval_features], dtype=torch.long
+                    all_source_ids, all_target_ids = load_features(
+                        args.dev_filename, tokenizer, args, stage="dev"
                     )
-                    all_target_ids = torch.tensor(
-                        [f.target_ids for f in eval_features], dtype=torch.long
-                    )
-                    eval_data = TensorDataset(all_source_ids, all_target_ids)
+                    eval_data = NpyFeaturesDataset(all_source_ids, all_target_ids)
+                    eval_examples = eval_data  # Only the number is used
                     dev_dataset["dev_loss"] = eval_examples, eval_data
                 eval_sampler = SequentialSampler(eval_data)
                 eval_dataloader = DataLoader(
-                    eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size
+                    eval_data,
+                    sampler=eval_sampler,
+                    batch_size=args.eval_batch_size,
+                    collate_fn=collate_fn,
                 )
 
                 pgrsu._ilog("***** Running evaluation *****")
@@ -513,7 +1290,7 @@ def main(args):
                     source_ids, target_ids = batch
 
                     with torch.no_grad():
-                        _, loss, num = model(
+                        _, loss, num = raw_model(
                             source_ids=source_ids, target_ids=target_ids
                         )
                     eval_loss += loss.sum().item()
@@ -531,57 +1308,51 @@ def main(args):
                     eval_examples, eval_data = dev_dataset["dev_bleu"]
                 else:
                     eval_examples = read_examples(args.dev_filename)
-                    eval_examples = random.sample(
-                        eval_examples, min(1000, len(eval_examples))
-                    )
-                    eval_features = convert_examples_to_features(
-                        eval_examples, tokenizer, args, stage="test"
+                    all_source_ids, _ = load_features(
+                        args.dev_filename,
+                        tokenizer,
+                        args,
+                        stage="test",
+                        examples=eval_examples,
                     )
-                    all_source_ids = torch.tensor(
-                        [f.source_ids for f in eval_features], dtype=torch.long
+                    # Same as random.sample(eval_examples, ...)
+                    sample_indexes = random.sample(
+                        range(len(eval_examples)), min(1000, len(eval_examples))
                     )
-                    eval_data = TensorDataset(all_source_ids)
+                    eval_examples = [eval_examples[i] for i in sample_indexes]
+                    eval_data = NpyFeaturesDataset(all_source_ids[sample_indexes])
                     dev_dataset["dev_bleu"] = eval_examples, eval_data
 
                 eval_sampler = SequentialSampler(eval_data)
                 eval_dataloader = DataLoader(
-                    eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size
+                    eval_data,
+                    sampler=eval_sampler,
+                    batch_size=args.eval_batch_size,
+                    collate_fn=collate_fn,
                 )
 
                 model.eval()
-                p = []
-                for batch in eval_dataloader:
-                    batch = tuple(t.to(device) for t in batch)
-                    source_ids = batch[0]
-                    with torch.no_grad():
-                        preds = model(source_ids)
-                        # convert ids to text
-                        for pred in preds:
-                            t = pred[0].cpu().numpy()
-                            t = list(t)
-                            if 0 in t:
-                                t = t[: t.index(0)]
-                            text = tokenizer.decode(
-                                t, clean_up_tokenization_spaces=False
-                            )
-                            p.append(text)
+                # Cheap (greedy by default) decoding at every evaluation, the full
+                # beam only for the candidates of a new best checkpoint
+                eval_beam_size = min(args.eval_beam_size, args.beam_size)
+                p = _decode(raw_model, eval_dataloader, tokenizer, eval_beam_size)
+                dev_bleu = _dev_bleu(p, eval_examples)
+                pgrsu._ilog(f"  bleu-4 (beam {eval_beam_size}) = {str(dev_bleu)} ")
+                is_candidate = dev_bleu > best_fast_bleu
+                best_fast_bleu = max(best_fast_bleu, dev_bleu)
+                if is_candidate and eval_beam_size < args.beam_size:
+                    p = _decode(raw_model, eval_dataloader, tokenizer, args.beam_size)
+                    dev_bleu = _dev_bleu(p, eval_examples)
+                    pgrsu._ilog(f"  bleu-4 (beam {args.beam_size}) = {str(dev_bleu)} ")
                 model.train()
-                predictions = []
-                with open(args.output_dir + "/dev.output", "w") as f, open(
-                    args.output_dir + "/dev.gold", "w"
-                ) as f1:
-                    for ref, gold in zip(p, eval_examples):
-                        predictions.append(str(gold.idx) + "\t" + ref)
-                        f.write(str(gold.idx) + "\t" + ref + "\n")
-                        f1.write(str(gold.idx) + "\t" + gold.target + "\n")
-
-                (goldMap, predictionMap) = bleu.computeMaps(
-                    predictions, os.path.join(args.output_dir, "dev.gold")
-                )
-                dev_bleu = round(bleu.bleuFromMaps(goldMap, predictionMap)[0], 2)
-                pgrsu._ilog(f"  bleu-4 = {str(dev_bleu)} ")
                 pgrsu._ilog("  " + "*" * 20)
-                if dev_bleu > best_bleu:
+                if is_candidate and dev_bleu > best_bleu:
+                    with open(args.output_dir + "/dev.output", "w") as f, open(
+                        args.output_dir + "/dev.gold", "w"
+                    ) as f1:
+                        for ref, gold in zip(p, eval_examples):
+                            f.write(str(gold.idx) + "\t" + ref + "\n")
+                            f1.write(str(gold.idx) + "\t" + gold.target + "\n")
                     pgrsu._ilog(f"  Best bleu: {dev_bleu}")
                     pgrsu._ilog("  " + "*" * 20)
                     best_bleu = dev_bleu
@@ -599,6 +1370,14 @@ def main(args):
                     patience += 1
                     # if patience == 2:
                     #     break
+            _barrier(args)  # Wait for the evaluation of rank 0
+
+    if args.world_size > 1:
+        torch.distributed.destroy_process_group()
+        if args.rank != 0:
+            return  # Test/inference on rank 0 only
+        model = raw_model
+
     if args.do_test:
         output_filename = os.path.join(
             args.output_dir, (args.output_and_gold_name or "test") + ".output"
@@ -615,20 +1394,24 @@ def main(args):
             model_to_load.load_state_dict(torch.load(output_dir))
 
         eval_examples = read_examples(args.test_filename)
-        eval_features = convert_examples_to_features(
-            eval_examples, tokenizer, args, stage="test"
+        all_source_ids, _ = load_features(
+            args.test_filename, tokenizer, args, stage="test", examples=eval_examples
         )
-        all_source_ids = torch.tensor(
-            [f.source_ids for f in eval_features], dtype=torch.long
-        )
-        eval_data = TensorDataset(all_source_ids)
+        eval_data = NpyFeaturesDataset(all_source_ids)
 
         # Calculate bleu
         eval_sampler = SequentialSampler(eval_data)
         eval_dataloader = DataLoader(
-            eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size
+            eval_data,
+            sampler=eval_sampler,
+            batch_size=args.eval_batch_size,
+            collate_fn=collate_fn,
         )
 
+        tries = None
+        if args.constrained_decoding:
+            tries = get_constrained_decoding_tries(eval_examples, tokenizer)
+
         model.eval()
         p = []
         for batch in pgrsu._tqdm(
@@ -637,7 +1420,8 @@ def main(args):
             batch = tuple(t.to(device) for t in batch)
             source_ids = batch[0]
             with torch.no_grad():
-                preds = model(source_ids)
+                batch_tries = tries and tries[len(p) : len(p) + len(source_ids)]
+                preds = model(source_ids, tries=batch_tries)
                 # convert ids to text
                 for pred in preds:
                     t = pred[0].cpu().numpy()
@@ -682,9 +1466,9 @@ def main(args):
             dummy_feature = convert_examples_to_features(
                 [dummy_example], tokenizer, args, stage="test"
             )[0]
-            source_ids = torch.tensor(
-                [dummy_feature.source_ids], dtype=torch.long, device=args.device
-            )
+            source_ids = torch.from_numpy(
+                dummy_feature.source_ids[None].astype(np.int64)
+            ).to(args.device)
             model.eval()
             with torch.no_grad():
                 preds = model(source_ids)
@@ -700,48 +1484,115 @@ def main(args):
             model.train()
 
     if args.run_inference_service:
+        import copy
+        import threading
+
         checkpoint_prefix = "checkpoint-best-bleu/pytorch_model.bin"
         output_dir = os.path.join(args.output_dir, checkpoint_prefix)
         model_to_load = model.module if hasattr(model, "module") else model
         model_to_load.load_state_dict(torch.load(output_dir))
 
+        # Draft decoding: the n-gram proposals are verified by the model
+        drafter = None
+        if args.draft_filename:
+            drafter = build_ngram_drafter(args.draft_filename, tokenizer, args)
+
+        # Hot reload: a new checkpoint is loaded into the standby copy while the
+        # active model keeps serving, then they are swapped between two requests
+        models = {"active": model_to_load, "standby": None}
+        infer_lock = threading.Lock()  # One inference at a time (as before)
+        reload_lock = threading.Lock()  # One reload at a time
+        checkpoints_dir = os.path.realpath(args.output_dir)
+
+        def reload(checkpoint=None):
+            checkpoint = os.path.realpath(checkpoint or output_dir)
+            # The service is not authenticated: only checkpoints under the output
+            # dir, and only their weights (no arbitrary unpickling)
+            if os.path.commonpath([checkpoint, checkpoints_dir]) != checkpoints_dir:
+                raise ValueError(f"Not a checkpoint under {checkpoints_dir}: {checkpoint}")
+            with reload_lock:
+                # The standby is never used by a request: it only becomes active
+                # (and the active one standby) under infer_lock
+                standby = models["standby"] or copy.deepcopy(models["active"])
+                standby.load_state_dict(
+                    torch.load(checkpoint, map_location=device, weights_only=True)
+                )
+                with infer_lock:
+                    models["active"], models["standby"] = standby, models["active"]
+            pgrsu._ilog(f"Reloaded checkpoint: {checkpoint}")
+            return checkpoint
+
         def service(inputs: list[str]) -> list[list[str]]:
+            with infer_lock:  # The whole request is served by the same weights
+                return _service(models["active"], inputs)
+
+        def _service(model, inputs: list[str]) -> list[list[str]]:
             infer_examples = []
             for idx, code in enumerate(inputs):
                 infer_examples.append(Example(idx, code, ""))
-            infer_features = convert_examples_to_features(
+            all_source_ids, _ = convert_examples_to_arrays(
                 infer_examples, tokenizer, args, stage="test"
             )
-
-            outputs = []
-            for e in infer_features:
-                source_ids = torch.tensor(
-                    [e.source_ids], dtype=torch.long, device=args.device
+            tries = None
+            if args.constrained_decoding:
+                tries = get_constrained_decoding_tries(infer_examples, tokenizer)
+            drafters = None
+            if drafter is not None:
+                drafters = [
+                    functools.partial(drafter.draft, _get_mask_hint(example))
+                    for example in infer_examples
+                ]
+
+            # Batch the inputs with similar lengths, each batch is padded to its
+            # longest member (unless disabled), then restore the order of inputs
+            if args.disable_dynamic_padding:
+                order = np.arange(len(inputs))
+            else:
+                lengths = _get_lengths(all_source_ids, tokenizer.pad_token_id)
+                order = np.argsort(lengths, kind="stable")
+            outputs = [None] * len(inputs)
+            model.eval()
+            for i in range(0, len(order), args.eval_batch_size):
+                batch_indexes = order[i : i + args.eval_batch_size]
+                source_ids = torch.from_numpy(
+                    all_source_ids[batch_indexes].astype(np.int64)
                 )
-                model.eval()
+                if not args.disable_dynamic_padding:
+                    source_ids = _trim_padding(source_ids, tokenizer.pad_token_id)
                 with torch.no_grad():
-                    preds = model(source_ids)
-                    assert preds.shape[0] == 1
+                    batch_tries = tries and [tries[idx] for idx in batch_indexes]
+                    batch_drafters = drafters and [drafters[i] for i in batch_indexes]
+                    preds = model(
+                        source_ids.to(args.device),
+                        tries=batch_tries,
+                        drafters=batch_drafters,
+                    )
+                    assert preds.shape[0] == len(batch_indexes)
                     # convert ids to text
-                    for pred in preds:
+                    for idx, pred in zip(batch_indexes, preds):
                         assert pred.shape[0] == args.beam_size
                         t = pred[0].cpu().numpy()
                         t = list(t)
                         if 0 in t:
                             t = t[: t.index(0)]
                         text = tokenizer.decode(t, clean_up_tokenization_spaces=False)
-                        outputs.append([text])  # Top 1 only now
-                model.train()
+                        outputs[idx] = [text]  # Top 1 only now
+            model.train()
             assert len(outputs) == len(inputs)
             return outputs
 
         # Run inference service (HTTP server)
-        import sys
         import http
         import http.server
         import json
 
         class InferenceServiceHandler(http.server.BaseHTTPRequestHandler):
+            def send_json(self, status, obj):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(obj).encode("utf-8"))
+
             def do_POST(self):
                 if self.path == "/health":
                     self.send_response(http.HTTPStatus.OK)
@@ -757,14 +1608,46 @@ def main(args):
                     self.send_header("Content-Type", "application/json")
                     self.end_headers()
                     self.wfile.write(json.dumps(outputs).encode("utf-8"))
+                elif self.path == "/reload":
+                    # {"checkpoint": "path/to/pytorch_model.bin"} under --output_dir,
+                    # default to the checkpoint-best-bleu one (e.g. retrained in place)
+                    try:  # A malformed request is rejected like a checkpoint not allowed
+                        content_length = int(self.headers["Content-Length"] or 0)
+                        body = self.rfile.read(content_length) if content_length else b""
+                        request = json.loads(body or "{}")
+                        if not isinstance(request, dict):
+                            raise ValueError(f"Not a JSON object: {body[:64]!r}")
+                        checkpoint = request.get("checkpoint")
+                        if checkpoint is not None and not isinstance(checkpoint, str):
+                            raise ValueError(f"Not a checkpoint path: {checkpoint!r}")
+                        checkpoint = reload(checkpoint)
+                    except ValueError as e:
+                        pgrsu._wlog(f"Reload rejected: {e}")
+                        self.send_json(
+                            http.HTTPStatus.BAD_REQUEST,
+                            {"status": "error", "error": str(e)},
+                        )
+                        return
+                    except Exception as e:  # Keep serving the active model
+                        pgrsu._wlog(f"Reload failed: {e}")
+                        self.send_json(
+                            http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                            {"status": "error", "error": str(e)},
+                        )
+                        return
+                    self.send_json(
+                        http.HTTPStatus.OK, {"status": "ok", "checkpoint": checkpoint}
+                    )
                 elif self.path == "/exit":
                     self.send_response(http.HTTPStatus.OK)
                     self.send_header("Content-Type", "application/json")
                     self.end_headers()
                     self.wfile.write(json.dumps({"status": "ok"}).encode("utf-8"))
-                    sys.exit(0)
+                    # Not sys.exit: the handler runs in a thread of the server
+                    threading.Thread(target=httpd.shutdown).start()
 
-        httpd = http.server.HTTPServer(("", 37654), InferenceServiceHandler)
+        # Threaded, so that /reload and /health are served during an inference
+        httpd = http.server.ThreadingHTTPServer(("", 37654), InferenceServiceHandler)
         httpd.serve_forever()
 
 
@@ -28,6 +28,15 @@ if [ $((max_source_length + max_target_length)) -gt 1024 ]; then
 	exit 1
 fi
 
+# One process per GPU (DistributedDataParallel) if there are many, train_batch_size is split across them
+num_gpus=${NUM_GPUS:-$(nvidia-smi -L 2>/dev/null | wc -l)}  # e.g. NUM_GPUS=2 with CUDA_VISIBLE_DEVICES
+if [ "${num_gpus}" -gt 1 ]; then
+	train_launcher="torchrun --nproc_per_node=${num_gpus}"
+else
+	train_launcher="python"
+fi
+echo "Train launcher: ${train_launcher}"
+
 # Python: model_name_or_path_short = os.path.basename(model_name_or_path).replace('-', '_')
 model_name_or_path_short=$(basename ${ARG_model_name_or_path} | tr '-' '_')
 echo "model_name_or_path_short: ${model_name_or_path_short}"
@@ -63,7 +72,8 @@ mkdir -p ${output_dir}
 
 # Training
 echo -e "\033[34m================= Training =================\033[0m"
-python -u -W ignore scripts/finetune_unixcoder.py \
+# -u -W ignore by env, torchrun takes no python options
+PYTHONUNBUFFERED=1 PYTHONWARNINGS=ignore ${train_launcher} scripts/finetune_unixcoder.py \
 	--do_train \
 	--do_eval \
 	--model_name_or_path ${model_name_or_path} \
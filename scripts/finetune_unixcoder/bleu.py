@@ -20,6 +20,8 @@ The reason for breaking the BLEU computation into three phases cook_refs(), cook
 import sys, math, re, xml.sax.saxutils
 import subprocess
 import os
+import functools
+from collections import Counter
 
 # Added to bypass NIST-style pre-processing of hyp and ref files -- wade
 nonorm = 0
@@ -74,11 +76,10 @@ def normalize(s):
 
 
 def count_ngrams(words, n=4):
-    counts = {}
+    # All k-grams at once by zipping k shifted views, instead of slicing per position
+    counts = Counter()
     for k in range(1, n + 1):
-        for i in range(len(words) - k + 1):
-            ngram = tuple(words[i : i + k])
-            counts[ngram] = counts.get(ngram, 0) + 1
+        counts.update(zip(*[words[i:] for i in range(k)]))
     return counts
 
 
@@ -96,6 +97,12 @@ def cook_refs(refs, n=4):
     return ([len(ref) for ref in refs], maxcounts)
 
 
+@functools.lru_cache(maxsize=65536)
+def _cook_refs_cached(refs, n=4):
+    # The gold side is the same for every dev evaluation, cook it once
+    return cook_refs(refs, n)
+
+
 def cook_test(test, item, n=4):
     """Takes a test sentence and returns an object that
     encapsulates everything that BLEU needs to know about it."""
@@ -165,7 +172,7 @@ def score_cooked(allcomps, n=4, ground=0, smooth=1):
 
 
 def bleu(refs, candidate, ground=0, smooth=1):
-    refs = cook_refs(refs)
+    refs = _cook_refs_cached(tuple(refs))
     test = cook_test(candidate, refs)
     return score_cooked([test], ground=ground, smooth=smooth)
 
@@ -175,9 +182,14 @@ def splitPuncts(line):
 
 
 def computeMaps(predictions, goldfile):
+    with open(goldfile, "r") as gf:
+        return computeMapsFromRows(predictions, gf)
+
+
+def computeMapsFromRows(predictions, golds):
+    """Same as computeMaps, but the gold rows (`id\tgold`) are given in memory."""
     predictionMap = {}
     goldMap = {}
-    gf = open(goldfile, "r")
 
     for row in predictions:
         cols = row.strip().split("\t")
@@ -187,7 +199,7 @@ def computeMaps(predictions, goldfile):
             (rid, pred) = (cols[0], cols[1])
         predictionMap[rid] = [splitPuncts(pred.strip().lower())]
 
-    for row in gf:
+    for row in golds:
         cols = row.strip().split("\t")
         if len(cols) == 1:
             (rid, pred) = (cols[0], "")
@@ -49,9 +49,34 @@ class Seq2Seq(nn.Module):
         self.sos_id = sos_id
         self.eos_id = eos_id
 
-    def forward(self, source_ids, target_ids=None):
+    def gradient_checkpointing_enable(self):
+        """
+        Recompute the activations of each encoder (also decoder) layer in backward.
+        The checkpointing of transformers turns off use_cache, but the decoder
+        needs the past_key_values of the encoder, so wrap the layers instead.
+        """
+        import torch.utils.checkpoint
+
+        def make_forward(layer, forward):
+            def checkpointed_forward(*args, **kwargs):
+                if not layer.training:
+                    return forward(*args, **kwargs)
+                return torch.utils.checkpoint.checkpoint(
+                    forward, *args, use_reentrant=False, **kwargs
+                )
+
+            return checkpointed_forward
+
+        for layer in self.encoder.encoder.layer:
+            layer.forward = make_forward(layer, layer.forward)
+
+    def forward(
+        self, source_ids, target_ids=None, beam_size=None, tries=None, drafters=None
+    ):
         if target_ids is None:
-            return self.generate(source_ids)
+            return self.generate(
+                source_ids, beam_size=beam_size, tries=tries, drafters=drafters
+            )
 
         mask = source_ids.ne(1)[:, None, :] * source_ids.ne(1)[:, :, None]
         encoder_output = self.encoder(source_ids, attention_mask=mask, use_cache=True)
@@ -79,46 +104,95 @@ class Seq2Seq(nn.Module):
         outputs = loss, loss * active_loss.sum(), active_loss.sum()
         return outputs
 
-    def generate(self, source_ids):
+    def _next_log_probs(self, context, context_ids, input_ids, drafts=None):
+        """
+        (beam x (1 + draft length) x vocab) log probs of the next token after each
+        input, then after each prefix of its draft: the decoder is causal, so the
+        first ones are the same as without drafts, and all come from one pass
+        """
+        num_drafted = max(map(len, drafts)) if drafts else 0
+        if num_drafted:
+            draft_ids = input_ids.new_ones(input_ids.size(0), num_drafted)  # 1: pad
+            for k, draft in enumerate(drafts):
+                draft_ids[k, : len(draft)] = input_ids.new_tensor(draft)
+            input_ids = torch.cat((input_ids, draft_ids), -1)
+        ids = torch.cat((context_ids, input_ids), -1)
+        mask = self.bias[:, context_ids.size(-1) : ids.size(-1), : ids.size(-1)].bool()
+        mask = mask & ids[:, None, :].ne(1)
+        out = self.decoder(
+            input_ids, attention_mask=mask, past_key_values=context
+        ).last_hidden_state
+        hidden_states = out[:, -1 - num_drafted :, :]
+        return self.lsm(self.lm_head(hidden_states)).data
+
+    def generate(self, source_ids, beam_size=None, tries=None, drafters=None):
+        """
+        Beam search. `tries`: a TokenTrie (or None, unconstrained) of each example,
+        only the continuations in the trie are expanded. `drafters`: a function
+        (or None) of each example proposing the next tokens of a hypothesis, the
+        steps whose hypotheses all follow the drafts skip the decoder pass (the
+        outputs are the same as without drafters).
+        """
+        beam_size = beam_size or self.beam_size  # e.g. 1 (greedy) for dev evaluation
         mask = source_ids.ne(1)[:, None, :] * source_ids.ne(1)[:, :, None]
         encoder_output = self.encoder(source_ids, attention_mask=mask, use_cache=True)
         preds = []
-        zero = torch.cuda.LongTensor(1).fill_(0)
+        zero = source_ids.new_zeros(1)
         source_len = list(source_ids.ne(1).sum(-1).cpu().numpy())
         for i in range(source_ids.shape[0]):
             context = [
                 [
-                    x[i : i + 1, :, : source_len[i]].repeat(self.beam_size, 1, 1, 1)
+                    x[i : i + 1, :, : source_len[i]].repeat(beam_size, 1, 1, 1)
                     for x in y
                 ]
                 for y in encoder_output.past_key_values
             ]
-            beam = Beam(self.beam_size, self.sos_id, self.eos_id)
+            beam = Beam(beam_size, self.sos_id, self.eos_id, source_ids.device)
             input_ids = beam.getCurrentState()
             context_ids = source_ids[i : i + 1, : source_len[i]].repeat(
-                self.beam_size, 1
+                beam_size, 1
             )
+            drafter = drafters[i] if drafters is not None else None
+            # The log probs of each hypothesis are log_probs[k, d]: after the
+            # input k of the last decoder pass plus the first d tokens of its draft
+            log_probs, drafts, positions = None, None, None
             for _ in range(self.max_length):
                 if beam.done():
                     break
 
-                ids = torch.cat((context_ids, input_ids), -1)
-                mask = self.bias[
-                    :, context_ids.size(-1) : ids.size(-1), : ids.size(-1)
-                ].bool()
-                mask = mask & ids[:, None, :].ne(1)
-                out = self.decoder(
-                    input_ids, attention_mask=mask, past_key_values=context
-                ).last_hidden_state
-                hidden_states = out[:, -1, :]
-                out = self.lsm(self.lm_head(hidden_states)).data
+                if positions is None:  # Decoder pass
+                    if drafter is not None:
+                        # Drafts are cut to fit in the max positions (of self.bias)
+                        room = self.bias.size(-1) - context_ids.size(-1)
+                        room = max(room - input_ids.size(-1), 0)
+                        drafts = [
+                            drafter(prefix)[:room] for prefix in input_ids.tolist()
+                        ]
+                    log_probs = self._next_log_probs(
+                        context, context_ids, input_ids, drafts
+                    )
+                    positions = [(k, 0) for k in range(beam_size)]
+                out = torch.stack([log_probs[k, d] for k, d in positions])
+                if tries is not None and tries[i] is not None:
+                    out = out + tries[i].penalty(input_ids[:, 1:], out.size(-1))
                 beam.advance(out)
                 input_ids.data.copy_(
                     input_ids.data.index_select(0, beam.getCurrentOrigin())
                 )
                 input_ids = torch.cat((input_ids, beam.getCurrentState()), -1)
+                # Skip the next decoder pass if every new hypothesis follows a draft
+                new_positions = []
+                origins = beam.getCurrentOrigin().tolist()
+                tokens = beam.getCurrentState().view(-1).tolist()
+                for origin, token in zip(origins, tokens):
+                    k, d = positions[origin]
+                    if drafts is None or d >= len(drafts[k]) or drafts[k][d] != token:
+                        new_positions = None
+                        break
+                    new_positions.append((k, d + 1))
+                positions = new_positions
             hyp = beam.getHyp(beam.getFinal())
-            pred = beam.buildTargetTokens(hyp)[: self.beam_size]
+            pred = beam.buildTargetTokens(hyp)[: beam_size]
             pred = [
                 torch.cat(
                     [x.view(-1) for x in p] + [zero] * (self.max_length - len(p))
@@ -132,16 +206,100 @@ class Seq2Seq(nn.Module):
         return preds
 
 
+class NgramDrafter(object):
+    """
+    Draft proposer for Seq2Seq.generate: the most frequent next token after the
+    last (up to) n - 1 tokens of the targets with the same mask hint
+    """
+
+    def __init__(self, eos_id, n=3, max_draft_len=8):
+        self.eos_id = eos_id
+        self.n = n
+        self.max_draft_len = max_draft_len
+        self.counts = {}  # (hint, context) => {next token: count}
+        self.table = {}  # (hint, context) => the most frequent next token
+
+    def add(self, hint, ids):
+        """Count the n-grams of the target ids (starting with sos)"""
+        for i in range(1, len(ids)):
+            for k in range(1, self.n):
+                key = (hint, tuple(ids[max(0, i - k) : i]))
+                counts = self.counts.setdefault(key, {})
+                counts[ids[i]] = counts.get(ids[i], 0) + 1
+
+    def build(self):
+        self.table = {key: max(c, key=c.get) for key, c in self.counts.items()}
+        self.counts = {}
+        return self
+
+    def draft(self, hint, prefix_ids):
+        """Tokens proposed after prefix_ids, backing off to shorter contexts"""
+        ids, draft = list(prefix_ids), []
+        while len(draft) < self.max_draft_len and draft[-1:] != [self.eos_id]:
+            for k in range(self.n - 1, 0, -1):
+                if (next_id := self.table.get((hint, tuple(ids[-k:])))) is not None:
+                    break
+            else:
+                break
+            ids.append(next_id)
+            draft.append(next_id)
+        return draft
+
+
+class TokenTrie(object):
+    """
+    Trie of token ids for constrained decoding: `sequences` are complete outputs
+    (ending with eos), `prefixes` are prefixes of outputs with free continuations.
+    """
+
+    _OPEN = -1  # Key of the nodes ending a prefix
+
+    def __init__(self, sequences, prefixes=()):
+        self.root = {}
+        for ids in sequences:
+            self._insert(ids)
+        for ids in prefixes:
+            self._insert(ids)[self._OPEN] = {}
+
+    def _insert(self, ids):
+        node = self.root
+        for i in ids:
+            node = node.setdefault(i, {})
+        return node
+
+    def allowed(self, prefix_ids):
+        """Token ids allowed after prefix_ids, None if any is allowed"""
+        node = self.root
+        for i in prefix_ids:
+            if self._OPEN in node or i not in node:
+                return None  # Free continuation (or a hypothesis off the trie)
+            node = node[i]
+        return None if self._OPEN in node else [i for i in node if i != self._OPEN]
+
+    def penalty(self, prefix_ids, vocab_size):
+        """(beam x vocab) 0 for the allowed tokens after each prefix, -1e20 otherwise"""
+        penalty = torch.full(
+            (prefix_ids.size(0), vocab_size), -1e20, device=prefix_ids.device
+        )
+        for k, prefix in enumerate(prefix_ids.tolist()):
+            allowed = self.allowed(prefix)
+            if allowed is None:
+                penalty[k] = 0
+            else:
+                penalty[k, allowed] = 0
+        return penalty
+
+
 class Beam(object):
-    def __init__(self, size, sos, eos):
+    def __init__(self, size, sos, eos, device=None):
         self.size = size
-        self.tt = torch.cuda
+        self.device = device or torch.device("cuda")
         # The score for each translation on the beam.
-        self.scores = self.tt.FloatTensor(size).zero_()
+        self.scores = torch.zeros(size, dtype=torch.float, device=self.device)
         # The backpointers at each time-step.
         self.prevKs = []
         # The outputs at each time-step.
-        self.nextYs = [self.tt.LongTensor(size).fill_(0)]
+        self.nextYs = [torch.zeros(size, dtype=torch.long, device=self.device)]
         self.nextYs[0][0] = sos
         # Has EOS topped the beam yet.
         self._eos = eos
@@ -151,7 +309,7 @@ class Beam(object):
 
     def getCurrentState(self):
         "Get the outputs for the current timestep."
-        batch = self.tt.LongTensor(self.nextYs[-1]).view(-1, 1)
+        batch = self.nextYs[-1].clone().view(-1, 1)
         return batch
 
     def getCurrentOrigin(self):
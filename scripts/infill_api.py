@@ -72,6 +72,22 @@ class ServiceBasedInfillAPI(InfillAPI):
         self.__proc.wait()
         pgrsu._ilog(f"{self.__class__.__name__} is stopped")
 
+    def reload(self, checkpoint: str = None):
+        # Swap the weights of the running service, without restarting it
+        import http
+        import requests
+
+        reload_api = "http://localhost:37654/reload"
+        data = json.dumps({"checkpoint": checkpoint} if checkpoint else {})
+        response = requests.post(reload_api, data=data)
+        if response.status_code != http.HTTPStatus.OK:
+            pgrsu._flog(
+                "Failed to reload the checkpoint",
+                response.text,
+                exp=RuntimeError("Failed to reload the checkpoint"),
+            )
+        pgrsu._ilog(f"{self.__class__.__name__} is reloaded")
+
     def current_num_infill(self) -> int:
         return len(self.__inputs)
 
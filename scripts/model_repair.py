@@ -1,9 +1,12 @@
 import os
 import sys
 import ast
+import json
+import math
 import uuid
 import tqdm
 import time
+import functools
 import multiprocessing
 import subprocess as sp
 import data_utils as du
@@ -11,6 +14,7 @@ import element_mask_actions as actions
 import _rs_utils as pgrsu
 import infill_api as infill
 from typing import Tuple
+from dataclasses import dataclass
 from repo2model_s import _std_keras_usage_style, _set_parent
 
 
@@ -49,7 +53,12 @@ def _fix_sfmodel_code(code: str):
     return code
 
 
-def _semantic_equivalent(a: str, b: str) -> bool:
+@functools.lru_cache(maxsize=65536)  # Per-process memo, shared by all buggy models
+def _std_code(code: str) -> str:
+    return ast.unparse(_std_keras_usage_style(ast.parse(code)))
+
+
+def _semantic_equivalent(a: str, b: str, std_code_fn=_std_code) -> bool:
     """
     _std_keras_usage_style(ast.parse(a)) == _std_keras_usage_style(ast.parse(b))
     """
@@ -61,23 +70,19 @@ def _semantic_equivalent(a: str, b: str) -> bool:
         return True
 
     try:
-        a_ast = ast.parse(a)
-        b_ast = ast.parse(b)
+        std_a = std_code_fn(a)
+        std_b = std_code_fn(b)
     except SyntaxError:
         return False
 
-    std_a_ast = _std_keras_usage_style(a_ast)
-    std_b_ast = _std_keras_usage_style(b_ast)
-    if ast.unparse(std_a_ast) == ast.unparse(std_b_ast):
+    if std_a == std_b:
         return True
 
     # ...
     return False
 
 
-def _try_get_min_bad_change_check_context(
-    model_with_mask: str, mask_pred: str
-) -> ast.expr | ast.stmt:
+def _get_min_bad_change_check_context_template(model_with_mask: str) -> str:
     assert model_with_mask.count("__mask_0__") == 1
     ori_mask_line = next(
         filter(lambda x: "__mask_0__" in x, model_with_mask.splitlines())
@@ -86,18 +91,6 @@ def _try_get_min_bad_change_check_context(
         ast.fix_missing_locations(ast.parse(ori_mask_line.strip()).body[0])
     )
 
-    def _is_cared_context(node: ast.expr | ast.stmt) -> bool:
-        if not node:
-            return False
-        node_code = ast.unparse(node)
-        if node_code.startswith("__root__.keras."):
-            return True
-        if ".compile(" in ast.unparse(node):
-            return True
-        if ".fit(" in ast.unparse(node):
-            return True
-        return False
-
     def impl(node) -> ast.expr | ast.stmt:
         if not node:
             return ori_mask_line_ast
@@ -116,15 +109,35 @@ def _try_get_min_bad_change_check_context(
             ast.walk(ori_mask_line_ast),
         )
     )
-    if _is_cared_context(ast.parse(mask_pred.strip())):
-        ctx = ast.parse(mask_pred.strip())
+    return ast.unparse(ast.fix_missing_locations(impl(mask_0_node)))
+
+
+def _try_get_min_bad_change_check_context(
+    model_with_mask: str, mask_pred: str, context_template: str | None = None
+) -> ast.expr | ast.stmt:
+    def _is_cared_context(node: ast.expr | ast.stmt) -> bool:
+        if not node:
+            return False
+        node_code = ast.unparse(node)
+        if node_code.startswith("__root__.keras."):
+            return True
+        if ".compile(" in node_code:
+            return True
+        if ".fit(" in node_code:
+            return True
+        return False
+
+    mask_pred_ast = ast.parse(mask_pred.strip())
+    if _is_cared_context(mask_pred_ast):
+        ctx = mask_pred_ast
         if isinstance(ctx, ast.Module):
             ctx = ctx.body[0]
         if isinstance(ctx, ast.Expr):
             ctx = ctx.value
         return ctx
-    ctx = ast.fix_missing_locations(impl(mask_0_node))
-    ctx = ast.parse(ast.unparse(ctx).replace("__mask_0__", mask_pred))
+    if context_template is None:
+        context_template = _get_min_bad_change_check_context_template(model_with_mask)
+    ctx = ast.parse(context_template.replace("__mask_0__", mask_pred))
     if isinstance(ctx, ast.Module):
         ctx = ctx.body[0]
     if isinstance(ctx, ast.Expr):
@@ -189,7 +202,7 @@ def _get_input_shape(layer: ast.Call) -> str | None:
 
 
 def _get_output_shape(
-    layer: ast.Call, layer_idx, layer_count, layer_lines
+    layer: ast.Call, layer_idx: int, layer_chain: "_KerasLayerChain"
 ) -> str | None:
     def _get_arg(args, idx) -> ast.AST | None:
         if len(args) > idx:
@@ -210,16 +223,9 @@ def _get_output_shape(
         units = _get_arg(args, 0) or _get_karg(kwargs, "units")
         return ast.unparse(units) if units is not None else None
     if "__root__.keras.layers.Activation" in layer_code and layer_idx > 0:
-        prev_layer = ast.parse(layer_lines[layer_idx - 1].strip())
-        prev_layer = list(filter(_is_keras_layer, ast.walk(prev_layer)))
-        if len(prev_layer) == 1:
-            prev_layer = prev_layer[0]
-            return _get_output_shape(
-                prev_layer,
-                layer_idx - 1,
-                layer_count,
-                layer_lines,
-            )
+        prev_layer = layer_chain.layers[layer_idx - 1].call
+        if prev_layer is not None:
+            return _get_output_shape(prev_layer, layer_idx - 1, layer_chain)
 
     raise ValueError(f"Unprocessed layer: {layer_code}")
 
@@ -263,33 +269,38 @@ def _input_shape_change_is_bad(
     raise NotImplementedError("Should not reach here")
 
 
+def _is_last_keras_layer(layer_idx: int, layer_chain: "_KerasLayerChain") -> bool:
+    # The last one, or followed by an Activation only
+    layer_count = len(layer_chain.layers)
+    if layer_idx == layer_count - 1:
+        return True
+    if (
+        layer_idx == layer_count - 2
+        and "__root__.keras.layers.Activation" in layer_chain.layers[-1].stmt
+    ):
+        return True
+    return False
+
+
 def _output_shape_change_is_bad(
     src_context: ast.Call,
     trg_context: ast.Call,
     layer_idx: int,
-    layer_count: int,
-    layer_lines,
+    layer_chain: "_KerasLayerChain",
 ) -> bool:
     CANNOT_CONFIRM = False
     # print(">>>Call _output_shape_change_is_bad")
 
     def _is_last_layer() -> bool:
-        if layer_idx == layer_count - 1:
-            return True
-        if (
-            layer_idx == layer_count - 2
-            and "__root__.keras.layers.Activation" in layer_lines[-1]
-        ):
-            return True
-        return False
+        return _is_last_keras_layer(layer_idx, layer_chain)
 
     if _is_last_layer():
         try:
             src_output_shape: tuple[int] | None = _get_output_shape(
-                src_context, layer_idx, layer_count, layer_lines
+                src_context, layer_idx, layer_chain
             )
             trg_output_shape: tuple[int] | None = _get_output_shape(
-                trg_context, layer_idx, layer_count, layer_lines
+                trg_context, layer_idx, layer_chain
             )
         except ValueError as ex:
             return CANNOT_CONFIRM
@@ -303,141 +314,619 @@ def _output_shape_change_is_bad(
     return False
 
 
-def _get_masked_layer_idx(model_with_mask: str) -> tuple[int, int]:
+@dataclass
+class _KerasLayer:
+    stmt: str  # The statement adding/calling the layer
+    call: ast.Call | None  # The layer, None if it's not a single layer call
+    input_shape: str | None = None  # Declared by input_dim/input_shape/shape
+    output_shape: str | None = None  # Declared by units (or by the previous layer)
+    block: tuple | None = None  # (id of the parent, field) of the statement
+
+
+@dataclass
+class _KerasLayerChain:
+    layers: list[_KerasLayer]
+    masked_idx: int  # Index of the layer with `__mask_0__`
+
+    @property
+    def layer_lines(self) -> list[str]:
+        return [layer.stmt for layer in self.layers]
+
+    @property
+    def straight_line(self) -> bool:
+        """All layers are in one block, not e.g. in the branches of an if/else"""
+        return len(set(layer.block for layer in self.layers)) == 1
+
+
+def _is_keras_layer_call(node: ast.AST) -> bool:
+    # NOTE: The model has been standardized by _std_keras_usage_style
+    return isinstance(node, ast.Call) and ast.unparse(node.func).startswith(
+        "__root__.keras.layers."
+    )
+
+
+def _iter_simple_stmts_in_order(codeast: ast.AST):
+    """
+    The simple statements in line order (branches and loop bodies are flattened),
+    and the block, i.e. (id of the parent, field), of each of them
+    """
+    stmts, blocks = [], {}
+    for node in ast.walk(codeast):
+        for field, value in ast.iter_fields(node):
+            if not isinstance(value, list):
+                continue
+            for child in value:
+                if isinstance(child, (ast.Assign, ast.AnnAssign, ast.Expr)):
+                    stmts.append(child)
+                    blocks[id(child)] = (id(node), field)
+    return sorted(stmts, key=lambda x: (x.lineno, x.col_offset)), blocks
+
+
+def _get_layer_chain(model_with_mask: str) -> _KerasLayerChain | None:
+    """
+    Walk the model once and extract the chain of keras layers (Sequential or
+    functional style) and the index of the masked layer, None if not found
+    """
+
+    def _make_layer(
+        stmt: ast.AST, call: ast.AST | None, block_stmt: ast.stmt | None = None
+    ) -> _KerasLayer:
+        if not _is_keras_layer_call(call):
+            call = None
+        block = blocks[id(block_stmt or stmt)]
+        layer = _KerasLayer(stmt=ast.unparse(stmt), call=call, block=block)
+        if call is not None and "__mask_0__" not in layer.stmt:
+            try:
+                layer.input_shape = _get_input_shape(call)
+            except ValueError:
+                pass
+        return layer
+
+    def _assigned_name(stmt: ast.stmt) -> str | None:
+        # e.g. `model = ...` or `self.model = ...`
+        if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1:
+            if isinstance(stmt.targets[0], (ast.Name, ast.Attribute)):
+                return ast.unparse(stmt.targets[0])
+        return None
+
+    def _make_chain(layers: list[_KerasLayer]) -> _KerasLayerChain:
+        masked_idx = next(
+            (i for i, l in enumerate(layers) if "__mask_0__" in l.stmt), None
+        )
+        if masked_idx is None or not layers:
+            raise ValueError("Not found")
+        layer_chain = _KerasLayerChain(layers=layers, masked_idx=masked_idx)
+        for i, layer in enumerate(layers):
+            if layer.call is None or "__mask_0__" in layer.stmt:
+                continue
+            try:
+                layer.output_shape = _get_output_shape(layer.call, i, layer_chain)
+            except ValueError:
+                pass
+        return layer_chain
+
     # 1. Sequential style
-    def _try_sequential_style(model_with_mask):
-        lines = map(lambda x: x.strip(), model_with_mask.splitlines())
+    def _try_sequential_style(stmts: list[ast.stmt]) -> _KerasLayerChain:
         sequential_name = None
-        layer_idx = None
-        layer_count = 0
-        layer_lines = []
-        for i, line in enumerate(lines):
-            if "__root__.keras.models.Sequential(" in line:
+        layers = []
+        for stmt in stmts:
+            value = getattr(stmt, "value", None)
+            # {sequential_name} = __root__.keras.models.Sequential([{layers}])
+            if (
+                isinstance(value, ast.Call)
+                and ast.unparse(value.func) == "__root__.keras.models.Sequential"
+            ):
                 if sequential_name:
                     raise ValueError("Multiple Sequential")
-                sequential_name = line.split("=")[0].strip()
-            if sequential_name is not None and line.startswith(
-                f"{sequential_name}.add("
+                if (sequential_name := _assigned_name(stmt)) is None:
+                    raise ValueError("Unknown Sequential")
+                init_layers = value.args[0] if value.args else None
+                if isinstance(init_layers, (ast.List, ast.Tuple)):
+                    layers.extend(_make_layer(e, e, stmt) for e in init_layers.elts)
+            # {sequential_name}.add({layer})
+            elif (
+                sequential_name is not None
+                and isinstance(stmt, ast.Expr)
+                and isinstance(value, ast.Call)
+                and isinstance(value.func, ast.Attribute)
+                and value.func.attr == "add"
+                and ast.unparse(value.func.value) == sequential_name
             ):
-                layer_count += 1
-                layer_lines.append(line)
-                if "__mask_0__" in line:
-                    layer_idx = layer_count - 1
-        if layer_idx is not None and layer_count > 0:
-            return layer_idx, layer_count, layer_lines
-        raise ValueError("Not found")
+                layers.append(_make_layer(stmt, value.args[0] if value.args else None))
+        return _make_chain(layers)
 
     # 2. Functional style
-    def _try_functional_style(model_with_mask):
-        import re
-
-        lines = map(lambda x: x.strip(), model_with_mask.splitlines())
+    def _try_functional_style(stmts: list[ast.stmt]) -> _KerasLayerChain:
         input_layer_name = None
-        ouput_layer_name = None
-        layer_idx = None
-        layer_count = 0
-        layer_lines = []
-        for i, line in enumerate(lines):
-            if "__root__.keras.layers.Input(" in line:
-                if input_layer_name or layer_count != 0:
+        output_layer_name = None
+        layers = []
+        for stmt in stmts:
+            value = getattr(stmt, "value", None)
+            if not isinstance(value, ast.Call):
+                continue
+            # {input_layer_name} = __root__.keras.layers.Input({args})
+            if ast.unparse(value.func) == "__root__.keras.layers.Input":
+                if input_layer_name or layers:
                     raise ValueError("Multiple Input")
-                layer_count = 1
-                layer_lines.append(line)
-                input_layer_name = line.split("=")[0].strip()
-            # {ouput_layer_name} = __root__.keras.layers.{layer}({args})({input_layer_name})
-            if input_layer_name is not None and (
-                match := re.match(
-                    r"(.*) = __root__.keras.layers\.(.+)\((.*)\)\((.*)\)DUMMY",
-                    line.strip() + "DUMMY",
-                )
-            ):
-                l_output_layer_name = match.group(1)
-                l_layer = match.group(2)
-                l_args = match.group(3)
-                l_input_layer_name = match.group(4)
-                if l_input_layer_name == input_layer_name:
-                    if layer_count != 1:
-                        raise ValueError("Multiple Input")
-                    layer_count = 2
-                    layer_lines.append(line)
-                    if "__mask_0__" in line:
-                        layer_idx = 1
-                    ouput_layer_name = l_output_layer_name
-            # {ouput_layer_name} = __root__.keras.layers.{layer}({args})({output_layer_name})
-            if ouput_layer_name is not None and (
-                match := re.match(
-                    r"(.*) = __root__.keras.layers\.(.+)\((.*)\)\((.*)\)DUMMY",
-                    line.strip() + "DUMMY",
-                )
+                if (input_layer_name := _assigned_name(stmt)) is None:
+                    raise ValueError("Unknown Input")
+                layers.append(_make_layer(stmt, value))
+                output_layer_name = input_layer_name
+                continue
+            # {output_layer_name} = __root__.keras.layers.{layer}({args})({input_layer_name})
+            if (
+                output_layer_name is None
+                or (l_output_layer_name := _assigned_name(stmt)) is None
+                or not _is_keras_layer_call(value.func)
+                or len(value.args) != 1
+                or value.keywords
+                or not isinstance(value.args[0], (ast.Name, ast.Attribute))
             ):
-                l_output_layer_name = match.group(1)
-                l_layer = match.group(2)
-                l_args = match.group(3)
-                l_input_layer_name = match.group(4)
-                if l_input_layer_name == ouput_layer_name:
-                    layer_count += 1
-                    layer_lines.append(line)
-                    if "__mask_0__" in line:
-                        layer_idx = layer_count - 1
-                    ouput_layer_name = l_output_layer_name
-        if layer_idx is not None and layer_count > 0:
-            return layer_idx, layer_count, layer_lines
-        raise ValueError("Not found")
-
-    model_with_mask = ast.unparse(ast.parse(model_with_mask))  # format
+                continue
+            l_input_layer_name = ast.unparse(value.args[0])
+            if l_input_layer_name == output_layer_name:
+                layers.append(_make_layer(stmt, value.func))
+                output_layer_name = l_output_layer_name
+                if l_output_layer_name == input_layer_name:
+                    input_layer_name = None  # Rebound, e.g. x = Dense(...)(x)
+            elif l_input_layer_name == input_layer_name:
+                raise ValueError("Multiple Input")  # Not a chain
+        return _make_chain(layers)
+
+    stmts, blocks = _iter_simple_stmts_in_order(ast.parse(model_with_mask))
 
     try:
-        return _try_sequential_style(model_with_mask)
+        return _try_sequential_style(stmts)
     except ValueError:
         pass
 
     try:
-        return _try_functional_style(model_with_mask)
+        return _try_functional_style(stmts)
     except ValueError:
         pass
 
-    return None, None, None
+    return None
+
+
+class _ShapeError(Exception):
+    pass
 
 
-def _is_bad_change_impl(model_with_mask: str, mask_src: str, mask_trg: str) -> bool:
+# Shape (without the batch dim) of a layer: tuple of int | None, or None if unknown
+_Shape = tuple | None
+
+_IDENTITY_SHAPE_LAYERS = {
+    "Activation", "Dropout", "AlphaDropout", "GaussianDropout", "GaussianNoise",
+    "SpatialDropout1D", "SpatialDropout2D", "SpatialDropout3D",
+    "BatchNormalization", "LayerNormalization", "ActivityRegularization",
+    "LeakyReLU", "PReLU", "ELU", "ReLU", "ThresholdedReLU", "Softmax", "Masking",
+}  # fmt: skip
+_RNN_LAYERS = {"SimpleRNN", "LSTM", "GRU", "CuDNNLSTM", "CuDNNGRU"}
+_CONV_LAYERS = {"Conv1D": 1, "Conv2D": 2, "Conv3D": 3}
+_CONV_LAYERS |= {f"Convolution{n}D": n for n in _CONV_LAYERS.values()}
+_POOLING_LAYERS = {
+    f"{kind}{n}D": n
+    for n in (1, 2, 3)
+    for kind in ("MaxPooling", "AveragePooling", "MaxPool", "AvgPool")
+}
+_GLOBAL_POOLING_LAYERS = {
+    f"Global{kind}{n}D": n
+    for n in (1, 2, 3)
+    for kind in ("MaxPooling", "AveragePooling", "MaxPool", "AvgPool")
+}
+
+
+def _get_layer_name(layer: ast.Call) -> str:
+    return ast.unparse(layer.func)[len("__root__.keras.layers.") :]
+
+
+def _get_layer_arg(layer: ast.Call, idx: int | None, key: str, default=None):
+    """
+    Literal value of the arg (positional idx or keyword key), raises KeyError if
+    the arg is not a literal
+    """
+    node = None
+    if idx is not None and len(layer.args) > idx:
+        node = layer.args[idx]
+    for kw in layer.keywords:
+        if kw.arg == key:
+            node = kw.value
+    if node is None:
+        return default
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise KeyError(key)
+
+
+def _as_shape(value) -> _Shape:
+    if isinstance(value, int):
+        return (value,)
+    if isinstance(value, (list, tuple)) and all(
+        v is None or isinstance(v, int) for v in value
+    ):
+        return tuple(value)
+    raise KeyError("shape")
+
+
+def _get_declared_input_shape(layer: ast.Call) -> _Shape:
+    """The input shape declared by the (first) layer, None if not declared"""
+    name = _get_layer_name(layer)
+    if name == "Input" or name == "InputLayer":
+        shape = _get_layer_arg(layer, 0, "shape")
+        if shape is None and name == "InputLayer":
+            shape = _get_layer_arg(layer, None, "input_shape")
+        return _as_shape(shape) if shape is not None else None
+    if name == "Embedding":  # input_dim is the vocabulary size of Embedding
+        input_length = _get_layer_arg(layer, None, "input_length")
+        if input_length is not None:
+            return _as_shape(input_length)
+    else:
+        input_dim = _get_layer_arg(layer, None, "input_dim")
+        if input_dim is not None:
+            return _as_shape(input_dim)
+    if (input_shape := _get_layer_arg(layer, None, "input_shape")) is not None:
+        return _as_shape(input_shape)
+    if (batch_input_shape := _get_layer_arg(layer, None, "batch_input_shape")) is not None:
+        return _as_shape(batch_input_shape)[1:]
+    return None
+
+
+def _infer_output_shape(layer: ast.Call, shape: tuple) -> _Shape:
+    """
+    Output shape of the layer for the input shape, None if unknown (unsupported
+    layer or non-literal args), raises _ShapeError if the shapes can't compose
+    """
+
+    def _check_rank(rank: int):
+        if len(shape) != rank:
+            raise _ShapeError(f"{name} expects rank {rank} input, got {shape}")
+
+    def _n_tuple(value, n: int) -> tuple:
+        value = (value,) * n if isinstance(value, int) else tuple(value)
+        if len(value) != n or not all(isinstance(v, int) and v > 0 for v in value):
+            raise KeyError(name)
+        return value
+
+    def _spatial_out(size, window, stride, dilation, padding) -> int | None:
+        if size is None:
+            return None
+        if padding == "same":
+            out = -(-size // stride)
+        elif padding == "valid":
+            out = (size - (window - 1) * dilation - 1) // stride + 1
+        elif padding == "causal":
+            out = size
+        else:
+            raise KeyError(padding)
+        if out <= 0:
+            raise _ShapeError(f"{name} makes a non-positive dim from {shape}")
+        return out
+
+    name = _get_layer_name(layer)
+    try:
+        if name in ("Input", "InputLayer"):
+            return shape
+        if name in _IDENTITY_SHAPE_LAYERS:
+            return shape
+        if name == "Dense":
+            units = _get_layer_arg(layer, 0, "units")
+            if len(shape) < 1:
+                raise _ShapeError(f"Dense expects rank >= 1 input, got {shape}")
+            return shape[:-1] + (units,) if isinstance(units, int) else None
+        if name == "Flatten":
+            if len(shape) < 1:
+                raise _ShapeError(f"Flatten expects rank >= 1 input, got {shape}")
+            if any(d is None for d in shape):
+                return (None,)
+            return (math.prod(shape),)
+        if name == "Reshape":
+            target_shape = _as_shape(_get_layer_arg(layer, 0, "target_shape"))
+            if any(d is None for d in shape) or target_shape.count(-1) > 1:
+                return None
+            size = math.prod(shape)
+            known_size = math.prod(d for d in target_shape if d != -1)
+            if -1 in target_shape:
+                if known_size == 0 or size % known_size != 0:
+                    raise _ShapeError(f"Cannot reshape {shape} to {target_shape}")
+                return tuple(d if d != -1 else size // known_size for d in target_shape)
+            if known_size != size:
+                raise _ShapeError(f"Cannot reshape {shape} to {target_shape}")
+            return target_shape
+        if name in _CONV_LAYERS:
+            n = _CONV_LAYERS[name]
+            if _get_layer_arg(layer, None, "data_format", "channels_last") != "channels_last":
+                return None
+            _check_rank(n + 1)
+            filters = _get_layer_arg(layer, 0, "filters")
+            kernel_size = _n_tuple(_get_layer_arg(layer, 1, "kernel_size"), n)
+            strides = _n_tuple(_get_layer_arg(layer, 2, "strides", 1), n)
+            padding = _get_layer_arg(layer, 3, "padding", "valid")
+            dilation = _n_tuple(_get_layer_arg(layer, None, "dilation_rate", 1), n)
+            spatial = tuple(
+                _spatial_out(shape[i], kernel_size[i], strides[i], dilation[i], padding)
+                for i in range(n)
+            )
+            return spatial + (filters if isinstance(filters, int) else None,)
+        if name in _POOLING_LAYERS:
+            n = _POOLING_LAYERS[name]
+            if _get_layer_arg(layer, None, "data_format", "channels_last") != "channels_last":
+                return None
+            _check_rank(n + 1)
+            pool_size = _n_tuple(_get_layer_arg(layer, 0, "pool_size", 2), n)
+            strides = _get_layer_arg(layer, 1, "strides", None)
+            strides = _n_tuple(strides, n) if strides is not None else pool_size
+            padding = _get_layer_arg(layer, 2, "padding", "valid")
+            spatial = tuple(
+                _spatial_out(shape[i], pool_size[i], strides[i], 1, padding)
+                for i in range(n)
+            )
+            return spatial + (shape[-1],)
+        if name in _GLOBAL_POOLING_LAYERS:
+            if _get_layer_arg(layer, None, "data_format", "channels_last") != "channels_last":
+                return None
+            _check_rank(_GLOBAL_POOLING_LAYERS[name] + 1)
+            return (shape[-1],)
+        if name in _RNN_LAYERS:
+            _check_rank(2)
+            units = _get_layer_arg(layer, 0, "units")
+            units = units if isinstance(units, int) else None
+            if _get_layer_arg(layer, None, "return_sequences", False):
+                return (shape[0], units)
+            return (units,)
+        if name == "Embedding":
+            output_dim = _get_layer_arg(layer, 1, "output_dim")
+            return shape + (output_dim if isinstance(output_dim, int) else None,)
+    except KeyError:  # Non-literal args
+        return None
+    return None  # Unsupported layer
+
+
+def _propagate_shapes(layers: list[ast.Call | None]) -> _Shape:
+    """
+    Propagate the input shape declared by the first layer through the chain,
+    returns the output shape of the last layer, None if it can't be inferred,
+    raises _ShapeError if the shapes of the layers can't compose
+    """
+    if not layers or layers[0] is None:
+        return None
+    try:
+        shape = _get_declared_input_shape(layers[0])
+    except KeyError:
+        return None
+    for layer in layers:
+        if shape is None or layer is None:
+            return None
+        shape = _infer_output_shape(layer, shape)
+    return shape
+
+
+class _MaskedModelInfo:
+    """Parsing/normalizing results of a `model_with_mask`, shared by all its predictions"""
+
+    def __init__(self, model_with_mask: str, std_model_with_mask: str):
+        assert "__mask_0__" in model_with_mask
+        self.model_with_mask = model_with_mask
+        self.std_model_with_mask = std_model_with_mask
+        self.__context_template = None
+        self.__layer_chain = None
+        self.__layer_chain_done = False
+        self.__propagated_shapes = {}  # masked layer => output shape | _ShapeError
+
+    @property
+    def context_template(self) -> str:
+        if self.__context_template is None:
+            self.__context_template = _get_min_bad_change_check_context_template(
+                self.std_model_with_mask
+            )
+        return self.__context_template
+
+    @property
+    def layer_chain(self) -> _KerasLayerChain | None:
+        if not self.__layer_chain_done:
+            self.__layer_chain = _get_layer_chain(self.std_model_with_mask)
+            self.__layer_chain_done = True
+        return self.__layer_chain
+
+    def propagate_shapes(self, masked_layer: ast.Call) -> _Shape:
+        """
+        _propagate_shapes over the layer chain with the masked layer filled in, None
+        if the layers are not in one straight-line block
+        """
+        assert self.layer_chain is not None
+        if not self.layer_chain.straight_line:
+            return None  # The layers may not be composed one after another
+        key = ast.unparse(masked_layer)
+        if key not in self.__propagated_shapes:
+            layers = [l.call for l in self.layer_chain.layers]
+            layers[self.layer_chain.masked_idx] = masked_layer
+            try:
+                self.__propagated_shapes[key] = _propagate_shapes(layers)
+            except _ShapeError as e:
+                self.__propagated_shapes[key] = e
+        if isinstance(ret := self.__propagated_shapes[key], _ShapeError):
+            raise ret
+        return ret
+
+
+class _FilterEngine:
+    """
+    Caches used by `filter_possible_repaired_models`, the whole `model_with_mask`
+    is parsed and normalized once, then only the mask fragments are processed
+    for each candidate.
+    """
+
+    def __init__(self):
+        self.__std_codes: dict[str, str | None] = {}  # None for syntax error
+        self.__masked_models: dict[str, _MaskedModelInfo] = {}
+
+    def std_code(self, code: str) -> str:
+        if code not in self.__std_codes:
+            try:
+                self.__std_codes[code] = _std_code(code)
+            except SyntaxError:
+                self.__std_codes[code] = None
+        std_code = self.__std_codes[code]
+        if std_code is None:
+            raise SyntaxError(f"Invalid code: {code}")
+        return std_code
+
+    def masked_model(self, model_with_mask: str) -> _MaskedModelInfo:
+        if model_with_mask not in self.__masked_models:
+            self.__masked_models[model_with_mask] = _MaskedModelInfo(
+                model_with_mask, self.std_code(model_with_mask)
+            )
+        return self.__masked_models[model_with_mask]
+
+
+def _shape_propagation_is_bad(
+    src_context: ast.Call, trg_context: ast.Call, masked_model: _MaskedModelInfo
+) -> bool:
+    """
+    Bad if the shapes of the layers of the buggy model compose while the shapes
+    of the patched ones don't, or the masked layer is the last one and the final
+    dim of its output changes (the buggy output shape is taken as the label shape
+    only then, as by _output_shape_change_is_bad)
+    """
+    CANNOT_CONFIRM = False
+
+    try:
+        src_output_shape = masked_model.propagate_shapes(src_context)
+    except _ShapeError:
+        return CANNOT_CONFIRM  # The bug may be the shape, nothing to compare
+    try:
+        trg_output_shape = masked_model.propagate_shapes(trg_context)
+    except _ShapeError:
+        return True
+    if src_output_shape is None or trg_output_shape is None:
+        return CANNOT_CONFIRM
+    # A wrong output rank of the buggy model may be the bug, e.g. a missing Flatten
+    if len(src_output_shape) != len(trg_output_shape) or not src_output_shape:
+        return CANNOT_CONFIRM
+    if not _is_last_keras_layer(masked_model.layer_chain.masked_idx, masked_model.layer_chain):
+        return CANNOT_CONFIRM
+    s, t = src_output_shape[-1], trg_output_shape[-1]  # Compare the known dims only
+    return s is not None and t is not None and s != t
+
+
+def _is_bad_change_impl(
+    model_with_mask: str,
+    mask_src: str,
+    mask_trg: str,
+    engine: _FilterEngine | None = None,
+) -> bool:
     assert "__mask_0__" in model_with_mask
 
     # print("----------------------------------------------")
 
-    model_with_mask = ast.unparse(_std_keras_usage_style(ast.parse(model_with_mask)))
-    mask_src = ast.unparse(_std_keras_usage_style(ast.parse(mask_src)))
-    mask_trg = ast.unparse(_std_keras_usage_style(ast.parse(mask_trg)))
-    src_context = _try_get_min_bad_change_check_context(model_with_mask, mask_src)
-    trg_context = _try_get_min_bad_change_check_context(model_with_mask, mask_trg)
+    engine = engine or _FilterEngine()
+    masked_model = engine.masked_model(model_with_mask)
+    model_with_mask = masked_model.std_model_with_mask
+    mask_src = engine.std_code(mask_src)
+    mask_trg = engine.std_code(mask_trg)
+    src_context = _try_get_min_bad_change_check_context(
+        model_with_mask, mask_src, masked_model.context_template
+    )
+    trg_context = _try_get_min_bad_change_check_context(
+        model_with_mask, mask_trg, masked_model.context_template
+    )
 
     if _is_keras_layer(src_context) and _is_keras_layer(trg_context):
-        layer_idx, layer_count, layer_lines = _get_masked_layer_idx(model_with_mask)
+        layer_chain = masked_model.layer_chain
+        if layer_chain is None:
+            return False  # Not confirmed
+        layer_idx, layer_count = layer_chain.masked_idx, len(layer_chain.layers)
         # print(">>>layer_idx:", layer_idx)
         # print(">>>layer_count:", layer_count)
-        if layer_idx is None or layer_count is None:
-            return False  # Not confirmed
         # 1. Check the change of the input shape of the layer
         if _input_shape_change_is_bad(src_context, trg_context, layer_idx, layer_count):
             # print(">>>input_shape_change_is_bad")
             return True
         # 2. Check the change of the output shape of the layer if the layer is the last layer
-        if _output_shape_change_is_bad(
-            src_context, trg_context, layer_idx, layer_count, layer_lines
-        ):
+        if _output_shape_change_is_bad(src_context, trg_context, layer_idx, layer_chain):
             # print(">>>output_shape_change_is_bad")
             return True
+        # 3. Check the shapes of the whole layer chain
+        if _shape_propagation_is_bad(src_context, trg_context, masked_model):
+            # print(">>>shape_propagation_is_bad")
+            return True
 
     return False  # Not confirmed
 
 
-def _is_bad_change(model_with_mask: str, mask_src: str, mask_trg: str) -> bool:
+def _is_bad_change(
+    model_with_mask: str,
+    mask_src: str,
+    mask_trg: str,
+    engine: _FilterEngine | None = None,
+) -> bool:
     try:
-        return _is_bad_change_impl(model_with_mask, mask_src, mask_trg)
+        return _is_bad_change_impl(model_with_mask, mask_src, mask_trg, engine)
     except Exception as e:
         pgrsu._wlog(f"Call _is_bad_change failed: {e}")
         return False
 
 
+# (model_with_mask, mask_src, mask_trg, is bad change), run by _check_bad_change_filter
+_BAD_CHANGE_FILTER_CASES = [
+    # A missing Flatten: the buggy output rank is not the label rank, keep the fix
+    (
+        "model = __root__.keras.models.Sequential()\n"
+        "model.add(__root__.keras.layers.Conv2D(32, (3, 3), input_shape=(28, 28, 1)))\n"
+        "model.add(__root__.keras.layers.MaxPooling2D())\n"
+        "model.add(__mask_0__)\n"
+        "model.add(__root__.keras.layers.Dense(10))\n",
+        "__root__.keras.layers.Dense(64)",
+        "__root__.keras.layers.Flatten()",
+        False,
+    ),
+    # The units of the last layer (of self.model) are the label shape
+    (
+        "self.model = __root__.keras.models.Sequential()\n"
+        "self.model.add(__root__.keras.layers.Dense(64, input_dim=20))\n"
+        "self.model.add(__root__.keras.layers.Dense(__mask_0__, activation='softmax'))\n",
+        "10",
+        "5",
+        True,
+    ),
+    # The layers in the branches of an if/else are not composed one after another
+    (
+        "model = __root__.keras.models.Sequential()\n"
+        "if big:\n"
+        "    model.add(__root__.keras.layers.Conv1D(32, __mask_0__, input_shape=(5, 4)))\n"
+        "else:\n"
+        "    model.add(__root__.keras.layers.Conv1D(32, 3, input_shape=(5, 4)))\n"
+        "model.add(__root__.keras.layers.Flatten())\n"
+        "model.add(__root__.keras.layers.Dense(2, activation='softmax'))\n",
+        "1",
+        "5",
+        False,
+    ),
+    # The shapes of the patched layers can't compose
+    (
+        "model = __root__.keras.models.Sequential()\n"
+        "model.add(__root__.keras.layers.Conv1D(32, __mask_0__, input_shape=(5, 4)))\n"
+        "model.add(__root__.keras.layers.Conv1D(32, 3))\n"
+        "model.add(__root__.keras.layers.Flatten())\n"
+        "model.add(__root__.keras.layers.Dense(2, activation='softmax'))\n",
+        "1",
+        "5",
+        True,
+    ),
+]
+
+
+def _check_bad_change_filter():
+    """
+    Regression check of the bad change filter, e.g.
+    `cd scripts && python -c "import model_repair; model_repair._check_bad_change_filter()"`
+    """
+    for model_with_mask, mask_src, mask_trg, expected in _BAD_CHANGE_FILTER_CASES:
+        is_bad = _is_bad_change_impl(model_with_mask, mask_src, mask_trg)
+        assert is_bad == expected, f"{mask_src} -> {mask_trg}: {is_bad}\n{model_with_mask}"
+    pgrsu._ilog(f"Bad change filter: {len(_BAD_CHANGE_FILTER_CASES)} cases passed")
+
+
 def train_sfmodels(
     sfmodel_dirs: list[str | None],
     train_sfmodel_path: str,
@@ -502,8 +991,9 @@ def generate_masked_buggy_models(
     model_src: str, actions: list[actions.MaskAction]
 ) -> list[str, str]:  # (code with mask, mask ori)
     masked_buggy_models = []
+    site_index = du.MaskSiteIndex(model_src)  # One parse and walk for all actions
     for a in actions:
-        masked_buggy_models.extend(a.generate_masked_models(model_src))
+        masked_buggy_models.extend(a.generate_masked_models(model_src, site_index))
     return masked_buggy_models
 
 
@@ -578,6 +1068,7 @@ def filter_possible_repaired_models(
     enable_bad_change_filter=True,
 ) -> list[str]:
     formated_original_buggy_model = ast.unparse(ast.parse(original_buggy_model)).strip()
+    engine = _FilterEngine()  # Shared by all candidates of the buggy model
     filtered_possible_repaired_models = []
     assert len(possible_repaired_models) == len(masked_buggy_models)
     for i, (model_with_mask, mask_pred) in enumerate(possible_repaired_models):
@@ -597,19 +1088,97 @@ def filter_possible_repaired_models(
         if enable_api_usage_filter:
             mask_ori = masked_buggy_models[i][1]
             assert mask_ori != mask_pred
-            if _semantic_equivalent(mask_ori, mask_pred):
+            if _semantic_equivalent(mask_ori, mask_pred, engine.std_code):
                 continue
         # Skip the model that can't be trained (some of
         if enable_bad_change_filter:
             mask_ori = masked_buggy_models[i][1]
             assert mask_ori != mask_pred
-            if _is_bad_change(model_with_mask, mask_ori, mask_pred):
+            if _is_bad_change(model_with_mask, mask_ori, mask_pred, engine):
                 continue
 
         filtered_possible_repaired_models.append(model)
     return filtered_possible_repaired_models
 
 
+# Dedupe the `filtered possible repaired models` by canonical form |=> `deduped ...`
+def dedupe_possible_repaired_models(
+    possible_repaired_models: list[str],
+) -> tuple[list[str], list[list[int]]]:  # (deduped models, dup ranks)
+    """
+    Keep the highest-ranked (first) occurrence of each canonical form, dup ranks
+    [j] are the indexes of deduped models[j] in the input, the first is itself
+    """
+
+    def _canonical_form(model: str) -> str:
+        try:  # NOTE: Not memoized by _std_code, the whole program is rarely shared
+            return ast.unparse(_std_keras_usage_style(ast.parse(model)))
+        except SyntaxError:
+            return model.strip()
+
+    deduped_models = []
+    dup_ranks = []
+    canonical_form_to_j = {}  # canonical form => index in deduped_models
+    for i, model in enumerate(possible_repaired_models):
+        canonical_form = _canonical_form(model)
+        if (j := canonical_form_to_j.get(canonical_form, None)) is not None:
+            dup_ranks[j].append(i)
+            continue
+        canonical_form_to_j[canonical_form] = len(deduped_models)
+        deduped_models.append(model)
+        dup_ranks.append([i])
+    return deduped_models, dup_ranks
+
+
+def _filter_buggy_model_task(args) -> tuple[str | None, int]:
+    """
+    Run op 3 for one buggy model, returns the skipped model file (or None) and the
+    duration (nano) of the task, which is timed here since it runs in a worker
+
+    NOTE: Module level to be picklable for the process pool of op 3
+    """
+    task_start_ns = time.time_ns()
+    model_file, m_out_dir, filter_kwargs, enable_dedup_filter = args
+    filtered_possible_repaired_models_jf = os.path.join(
+        m_out_dir, "filtered_possible_repaired_models.json"
+    )
+    dup_ranks_jf = os.path.join(
+        m_out_dir, "filtered_possible_repaired_models-dup_ranks.json"
+    )
+    _3_time_cost_jf = os.path.join(m_out_dir, "_3_time_cost.json")
+    if os.path.exists(filtered_possible_repaired_models_jf):
+        return model_file, time.time_ns() - task_start_ns
+    with open(model_file, "r", encoding="UTF-8") as f:
+        model_src = f.read()
+    with open(
+        os.path.join(m_out_dir, "masked_buggy_models.json"), "r", encoding="UTF-8"
+    ) as f:
+        masked_buggy_models = json.load(f)
+    with open(
+        os.path.join(m_out_dir, "possible_repaired_models.json"), "r", encoding="UTF-8"
+    ) as f:
+        possible_repaired_models = json.load(f)
+    start_time = time.time()
+    filtered_possible_repaired_models = filter_possible_repaired_models(
+        possible_repaired_models, masked_buggy_models, model_src, **filter_kwargs
+    )
+    if enable_dedup_filter:
+        filtered_possible_repaired_models, dup_ranks = dedupe_possible_repaired_models(
+            filtered_possible_repaired_models
+        )
+    time_cost = time.time() - start_time
+    with open(filtered_possible_repaired_models_jf, "w", encoding="UTF-8") as fp:
+        json.dump(filtered_possible_repaired_models, fp)
+    if enable_dedup_filter:  # Used to fan results back out to all ranks
+        with open(dup_ranks_jf, "w", encoding="UTF-8") as fp:
+            json.dump(dup_ranks, fp)
+    elif os.path.exists(dup_ranks_jf):
+        os.remove(dup_ranks_jf)
+    with open(_3_time_cost_jf, "w", encoding="UTF-8") as fp:
+        json.dump({"time_cost": time_cost}, fp)
+    return None, time.time_ns() - task_start_ns
+
+
 # Construct trainable sfmodel for each `filtered possible repaired models` |=> `trainable sfmodels`
 ## Reused by `buggy-models-to-sfmodel`
 def construct_trainable_sfmodel(
@@ -753,7 +1322,9 @@ Cmd Args:
     18. `disable-api-usage-filter`: optional, default False
     19. `disable-bad-change-filter`: optional, default False
     20. `disable-early-stop`: optional, default False
-    21. `model-valid-num-workers`: optional, default 1"""
+    21. `model-valid-num-workers`: optional, default 1
+    22. `filter-num-workers`: optional, default 1 (0 for all cores), used by 3
+    23. `disable-dedup-filter`: optional, default False"""
 
     # fmt: off
     parser = argparse.ArgumentParser(description=doc)
@@ -773,9 +1344,11 @@ Cmd Args:
     parser.add_argument("--disable-eq-filter", action="store_true", default=False)
     parser.add_argument("--disable-api-usage-filter", action="store_true", default=False)
     parser.add_argument("--disable-bad-change-filter", action="store_true", default=False)
+    parser.add_argument("--disable-dedup-filter", action="store_true", default=False)
 
     parser.add_argument("--disable-early-stop", action="store_true", default=False)
     parser.add_argument("--model-valid-num-workers", type=int, default=1)
+    parser.add_argument("--filter-num-workers", type=int, default=1)
 
     args = parser.parse_args()
     pgrsu._plog("Cmd Args", vars(args))
@@ -795,8 +1368,10 @@ Cmd Args:
     enable_eq_filter = not args.disable_eq_filter
     enable_api_usage_filter = not args.disable_api_usage_filter
     enable_bad_change_filter = not args.disable_bad_change_filter
+    enable_dedup_filter = not args.disable_dedup_filter
     enable_early_stop = not args.disable_early_stop
     model_valid_num_workers = args.model_valid_num_workers
+    filter_num_workers = args.filter_num_workers or os.cpu_count()
     assert os.path.isdir(buggy_models_dir)
     # assert os.path.isdir(correct_models_dir)
     assert os.path.isdir(train_work_dir)
@@ -1010,48 +1585,35 @@ Cmd Args:
     # 3. Filter the `possible repaired models` by static check
     if "3" in ops:
         print("Filtering the `possible repaired models` by static check...")
-        for model_file, m_out_dir in pgrsu._tcfor(
-            tqdm.tqdm(zip(model_files, model_out_dirs), total=len(model_files)),
-            tag_maker=lambda x: ("3", x[0]),
-        ):
-            filtered_possible_repaired_models_jf = os.path.join(
-                m_out_dir, "filtered_possible_repaired_models.json"
-            )
-            _3_time_cost_jf = os.path.join(m_out_dir, "_3_time_cost.json")
-            if os.path.exists(filtered_possible_repaired_models_jf):
-                pgrsu._wlog(f"Already filtered, skip: {model_file}")
-                continue
-            with open(model_file, "r", encoding="UTF-8") as f:
-                model_src = f.read()
-            with open(
-                os.path.join(m_out_dir, "masked_buggy_models.json"),
-                "r",
-                encoding="UTF-8",
-            ) as f:
-                masked_buggy_models = json.load(f)
-            with open(
-                os.path.join(m_out_dir, "possible_repaired_models.json"),
-                "r",
-                encoding="UTF-8",
-            ) as f:
-                possible_repaired_models = json.load(f)
-            start_time = time.time()
-            filtered_possible_repaired_models = filter_possible_repaired_models(
-                possible_repaired_models,
-                masked_buggy_models,
-                model_src,
-                enable_syntax_error_filter=enable_syntax_error_filter,
-                enable_eq_filter=enable_eq_filter,
-                enable_api_usage_filter=enable_api_usage_filter,
-                enable_bad_change_filter=enable_bad_change_filter,
-            )
-            time_cost = time.time() - start_time
-            with open(
-                filtered_possible_repaired_models_jf, "w", encoding="UTF-8"
-            ) as fp:
-                json.dump(filtered_possible_repaired_models, fp)
-            with open(_3_time_cost_jf, "w", encoding="UTF-8") as fp:
-                json.dump({"time_cost": time_cost}, fp)
+        filter_kwargs = {
+            "enable_syntax_error_filter": enable_syntax_error_filter,
+            "enable_eq_filter": enable_eq_filter,
+            "enable_api_usage_filter": enable_api_usage_filter,
+            "enable_bad_change_filter": enable_bad_change_filter,
+        }
+        filter_tasks = [
+            (model_file, m_out_dir, filter_kwargs, enable_dedup_filter)
+            for model_file, m_out_dir in zip(model_files, model_out_dirs)
+        ]
+        # One buggy model per task, imap keeps the order of the tasks
+        filter_pool = None
+        if filter_num_workers > 1:
+            filter_pool = multiprocessing.Pool(filter_num_workers)
+            filter_results = filter_pool.imap(_filter_buggy_model_task, filter_tasks)
+        else:
+            filter_results = map(_filter_buggy_model_task, filter_tasks)
+        try:
+            # Tasks are timed by themselves, _tcfor would only time this loop body
+            for model_file, (skipped_model_file, duration) in tqdm.tqdm(
+                zip(model_files, filter_results), total=len(model_files)
+            ):
+                pgrsu.TimeCounter.add_result(duration, "3", model_file)
+                if skipped_model_file is not None:
+                    pgrsu._wlog(f"Already filtered, skip: {model_file}")
+        finally:
+            if filter_pool is not None:
+                filter_pool.close()
+                filter_pool.join()
 
     # stat-3. Stat the num of `filtered possible repaired models`
     if "stat-3" in ops or "3" in ops:
@@ -1103,6 +1665,14 @@ Cmd Args:
             ) as f:
                 correct_model = f.read()
 
+            dup_ranks_jf = os.path.join(
+                m_out_dir, "filtered_possible_repaired_models-dup_ranks.json"
+            )
+            dup_ranks = None  # Fan the deduped ranks back out
+            if os.path.exists(dup_ranks_jf):
+                with open(dup_ranks_jf, "r", encoding="UTF-8") as f:
+                    dup_ranks = json.load(f)
+
             for i, filtered_possible_repaired_model in enumerate(
                 filtered_possible_repaired_models,
                 start=1,
@@ -1110,7 +1680,8 @@ Cmd Args:
                 if _semantic_equivalent(
                     filtered_possible_repaired_model, correct_model
                 ):
-                    rank_stat.append((model_file, i))
+                    rank = dup_ranks[i - 1][0] + 1 if dup_ranks else i
+                    rank_stat.append((model_file, rank))
                     break
             else:
                 rank_stat.append((model_file, -1))
@@ -6,7 +6,9 @@ import ast
 import glob
 import json
 import pickle
+import hashlib
 import argparse
+import collections
 
 
 try:
@@ -319,9 +321,114 @@ class ImportedModule:
         return cls(fullname, module, symbol_map)
 
 
+class ModuleIndex:
+    """
+    Where the modules are (dotted name => file, of each import root) and what they
+    are (file => parsed module), shared by the ModuleTable(s) of all programs of a
+    process and optionally saved to a file, so that the modules shared by many
+    programs (e.g. the utils of a repository) are searched and parsed once
+    """
+    def __init__(self, filename: str | None = None) -> None:
+        self.filename = filename
+        self.__files = {}  # (root, fullname) => file | ((dir, mtime_ns), ...) of a miss
+        self.__parsed = {}  # file => (mtime_ns, size, digest, pickled ast.Module | None)
+        self.__dirty = False
+        if filename and os.path.isfile(filename):
+            try:
+                with open(filename, 'rb') as fp:
+                    self.__parsed = pickle.load(fp)
+                assert isinstance(self.__parsed, dict)
+            except Exception:  # Broken or of another version, rebuild it
+                self.__parsed = {}
+
+    @staticmethod
+    def __stamp(path: str) -> int | None:
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def __find_file(self, root: str, module_name: str) -> str | None:
+        # A found file is checked again, a miss is kept with the mtimes of the dirs where the module would be
+        # added (the deepest existing one of its parent dirs, and its package dir if any), so that a module
+        # added (or removed) later is found (or not) by the next lookup
+        key = (root, module_name)
+        if (entry := self.__files.get(key)) is not None:
+            if isinstance(entry, str):
+                if os.path.isfile(entry):
+                    return entry
+            elif all(self.__stamp(d) == mtime for d, mtime in entry):
+                return None
+        module_relpath = '/'.join(module_name.split('.'))
+        if os.path.isfile(mpy := f'{root}/{module_relpath}.py'):
+            self.__files[key] = mpy
+        elif os.path.isdir(mdir := f'{root}/{module_relpath}') and \
+                os.path.isfile(mpy := f'{mdir}/__init__.py'):
+            self.__files[key] = mpy
+        else:
+            parent = os.path.dirname(f'{root}/{module_relpath}')
+            while not os.path.isdir(parent) and parent != os.path.dirname(parent):
+                parent = os.path.dirname(parent)
+            dirs = [parent, mdir] if os.path.isdir(mdir) else [parent]
+            self.__files[key] = tuple((d, self.__stamp(d)) for d in dirs)
+            return None
+        return self.__files[key]
+
+    def __parse(self, mpy: str) -> ast.Module | None:
+        # A new ast.Module for each call (the callers change it), None if unparsable
+        try:
+            st = os.stat(mpy)
+        except FileNotFoundError:
+            return None
+        entry = self.__parsed.get(mpy)
+        if entry is None or entry[:2] != (st.st_mtime_ns, st.st_size):
+            try:
+                with open(mpy, 'rb') as fp:
+                    data = fp.read()
+            except FileNotFoundError:
+                return None
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            if entry is not None and entry[2] == digest:  # Touched only
+                entry = (st.st_mtime_ns, st.st_size, digest, entry[3])
+            else:
+                try:
+                    module = pickle.dumps(ast.parse(data.decode('UTF-8')), protocol=pickle.HIGHEST_PROTOCOL)
+                except (UnicodeDecodeError, SyntaxError):
+                    module = None
+                entry = (st.st_mtime_ns, st.st_size, digest, module)
+            self.__parsed[mpy] = entry
+            self.__dirty = True
+        return pickle.loads(entry[3]) if entry[3] is not None else None
+
+    def find_module(self, roots: list, module_name: str) -> ast.Module | None:
+        for root in roots:
+            if (mpy := self.__find_file(root, module_name)) and (module := self.__parse(mpy)):
+                return module
+        return None
+
+    def save(self):
+        if not (self.filename and self.__dirty):
+            return
+        tmp_filename = f'{self.filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'wb') as fp:
+            pickle.dump(self.__parsed, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, self.filename)  # Atomic, the last writer wins
+        self.__dirty = False
+
+
+_glb_module_index = ModuleIndex()
+def _get_module_index(filename: str | None = None) -> ModuleIndex:
+    global _glb_module_index
+    if _glb_module_index.filename != filename:
+        _glb_module_index.save()
+        _glb_module_index = ModuleIndex(filename)
+    return _glb_module_index
+
+
 class ModuleTable:
-    def __init__(self, roots: list) -> None:
+    def __init__(self, roots: list, index: ModuleIndex | None = None) -> None:
         self.__roots = roots
+        self.__index = index or ModuleIndex()
         self.__modules = {}  # fullname => ast.Module
 
     @property
@@ -330,26 +437,7 @@ class ModuleTable:
 
     def __find_module(self, module_name: str) -> ImportedModule | None:
         if module_name not in self.__modules:
-            module_relpath = '/'.join(module_name.split('.'))
-            module: ast.Module | None = None
-            for root in self.__roots:
-                if os.path.isfile(mpy := f'{root}/{module_relpath}.py'):
-                    try:
-                        with open(mpy, 'r', encoding='UTF-8') as fp:
-                            code = fp.read()
-                        module = ast.parse(code)
-                        break
-                    except (UnicodeDecodeError, FileNotFoundError, SyntaxError):
-                        continue
-                elif os.path.isdir(mdir := f'{root}/{module_relpath}') and \
-                        os.path.isfile(mpy := f'{mdir}/__init__.py'):
-                    try:
-                        with open(mpy, 'r', encoding='UTF-8') as fp:
-                            code = fp.read()
-                        module = ast.parse(code)
-                        break
-                    except (UnicodeDecodeError, FileNotFoundError, SyntaxError):
-                        continue
+            module = self.__index.find_module(self.__roots, module_name)
             self.__modules[module_name] = ImportedModule.make(module_name, module)
         # print(f'Find module: {module_name}, {self.__modules[module_name]}')
         return self.__modules[module_name]
@@ -378,8 +466,8 @@ class ModuleTable:
             return self.__process_import_from(import_)
 
     @classmethod
-    def make(cls, roots: list):
-        return cls(roots)
+    def make(cls, roots: list, index: ModuleIndex | None = None):
+        return cls(roots, index)
 
 
 # ToDo-List:
@@ -390,6 +478,7 @@ class FuncTable:
     def __init__(self, init_func_table: dict) -> None:
         assert isinstance(init_func_table, dict)  # name -> ast.FunctionDef
         self.func_table = init_func_table
+        self.lazy_funcdefs = {}  # name -> ast.FunctionDef, not cloned (update_lazily)
 
     def lookup(self, name) -> ast.FunctionDef:
         # `name` <=> `ast.Call().func`
@@ -397,10 +486,23 @@ class FuncTable:
         if isinstance(name, ast.Name):
             funcname = name.id
             result = self.func_table.get(funcname)
+            if result is None and (fdef := self.lazy_funcdefs.get(funcname)):
+                result = self.func_table[funcname] = _set_parent(_clone_ast(fdef))
         return result
 
     def update(self, codeast: ast.Module):
         self.func_table = self.__class__.find_funcdefs(codeast)
+        self.lazy_funcdefs = {}
+
+    def update_lazily(self, funcdefs: dict):
+        # As update, but a funcdef (of the top-level ones, name -> ast.FunctionDef) is cloned when looked up
+        self.func_table = {}
+        self.lazy_funcdefs = funcdefs
+
+    @classmethod
+    def find_toplevel_funcdefs(cls, codeast: ast.Module):
+        # The funcdefs of find_funcdefs, not cloned
+        return {e.name: e for e in codeast.body if isinstance(e, ast.FunctionDef)}
 
     @classmethod
     def find_funcdefs(cls, codeast: ast.Module):
@@ -420,6 +522,50 @@ class FuncTable:
         return cls(init_func_table=cls.find_funcdefs(codeast))
 
 
+class DefUseIndex:
+    """
+    The def-use of the toplevel stmts of a module: stmt => (read ids, write ids, init ids, read-after-init
+    ids) of _get_rwref_ids(stmt, recursive=False), computed once (when first queried) and filtered by the
+    ignores of each query, for slicing the module many times (_make_program_fragments)
+    NOTE: Built once, the module must not be changed while the index is used (the slicing only clones)
+    """
+    def __init__(self, codeast: ast.Module) -> None:
+        assert isinstance(codeast, ast.Module)
+        self.codeast = codeast
+        self.__rwref_ids = {}  # stmt => (rids, wids, initids, raiids), not filtered
+        self.__srcs = {}  # stmt => source
+        self.__stmt2index = None  # stmt => index in codeast.body
+        self.__import_ids = None
+
+    def index(self, stmt) -> int | None:
+        if self.__stmt2index is None:
+            self.__stmt2index = {s: i for i, s in enumerate(self.codeast.body)}
+        return self.__stmt2index.get(stmt)
+
+    def rwref_ids(self, stmt, ignores=None) -> tuple:
+        if (ids := self.__rwref_ids.get(stmt)) is None:
+            gi = GetRWRefIDs(recursive=False)
+            gi.visit(stmt)
+            ids = self.__rwref_ids[stmt] = tuple(frozenset(e) for e in (gi.rids, gi.wids, gi.initids, gi.allr_after_i_ids))
+        ignores = ignores or set()
+        return tuple(e - ignores for e in ids)
+
+    def source(self, stmt) -> str:
+        if (src := self.__srcs.get(stmt)) is None:
+            src = self.__srcs[stmt] = ast.unparse(ast.fix_missing_locations(stmt))
+        return src
+
+    @property
+    def import_ids(self) -> set:
+        if self.__import_ids is None:
+            self.__import_ids = _get_ids(_find_imports(self.codeast))
+        return set(self.__import_ids)
+
+    @classmethod
+    def make(cls, codeast: ast.Module):
+        return cls(codeast)
+
+
 class FindImports(ast.NodeVisitor):
     def __init__(self) -> None:
         self.imports = []
@@ -944,6 +1090,18 @@ def _is_name_node(node: ast.AST) -> bool:
     return False
 
 
+def _name_node_text(node: ast.AST) -> str | None:
+    # ast.unparse(node) if _is_name_node(node) else None, without the unparser
+    attrs = []
+    while isinstance(node, ast.Attribute):
+        attrs.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    attrs.append(node.id)
+    return '.'.join(reversed(attrs))
+
+
 def _make_name_node(*, name: str=None, name_l: list=None, ctx=None):
     if name is not None:
         name_l = name.split('.')
@@ -1000,6 +1158,19 @@ def _clone_ast(root):
 
     return ret(ast.parse(ast.unparse(mod)))
 
+def _copy_ast_fields(node):
+    # Like copy.deepcopy, but of the fields and locations only, not of `parent`
+    # (which would copy the whole tree the node is in)
+    if isinstance(node, list):
+        return [_copy_ast_fields(e) for e in node]
+    if not isinstance(node, ast.AST):
+        return node
+    new_node = node.__class__(**{f: _copy_ast_fields(getattr(node, f)) for f in node._fields if hasattr(node, f)})
+    for a in node._attributes:
+        if hasattr(node, a):
+            setattr(new_node, a, getattr(node, a))
+    return new_node
+
 def _make_if_true_block(stmts: list):
     assert isinstance(stmts, list)
     return ast.If(
@@ -2173,12 +2344,118 @@ _std_keras_usage_style_trans_fn = {'K_initializer': _std_keras_initializer_usage
                                    'K_loss': _std_keras_loss_usage_style,                # call/name -> string -> original name -> snake name
                                    'K_optimizer': _std_keras_optimizer_usage_style,      # string -> call; call -> std call
                                    'K_metric': _std_keras_metric_usage_style}            # call/name -> string -> original name -> snake name
+
+# Compiled dispatch of _std_keras_usage_style, the same hints as _get_possible_ast_hint
+# for the fragments it rewrites (str constants, names and calls) by dict lookups:
+# str value => hint, and api root => (rank, hint) where the first (rank) category
+# wins as the `if`s of _get_possible_ast_hint
+def _make_keras_str_hint_table(*hint_names) -> dict[str, str]:
+    table = {}
+    for hint, names in hint_names:
+        for name in names:
+            table.setdefault(name, hint)
+    return table
+
+def _make_keras_root_hint_table(*hint_roots) -> tuple[dict[str, tuple[int, str]], list[int]]:
+    table = {}
+    for rank, (hint, roots) in enumerate(hint_roots):
+        for root in roots:
+            table.setdefault(root, (rank, hint))
+    return table, sorted({len(root) for root in table})
+
+_std_keras_str_hints = _make_keras_str_hint_table(('K_padding', _keras_padding_names),
+                                                  ('K_initializer', _keras_initializer_names),
+                                                  ('K_constraint', _keras_constraint_names),
+                                                  ('K_activation', _keras_activation_names),
+                                                  ('K_dataformat', _keras_dataformat_names),
+                                                  ('K_loss', _keras_loss_names),
+                                                  ('K_optimizer', _keras_optimizer_names),
+                                                  ('K_metric', _keras_metric_names),
+                                                  ('K_regularizer', _keras_regularizer_names))
+_std_keras_call_root_hints = _make_keras_root_hint_table(('K_layer', _keras_possible_layers_api_root),
+                                                         ('K_initializer', _keras_possible_inits_api_root),
+                                                         ('K_constraint', _keras_possible_constraints_api_root),
+                                                         ('K_loss', _keras_possible_losses_api_root),
+                                                         ('K_optimizer', _keras_possible_optimizers_api_root),
+                                                         ('K_metric', _keras_possible_metrics_api_root),
+                                                         ('K_regularizer', _keras_possible_regularizers_api_root))
+_std_keras_name_root_hints = _make_keras_root_hint_table(('K_initializer', _keras_possible_inits_api_root),
+                                                         ('K_constraint', _keras_possible_constraints_api_root),
+                                                         ('K_activation', _keras_possible_activations_api_root),
+                                                         ('K_loss', _keras_possible_losses_api_root),
+                                                         ('K_metric', _keras_possible_metrics_api_root))
+def _match_keras_root_hint(fullname: str, root_hints) -> str | None:
+    # any(fullname.startswith(root) for root in roots) of each category, in order
+    table, lengths = root_hints
+    matched = [table[prefix] for n in lengths if (prefix := fullname[:n]) in table]
+    return min(matched)[1] if matched else None
+
+
+class _LRUMemo:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+
+    def get(self, key):
+        if (value := self.data.get(key)) is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+
+_STD_KERAS_INPLACE = object()  # The rule changes the node itself (optimizer calls)
+_std_keras_usage_memo = _LRUMemo(maxsize=1 << 16)  # (cls, fragment) => (fn, new node | None | _STD_KERAS_INPLACE)
+def _std_keras_usage_style_of(node) -> ast.AST | None:
+    # The new node of node by _std_keras_usage_style_trans_fn, memoized by the
+    # source of the fragment, so 'adam', 'relu', ... are looked up once
+    if isinstance(node, ast.Constant):
+        if not isinstance(node.value, str):
+            return None
+        key = ('Constant', node.value)
+    elif (fullname := _name_node_text(node)) is not None:
+        key = (node.__class__.__name__, fullname)
+    elif isinstance(node, ast.Call):
+        # A call is only rewritten if its target (the fullname) is under an api root,
+        # e.g. not model.add(...), which is known without unparsing the whole call
+        if (fullname := _name_node_text(node.func)) is not None and \
+                _match_keras_root_hint(fullname, _std_keras_call_root_hints) not in _std_keras_usage_style_trans_fn:
+            return None
+        key = ('Call', ast.unparse(node))
+    else:
+        return None
+    if (rule := _std_keras_usage_memo.get(key)) is None:
+        if key[0] == 'Constant':
+            hint = _std_keras_str_hints.get(node.value)
+        elif key[0] == 'Call':
+            line = key[1]
+            if _keras_model_compile_infix in line: hint = 'K_model_compile'
+            elif _keras_model_fit_infix in line: hint = 'K_model_fit'
+            else: hint = _match_keras_root_hint(line, _std_keras_call_root_hints)
+        else:
+            hint = _match_keras_root_hint(key[1], _std_keras_name_root_hints)
+        fn = _std_keras_usage_style_trans_fn.get(hint, None)
+        if fn is None:
+            rule = (None, None)
+        elif fn is _std_keras_optimizer_usage_style and isinstance(node, ast.Call):
+            rule = (fn, _STD_KERAS_INPLACE)
+        else:
+            rule = (fn, fn(node))
+        _std_keras_usage_memo.put(key, rule)
+    fn, new_node = rule
+    if new_node is _STD_KERAS_INPLACE:
+        return fn(node)
+    return _copy_ast_fields(new_node)  # Never share a node between trees
+
+
 def _std_keras_usage_style(codeast):
     replace_node_map = {}  # node => new node
     for node in ast.walk(codeast):
-        if fn := _std_keras_usage_style_trans_fn.get(_get_possible_ast_hint(node), None):
-            if new_node := fn(node):
-                replace_node_map[node] = new_node
+        if new_node := _std_keras_usage_style_of(node):
+            replace_node_map[node] = new_node
     codeast = ReplaceXWithY(x_cls_names=[e.__class__.__name__ for e in replace_node_map.keys()],
                             is_x=lambda x: x in replace_node_map,
                             make_y=lambda x: replace_node_map.pop(x)).visit(codeast)
@@ -2186,9 +2463,9 @@ def _std_keras_usage_style(codeast):
     return codeast
 
 
-def _make_module_table(roots: str):
+def _make_module_table(roots: str, index: ModuleIndex | None = None):
     roots = [os.path.abspath(root) for root in roots]
-    return ModuleTable.make(roots)
+    return ModuleTable.make(roots, index)
 
 
 def _make_func_table(codeast):
@@ -2523,6 +2800,18 @@ def _inline_all_imports(
         make_y=lambda n: replace_node_map[n]).visit(codeast)
 
     # Rename imported ids
+    ## The names (and <name>.xxx) that can be renamed, by id, instead of walking the codeast for each import
+    id2names = collections.defaultdict(dict)  # id => {ast.Name: None}, ordered
+    name2attr = {}  # ast.Name => ast.Attribute(value=ast.Name)
+    for node in ast.walk(codeast):
+        if isinstance(node, ast.Name) and node in node2seq:
+            id2names[node.id][node] = None
+        elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            name2attr[node.value] = node
+    def rename(name, new_id):
+        del id2names[name.id][name]
+        name.id = new_id
+        id2names[new_id][name] = None
     replace_node_map = {}  # node => new_node
     for si, (lseq, hseq), symbol_map, imp_mod in imported_symbol_maps:
         imported_symbol, imported_id = _get_imported_symbol_and_id(si)
@@ -2535,8 +2824,9 @@ def _inline_all_imports(
                         x.attr in symbol_map and \
                         x.value in node2seq and \
                         lseq <= node2seq[x.value] < hseq
-            for attr in _find_x(codeast, is_x=is_x):
-                replace_node_map[attr] = ast.Name(id=symbol_map[attr.attr], ctx=attr.ctx)
+            for attr in [name2attr[n] for n in id2names[imported_id] if n in name2attr]:
+                if is_x(attr):
+                    replace_node_map[attr] = ast.Name(id=symbol_map[attr.attr], ctx=attr.ctx)
         else:  # imported_symbol is symbol
             if imported_id == '*':
                 def is_x(x):
@@ -2545,8 +2835,8 @@ def _inline_all_imports(
                             x.id in symbol_map and \
                             x in node2seq and \
                             lseq <= node2seq[x] < get_1st_init_seq(x.id)
-                for name in _find_x(codeast, is_x=is_x):
-                    name.id = symbol_map[name.id]
+                for name in [n for i in symbol_map if i in id2names for n in id2names[i] if is_x(n)]:
+                    rename(name, symbol_map[name.id])
             else:
                 def is_x(x):
                     # <imported_id>...
@@ -2555,8 +2845,8 @@ def _inline_all_imports(
                             x in node2seq and \
                             lseq <= node2seq[x] < hseq
                 if (rel_i_sym := _get_relname(imported_symbol, start=imp_mod.fullname)) in symbol_map:
-                    for name in _find_x(codeast, is_x=is_x):
-                        name.id = symbol_map[rel_i_sym]
+                    for name in [n for n in id2names[imported_id] if is_x(n)]:
+                        rename(name, symbol_map[rel_i_sym])
     codeast = ReplaceXWithY(
         x_cls_names={x.__class__.__name__ for x in replace_node_map.keys()},
         is_x=lambda n: n in replace_node_map,
@@ -2567,28 +2857,74 @@ def _inline_all_imports(
     return codeast, len(inlined_imports), inlined_imports
 
 
-# NOTE: Required: After `_trans_comp_to_loop`
-def _inline_all_calls(
-        codeast, 
-        func_table: FuncTable, 
-        idx_maker, 
-        recursive=True, 
-        max_tries=512, 
-        rename_with_more_info=False): # -> codeast, int
-    assert callable(idx_maker)
-    codeast = _set_depth(codeast)
-    calls = _find_calls(codeast, recursive=True, ignore_parents=['FunctionDef'])
-    calls.sort(key=lambda e: -e._pg_depth)  # sort by -depth; rq:stable-sort
+def _preorder_key(node) -> tuple | None:
+    # Compare as the nodes are visited by ast.NodeVisitor (from the root), None if the node has been
+    # removed from the tree; NOTE: Required: parents
+    path = []
+    while (p := node.parent) is not None:
+        i = next((i for i, child in enumerate(ast.iter_child_nodes(p)) if child is node), None)
+        if i is None: return None
+        path.append(i)
+        node = p
+    return tuple(reversed(path))
+
+
+def _find_calls_with_keys(node, key: tuple) -> list:
+    # [((-depth, preorder key), call), ...] of _find_calls(node, recursive=True, ignore_parents=['FunctionDef']),
+    # by which the calls of the codeast are sorted in _inline_all_calls; key is the preorder key of node
+    found = []
+    def visit(n, k):
+        if isinstance(n, ast.FunctionDef): return
+        if isinstance(n, ast.Call): found.append(((-len(k), k), n))
+        for i, child in enumerate(ast.iter_child_nodes(n)):
+            visit(child, (*k, i))
+    visit(node, key)
+    return found
+
+
+def _fix_missing_locations_under(node, parent):
+    # The locations of ast.fix_missing_locations(codeast) for the node newly put under parent
+    # (which has been fixed), i.e. the missing ones are of the nearest located ancestor
+    loc = {'lineno': 1, 'col_offset': 0, 'end_lineno': 1, 'end_col_offset': 0}
+    for p in _iter_parent_chain(parent, with_self=True):
+        if 'lineno' in p._attributes:
+            loc = {a: getattr(p, a) for a in loc}
+            break
+    for a, v in loc.items():
+        if a in node._attributes and getattr(node, a, None) is None:
+            setattr(node, a, v)
+    return ast.fix_missing_locations(node)
+
+
+def _fix_inlined_stmts(inlined_at: list) -> list:
+    # Set parents & fix locations of the c_pstmts (calls replaced) and the stmts put before them, as
+    # _set_parent(ast.fix_missing_locations(codeast)) does; -> [(preorder key, stmt), ...] (sorted)
+    # NOTE: In preorder, the parent of a node put in many places (e.g. a default of a funcdef) is the last one
+    for c_pstmt, stmts in inlined_at:
+        ast.fix_missing_locations(_set_parent(c_pstmt))
+        for s in stmts:
+            s.parent = c_pstmt.parent
+    keyed_stmts = sorted(((_preorder_key(s), s) for _, stmts in inlined_at for s in stmts), key=lambda e: e[0])
+    for _, s in keyed_stmts:
+        _set_parent(_fix_missing_locations_under(s, s.parent))
+    return keyed_stmts
+
+
+def _inline_calls_in_order(codeast, calls, func_table: FuncTable, idx_maker, rename_with_more_info=False):
+    # -> inlined calls, the not inlined calls, [(c_pstmt, stmts put before it), ...]
+    # NOTE: The stmts are put in place, the parents and locations of them are not set
     soft_func_name = (lambda n: n.func.id if isinstance(n.func, ast.Name) else '') \
                         if rename_with_more_info else (lambda n: '')
     replace_node_map = {}  # node => [stmt0, stmt1, ...]
-    inlined_calls = []
+    inlined_calls, not_inlined_calls = [], []
     for c in calls:
         inlined_stmts, arg_var_ids, ret_var_id = _inline_call(
             call=c,
             id_suffix_maker=lambda: f'{soft_func_name(c)}{idx_maker()}',
             func_table=func_table)
-        if inlined_stmts is None: continue
+        if inlined_stmts is None:
+            not_inlined_calls.append(c)
+            continue
         block, c_pstmt = _get_nearest_block_stmt(c)
         # c_pstmt -> [*inlined_stmts, replace_call_with_retvar(c_pstmt, ...)]
         proced_c_pstmt = ReplaceXWithY(
@@ -2600,20 +2936,79 @@ def _inline_all_calls(
         replace_node_map[c_pstmt].extend(inlined_stmts)
         inlined_calls.append(c)
     assert len(inlined_calls) >= len(replace_node_map)
-    codeast = ReplaceXWithY(
-        x_cls_names={x.__class__.__name__ for x in replace_node_map.keys()},
-        is_x=lambda n: n in replace_node_map,
-        make_y=lambda n: [*replace_node_map[n], n]).visit(codeast)
-    # Fix codeast (locs & set-parent)
-    codeast = _set_parent(ast.fix_missing_locations(codeast))
-    # Inline calls in the codeast recursively
-    ch_cnt = len(inlined_calls)
-    if recursive:
-        for _ in range(max_tries):
-            func_table.update(codeast)
-            codeast, ch_cnt, ics = _inline_all_calls(codeast, func_table, idx_maker, False, None, rename_with_more_info)
-            if ch_cnt == 0: break
-            inlined_calls.extend(ics)
+    # c_pstmt -> [*inlined_stmts, c_pstmt], in its block (as ReplaceXWithY, without visiting the codeast)
+    for c_pstmt, stmts in replace_node_map.items():
+        block = c_pstmt.parent
+        stmt_list = next(l for l in (getattr(block, f, None) for f in ('body', 'orelse', 'finalbody'))
+                         if isinstance(l, list) and any(s is c_pstmt for s in l))
+        i = next(i for i, s in enumerate(stmt_list) if s is c_pstmt)
+        stmt_list[i:i] = stmts
+    return inlined_calls, not_inlined_calls, list(replace_node_map.items())
+
+
+# NOTE: Required: After `_trans_comp_to_loop`
+def _inline_all_calls(
+        codeast, 
+        func_table: FuncTable, 
+        idx_maker, 
+        recursive=True, 
+        max_tries=512, 
+        rename_with_more_info=False,
+        ch_cnts: list | None = None): # -> codeast, int
+    # ch_cnts: If given, the number of the inlined calls of each pass is appended to it
+    # A pass only visits the calls that can be inlined (as a worklist): the calls in the stmts inlined by the
+    # last pass, and the (not inlined) calls of the new funcdefs (toplevel ones, from the inlined stmts).
+    # All calls are visited (a full pass) in the 1st pass, or if a call is put in many places (e.g. in
+    # a default of a funcdef), which can be inlined many times (once a pass) as it was
+    assert callable(idx_maker)
+    ch_cnts = ch_cnts if ch_cnts is not None else []
+    funcdefs = FuncTable.find_toplevel_funcdefs(codeast)
+    keyed_calls = None  # [((-depth, preorder key), call), ...]; None: a full pass
+    inlined_calls = []
+    waiting_calls = {}  # call => None, not inlined
+    shared_calls = set()  # ids of the calls put in many places
+    for i in range(1 + (max_tries if recursive else 0)):
+        if i > 0:
+            func_table.update_lazily(funcdefs)
+        if keyed_calls is None:
+            codeast = _set_depth(codeast)
+            calls = _find_calls(codeast, recursive=True, ignore_parents=['FunctionDef'])
+            calls.sort(key=lambda e: -e._pg_depth)  # sort by -depth; rq:stable-sort
+        else:
+            calls = [c for _, c in keyed_calls]
+        ics, not_inlined_calls, inlined_at = _inline_calls_in_order(
+            codeast, calls, func_table, idx_maker, rename_with_more_info)
+        # Fix codeast (locs & set-parent)
+        if keyed_calls is None:
+            codeast = _set_parent(ast.fix_missing_locations(codeast))
+            keyed_stmts = sorted(((_preorder_key(s), s) for _, stmts in inlined_at for s in stmts), key=lambda e: e[0])
+        else:
+            keyed_stmts = _fix_inlined_stmts(inlined_at)
+        ch_cnt = len(ics)
+        ch_cnts.append(ch_cnt)
+        if i > 0 and ch_cnt == 0: break
+        inlined_calls.extend(ics)
+        # The calls for the next pass
+        n_occurs = collections.Counter(map(id, calls))
+        shared_calls.update(id(c) for c in calls if n_occurs[id(c)] > 1)
+        for c in not_inlined_calls: waiting_calls[c] = None
+        for c in ics: waiting_calls.pop(c, None)
+        keyed_calls = [kc for k, s in keyed_stmts for kc in _find_calls_with_keys(s, k)]
+        if any(c_pstmt.parent is codeast and isinstance(s, ast.FunctionDef) for c_pstmt, stmts in inlined_at for s in stmts):
+            new_funcdefs = FuncTable.find_toplevel_funcdefs(codeast)
+            new_names = {name for name, fdef in new_funcdefs.items() if funcdefs.get(name) is not fdef}
+            funcdefs = new_funcdefs
+            visited = {id(c) for _, c in keyed_calls}
+            for c in waiting_calls:
+                if isinstance(c.func, ast.Name) and c.func.id in new_names and id(c) not in visited and \
+                        (k := _preorder_key(c)) is not None:
+                    keyed_calls.append(((-len(k), k), c))
+        keyed_calls.sort(key=lambda e: e[0])
+        n_occurs = collections.Counter(id(c) for _, c in keyed_calls)
+        shared_calls.update(cid for cid, n in n_occurs.items() if n > 1)
+        if any(id(c) in shared_calls for c in ics) or \
+                any(id(c) in shared_calls and isinstance(c.func, ast.Name) and c.func.id in funcdefs for _, c in keyed_calls):
+            keyed_calls = None
 
     return codeast, ch_cnt, inlined_calls
 
@@ -2676,11 +3071,14 @@ def _make_program_fragments(
         cared_ast_checkers: list,
         cared_ast_transformer,
         print_progress: bool = False,
-        spec_cared_ast = None) -> list:
+        spec_cared_ast = None,
+        def_use_index: DefUseIndex | None = None) -> list:
     if cared_ast_transformer is None: return []
     assert spec_cared_ast or all([callable(f) for f in cared_ast_checkers])
     assert callable(cared_ast_transformer)
     glb_ignores = glb_ignores or set()
+    # Shared by all cared nodes and fragments (the codeast is not changed)
+    def_use_index = def_use_index or DefUseIndex.make(codeast)
 
     def is_cared_stmt(x) -> bool:
         for ck in cared_ast_checkers:
@@ -2693,15 +3091,13 @@ def _make_program_fragments(
 
     for node in nodes:
         assert isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
-        import_ids = _get_ids(_find_imports(codeast))
+        import_ids = def_use_index.import_ids
         body: list = codeast.body
 
         for p in _iter_parent_chain(node):
-            try:
-                index = body.index(p)
+            if (i := def_use_index.index(p)) is not None:
+                index = i
                 break
-            except ValueError as ex:
-                pass
 
         stmt_list = []
         id_set = set()
@@ -2723,8 +3119,8 @@ def _make_program_fragments(
             stmt_list.append(cared_stmt)
         id_set.update(_get_ids(cared_stmt, ignores=ignore_ids))
         for stmt in reversed(body[: index]):
-            rids, wids, initids, allr_after_i_ids = _get_rwref_ids(stmt, recursive=False, ignores=ignore_ids)
-            stmt_src = ast.unparse(ast.fix_missing_locations(stmt))
+            rids, wids, initids, allr_after_i_ids = def_use_index.rwref_ids(stmt, ignores=ignore_ids)
+            stmt_src = def_use_index.source(stmt)
             if (wids & id_set) or \
                 '__mask_0__' in stmt_src or \
                 'seed(' in  stmt_src:
@@ -2750,7 +3146,8 @@ def _make_program_fragments(
                                          cared_ast_checkers=cared_ast_checkers,
                                          cared_ast_transformer=next_cared_ast_transformer,
                                          print_progress=print_progress,
-                                         spec_cared_ast=[node]),
+                                         spec_cared_ast=[node],
+                                         def_use_index=def_use_index),
             ]
 
     raise R2MSError(f'Make program fragment: failed to verify the program')
@@ -2802,13 +3199,15 @@ def _main(code: str, import_root: str, configs: dict) -> str:
                                                                           roots=[
                                                                               *configs['CONFIG_import_roots'],
                                                                               import_root
-                                                                          ]
+                                                                          ],
+                                                                          index=_get_module_index(configs['CONFIG_module_index_file'] or None)
                                                                       ),
                                                                       idx_maker=glb_idx_maker,
                                                                       recursive=True,
                                                                       max_tries=configs['CONFIG_inline_imports_max_tries'],
                                                                       print_progress=configs['ENABLE_print_inline_imports_progress'],
                                                                       rename_with_more_info=configs['ENABLE_rename_with_more_info'])
+        _get_module_index(configs['CONFIG_module_index_file'] or None).save()
     ## Flat the non-vatomic-stmt(s): _trans_comp_to_loop, _std_calls; NOTE: DO NOT CHANE ORDER OF THE PASSES
     if configs['ENABLE_trans_comp_to_loop']:
         codeast = _trans_comp_to_loop(codeast, idx_maker=glb_idx_maker)
@@ -2817,12 +3216,16 @@ def _main(code: str, import_root: str, configs: dict) -> str:
     ## Inline calls
     inlined_calls = []
     if configs['ENABLE_inline_calls']:
+        inline_calls_ch_cnts = []
         codeast, latest_ch_cnt, inlined_calls = _inline_all_calls(codeast,
                                                                   func_table=_make_func_table(codeast),
                                                                   idx_maker=glb_idx_maker,
                                                                   recursive=True,
                                                                   max_tries=configs['CONFIG_inline_calls_max_tries'],
-                                                                  rename_with_more_info=configs['ENABLE_rename_with_more_info'])
+                                                                  rename_with_more_info=configs['ENABLE_rename_with_more_info'],
+                                                                  ch_cnts=inline_calls_ch_cnts)
+        if configs['ENABLE_print_inline_calls_progress']:
+            print(f'Inlined calls of each pass: {inline_calls_ch_cnts}')
     if configs['ENABLE_rename_imported_id_to_fullname']:
         codeast = _rename_imported_id_to_fullname(codeast, 
                                                   remove_imports=configs['ENABLE_remove_imports_after_renaming_imported_id_to_fullname'],
@@ -3193,6 +3596,7 @@ DEFAULT_CONFIGS = {
     'ENABLE_print_clip_process': False,
     'ENABLE_print_changed_code': False,
     'ENABLE_print_inline_imports_progress': False,
+    'ENABLE_print_inline_calls_progress': False,
     'ENABLE_rename_with_more_info': False,
     'ENABLE_rename_imported_id_to_fullname': True,
     'ENABLE_remove_imports_after_renaming_imported_id_to_fullname': True,
@@ -3215,6 +3619,7 @@ DEFAULT_CONFIGS = {
     'CONFIG_inline_calls_max_tries': 16,
     'CONFIG_rename_imported_id_root_mark': '__root__',
     'CONFIG_import_roots': [],
+    'CONFIG_module_index_file': '',  # Save the parsed modules for other runs if given
     'CONFIG_cared_api_calls': ['keras_fit', 'keras_fit_generator', 'keras_train_on_batch'],
     'CONFIG_cared_ast_transformer': 'keras_program',
 }
@@ -3226,6 +3631,7 @@ def get_v6_config():
     configs['ENABLE_print_clip_process'] = False
     configs['ENABLE_print_changed_code'] = False
     configs['ENABLE_print_inline_imports_progress'] = False
+    configs['ENABLE_print_inline_calls_progress'] = False
     configs['ENABLE_rename_with_more_info'] = False
     configs['ENABLE_rename_imported_id_to_fullname'] = True
     configs['ENABLE_remove_imports_after_renaming_imported_id_to_fullname'] = True
@@ -3248,6 +3654,7 @@ def get_v6_config():
     configs['CONFIG_inline_calls_max_tries'] = 16
     configs['CONFIG_rename_imported_id_root_mark'] = '__root__'
     configs['CONFIG_import_roots'] = []
+    configs['CONFIG_module_index_file'] = ''
     configs['CONFIG_cared_api_calls'] = ['keras_fit', 'keras_fit_generator', 'keras_train_on_batch']
     configs['CONFIG_cared_ast_transformer'] = 'keras_program'
     return configs